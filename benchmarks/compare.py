@@ -0,0 +1,74 @@
+"""Compare two benchmark result files and fail on regressions
+
+Usage:
+    python -m benchmarks.compare baseline.json candidate.json [--threshold 10]
+
+Exits with 1 if any metric of any case got worse by more than the
+threshold, in percent. Timings below --min-seconds are too noisy to
+compare and are only shown.
+"""
+import argparse
+import json
+import sys
+
+from benchmarks.run import METRICS
+
+# Timings are too noisy to compare when they are very short
+TIME_METRICS = {'wall_s', 'cpu_s'}
+
+
+def compare(baseline: dict, candidate: dict, threshold: float, min_seconds: float) -> list[str]:
+    """Print a comparison table and return the regressions found"""
+    regressions = []
+    print(f"{'case':<16} {'metric':<16} {'baseline':>12} {'candidate':>12} {'change':>9}")
+    for name, new in candidate['cases'].items():
+        old = baseline['cases'].get(name)
+        if old is None:
+            print(f"{name:<16} (new case)")
+            continue
+
+        rows = [(metric, old[metric], new[metric]) for metric in METRICS]
+        rows += [
+            (f"stage:{stage}", old['stages'].get(stage, 0.0), seconds)
+            for stage, seconds in new['stages'].items()
+        ]
+        for metric, old_value, new_value in rows:
+            change = (new_value - old_value) / old_value * 100 if old_value else 0.0
+            noisy = (metric in TIME_METRICS or metric.startswith('stage:')) and old_value < min_seconds
+            regressed = change > threshold and not noisy
+            mark = " !" if regressed else ""
+            print(f"{name:<16} {metric:<16} {old_value:>12.3f} {new_value:>12.3f} {change:>+8.1f}%{mark}")
+            if regressed:
+                regressions.append(f"{name} {metric}: {old_value:.3f} -> {new_value:.3f} ({change:+.1f}%)")
+    return regressions
+
+
+def main(argv: list[str] = None) -> int:
+    """Command-line entry point"""
+    parser = argparse.ArgumentParser(prog="python -m benchmarks.compare", description=__doc__.splitlines()[0])
+    parser.add_argument('baseline')
+    parser.add_argument('candidate')
+    parser.add_argument('--threshold', type=float, default=10.0, help="allowed regression in percent")
+    parser.add_argument('--min-seconds', type=float, default=0.05, help="ignore timings shorter than this")
+    args = parser.parse_args(argv)
+
+    with open(args.baseline, encoding='utf-8') as f:
+        baseline = json.load(f)
+    with open(args.candidate, encoding='utf-8') as f:
+        candidate = json.load(f)
+
+    if baseline['meta']['mode'] != candidate['meta']['mode']:
+        print(f"Warning: comparing {baseline['meta']['mode']} results with {candidate['meta']['mode']} results")
+
+    regressions = compare(baseline, candidate, args.threshold, args.min_seconds)
+    if regressions:
+        print(f"\n{len(regressions)} regressions over {args.threshold}%:")
+        for regression in regressions:
+            print(f"  {regression}")
+        return 1
+    print("\nNo regressions")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,109 @@
+"""Deterministic synthetic media corpus for the benchmarks
+
+Every case is generated from a fixed seed, so the same library versions
+always produce the same files. Files that already exist are reused.
+"""
+import os
+from typing import Callable, NamedTuple
+
+import cv2
+import numpy
+from PIL import Image
+
+SEED = 1234
+
+
+class Case(NamedTuple):
+    name: str
+    file_name: str
+    path: str  # MediaProcessor path it exercises: static, gif or video
+    generate: Callable[[str], None]
+
+
+def _scene(rng: numpy.random.Generator, width: int, height: int, t: float) -> numpy.ndarray:
+    """Frame with a gradient, moving shapes and noise, so encoders have real work"""
+    x = numpy.linspace(0, 255, width, dtype=numpy.float32)
+    y = numpy.linspace(0, 255, height, dtype=numpy.float32)[:, None]
+    frame = numpy.empty((height, width, 3), dtype=numpy.uint8)
+    frame[:, :, 0] = (x + t * 40) % 256
+    frame[:, :, 1] = (y + t * 25) % 256
+    frame[:, :, 2] = ((x + y) / 2 + t * 10) % 256
+
+    size = min(width, height)
+    for i in range(6):
+        center = (
+            int(width / 2 + numpy.cos(t * (i + 1) * 0.7 + i) * width / 3),
+            int(height / 2 + numpy.sin(t * (i + 1) * 0.5 + i) * height / 3)
+        )
+        color = tuple(int(c) for c in (i * 40 % 256, 255 - i * 30, i * 70 % 256))
+        cv2.circle(frame, center, max(size // (8 + i), 2), color, -1)
+
+    noise = rng.integers(0, 24, size=frame.shape, dtype=numpy.uint8)
+    return cv2.add(frame, noise)
+
+
+def _jpeg(width: int, height: int) -> Callable[[str], None]:
+    def generate(path: str):
+        rng = numpy.random.default_rng(SEED)
+        frame = _scene(rng, width, height, 0.0)
+        Image.fromarray(frame[:, :, ::-1]).save(path, 'JPEG', quality=90)
+    return generate
+
+
+def _rgba_png(width: int, height: int) -> Callable[[str], None]:
+    def generate(path: str):
+        rng = numpy.random.default_rng(SEED)
+        rgb = _scene(rng, width, height, 1.0)[:, :, ::-1]
+        # Round sticker-like shape with soft edges
+        yy, xx = numpy.mgrid[0:height, 0:width]
+        distance = numpy.hypot(xx - width / 2, yy - height / 2) / (min(width, height) / 2)
+        alpha = numpy.clip((1.0 - distance) * 8 * 255, 0, 255).astype(numpy.uint8)
+        Image.fromarray(numpy.dstack([rgb, alpha]), 'RGBA').save(path, 'PNG')
+    return generate
+
+
+def _mp4(width: int, height: int, fps: int, seconds: float) -> Callable[[str], None]:
+    def generate(path: str):
+        rng = numpy.random.default_rng(SEED)
+        out = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*'mp4v'), fps, (width, height))
+        if not out.isOpened():
+            raise RuntimeError(f"Failed to open video writer for {path}")
+        for index in range(int(fps * seconds)):
+            out.write(_scene(rng, width, height, index / fps))
+        out.release()
+    return generate
+
+
+def _gif(width: int, height: int, frames: int, duration: int) -> Callable[[str], None]:
+    def generate(path: str):
+        rng = numpy.random.default_rng(SEED)
+        images = [
+            Image.fromarray(_scene(rng, width, height, index * duration / 1000)[:, :, ::-1])
+            .quantize(64, method=Image.Quantize.FASTOCTREE)
+            for index in range(frames)
+        ]
+        images[0].save(path, save_all=True, append_images=images[1:], duration=duration, loop=0)
+    return generate
+
+
+CASES = [
+    Case('jpeg-small', 'small.jpg', 'static', _jpeg(640, 480)),
+    Case('jpeg-huge', 'huge.jpg', 'static', _jpeg(6000, 4000)),
+    Case('png-rgba', 'rgba.png', 'static', _rgba_png(1600, 1600)),
+    Case('mp4-long', 'long.mp4', 'video', _mp4(1280, 720, 30, 20)),
+    Case('mp4-high-fps', 'high_fps.mp4', 'video', _mp4(1280, 720, 120, 4)),
+    Case('gif-many-frames', 'many_frames.gif', 'gif', _gif(480, 360, 300, 20)),
+]
+
+
+def ensure_corpus(directory: str, cases: list[Case], regenerate: bool = False) -> dict[str, str]:
+    """Generate missing corpus files, returns the file path of every case"""
+    os.makedirs(directory, exist_ok=True)
+    paths = {}
+    for case in cases:
+        path = os.path.join(directory, case.file_name)
+        if regenerate or not os.path.exists(path):
+            print(f"Generating {case.name}: {path}")
+            case.generate(path)
+        paths[case.name] = path
+    return paths
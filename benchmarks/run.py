@@ -0,0 +1,192 @@
+"""Run MediaProcessor over the synthetic corpus and store the results as JSON
+
+Usage:
+    python -m benchmarks.run [--mode sticker|emoji] [--repeat 3] [--output results.json]
+
+Every run processes one file in a fresh process, so peak RSS belongs to
+that file alone. CPU time includes encoder subprocesses such as ffmpeg,
+peak RSS is the benchmark process only. Per case, the median of the runs
+is reported.
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import cv2
+import numpy
+import PIL
+
+from benchmarks.corpus import CASES, ensure_corpus
+from utils.encoders import get_encoder
+
+# Numbers reported per run and summarized per case
+METRICS = ['wall_s', 'cpu_s', 'peak_rss_mb', 'encode_attempts', 'output_size']
+
+
+def _peak_rss_mb() -> float:
+    """Peak RSS of this process, without subprocesses"""
+    # Encoder subprocesses aren't measured, RUSAGE_CHILDREN has the same
+    # problem and would report the peak of the process that forked them.
+    # Linux keeps ru_maxrss across exec, so a spawned process would report
+    # its parent's peak. VmHWM starts over with the new address space.
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 1024 / (1024 if sys.platform == 'darwin' else 1)
+
+
+def _run_case(source_path: str, is_sticker: bool, results: multiprocessing.Queue):
+    """Process one file, runs in its own process"""
+    import logging
+    logging.disable(logging.CRITICAL)
+    from utils.admission import cpu_time, estimate_cost
+    from utils.media_processor import MediaProcessor
+
+    scratch_dir = tempfile.mkdtemp(prefix="bench_")
+    try:
+        work_path = os.path.join(scratch_dir, os.path.basename(source_path))
+        shutil.copyfile(source_path, work_path)
+        # The encoder is probed once, outside the measurement
+        get_encoder()
+        baseline_rss = _peak_rss_mb()
+
+        wall_start = time.perf_counter()
+        cpu_start = cpu_time()
+        processor = MediaProcessor(work_path, is_sticker)
+        estimate = estimate_cost(processor.probe(), is_sticker, processor.encoder.in_process)
+        result_path, was_modified = processor.process()
+        run = {
+            'wall_s': time.perf_counter() - wall_start,
+            # Encoder subprocesses included, like the admission control prediction
+            'cpu_s': cpu_time() - cpu_start,
+            'peak_rss_mb': _peak_rss_mb(),
+            'baseline_rss_mb': baseline_rss,
+            # The admission control prediction, compare with peak_rss_mb - baseline_rss_mb
+            'predicted_memory_mb': estimate.memory_bytes / 1024 / 1024,
+            'predicted_cpu_s': estimate.cpu_seconds,
+            'encode_attempts': processor.encode_attempts,
+            'decode_passes': processor.decode_passes,
+            'output_size': os.path.getsize(result_path),
+            'was_modified': was_modified,
+            'stages': processor.stage_times,
+            'encode_times': processor.encode_times
+        }
+        del processor
+        results.put(run)
+    except Exception as e:
+        results.put({'error': str(e)})
+    finally:
+        shutil.rmtree(scratch_dir, ignore_errors=True)
+
+
+def run_once(source_path: str, is_sticker: bool) -> dict:
+    """Process a file in a fresh process and return its measurements"""
+    context = multiprocessing.get_context('spawn')
+    results = context.Queue()
+    process = context.Process(target=_run_case, args=(source_path, is_sticker, results))
+    process.start()
+    run = results.get()
+    process.join()
+    if 'error' in run:
+        raise RuntimeError(run['error'])
+    return run
+
+
+def summarize(runs: list[dict]) -> dict:
+    """Median of every metric and stage over the runs"""
+    # The lower median is an actual run, so counts stay whole numbers
+    summary = {metric: statistics.median_low(run[metric] for run in runs) for metric in METRICS}
+    stages = sorted({stage for run in runs for stage in run['stages']})
+    summary['stages'] = {
+        stage: statistics.median_low(run['stages'].get(stage, 0.0) for run in runs)
+        for stage in stages
+    }
+    summary['decode_passes'] = runs[0]['decode_passes']
+    summary['predicted_memory_mb'] = runs[0]['predicted_memory_mb']
+    summary['baseline_rss_mb'] = statistics.median_low(run['baseline_rss_mb'] for run in runs)
+    summary['was_modified'] = runs[0]['was_modified']
+    return summary
+
+
+def _git_revision() -> str:
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ""
+
+
+def main(argv: list[str] = None) -> int:
+    """Command-line entry point"""
+    parser = argparse.ArgumentParser(prog="python -m benchmarks.run", description=__doc__.splitlines()[0])
+    parser.add_argument('--mode', choices=['sticker', 'emoji'], default='sticker')
+    parser.add_argument('--repeat', type=int, default=3, help="runs per case")
+    parser.add_argument('--case', action='append', choices=[case.name for case in CASES],
+                        help="run only these cases, can be repeated")
+    parser.add_argument('--corpus', default=os.path.join(os.path.dirname(__file__), 'corpus'),
+                        help="directory of the generated corpus")
+    parser.add_argument('--regenerate', action='store_true', help="generate the corpus again")
+    parser.add_argument('--output', default="benchmark_results.json", help="results file")
+    args = parser.parse_args(argv)
+
+    cases = [case for case in CASES if not args.case or case.name in args.case]
+    paths = ensure_corpus(args.corpus, cases, args.regenerate)
+
+    results = {
+        'meta': {
+            'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'revision': _git_revision(),
+            'mode': args.mode,
+            'video_encoder': get_encoder().name,
+            'repeat': args.repeat,
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+            'opencv': cv2.__version__,
+            'pillow': PIL.__version__,
+            'numpy': numpy.__version__
+        },
+        'cases': {}
+    }
+
+    for case in cases:
+        runs = [run_once(paths[case.name], args.mode == 'sticker') for _ in range(args.repeat)]
+        summary = summarize(runs)
+        summary['path'] = case.path
+        summary['source_size'] = os.path.getsize(paths[case.name])
+        summary['runs'] = runs
+        results['cases'][case.name] = summary
+
+        stages = ", ".join(f"{stage} {seconds:.2f}s" for stage, seconds in summary['stages'].items())
+        print(
+            f"{case.name:<16} wall {summary['wall_s']:.2f}s  cpu {summary['cpu_s']:.2f}s  "
+            f"rss (self) {summary['peak_rss_mb']:.0f}MB (+{summary['peak_rss_mb'] - summary['baseline_rss_mb']:.0f}MB, "
+            f"predicted {summary['predicted_memory_mb']:.0f}MB)  attempts {summary['encode_attempts']}  "
+            f"size {summary['output_size'] / 1024:.1f}KB  ({stages})"
+        )
+
+    with open(args.output, 'w', encoding='utf-8') as f:
+        json.dump(results, f, indent=2)
+    print(f"Results: {args.output}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
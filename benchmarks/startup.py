@@ -0,0 +1,124 @@
+"""Measure how fast the bot starts and serves its first file
+
+Usage:
+    python -m benchmarks.startup [--repeat 5] [--output startup.json]
+
+Every run starts a fresh interpreter, imports main, warms the worker
+pool up and processes a small JPEG. The import time, the warm-up time
+and the time to the first result are reported as medians over the runs.
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+METRICS = ['import_s', 'warm_up_s', 'first_result_s', 'total_s']
+# Modules the bot process itself should not need to import
+HEAVY_MODULES = ['cv2', 'numpy', 'PIL']
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def _child(source_path: str):
+    """One cold start, runs in a fresh interpreter and prints its measurements"""
+    start = time.perf_counter()
+    import main
+    imported = time.perf_counter()
+    heavy_modules = [name for name in HEAVY_MODULES if name in sys.modules]
+
+    async def serve_first_file() -> tuple[float, float]:
+        await main.worker_pool.warm_up(60)
+        warmed = time.perf_counter()
+        work_path = os.path.join(os.getcwd(), os.path.basename(source_path))
+        shutil.copyfile(source_path, work_path)
+        await main.worker_pool.process(work_path, True)
+        return warmed, time.perf_counter()
+
+    try:
+        warmed, done = asyncio.run(serve_first_file())
+    finally:
+        main.worker_pool.shutdown()
+    print(json.dumps({
+        'import_s': imported - start,
+        'warm_up_s': warmed - imported,
+        'first_result_s': done - warmed,
+        'total_s': done - start,
+        'heavy_modules': heavy_modules
+    }))
+
+
+def run_once(source_path: str) -> dict:
+    """Start the bot in a fresh interpreter and return its measurements"""
+    work_dir = tempfile.mkdtemp(prefix="startup_")
+    env = dict(os.environ, PYTHONPATH=REPO_ROOT, BOT_TOKEN="123456:startup-benchmark", METRICS_ENABLED="false")
+    try:
+        # The bot writes logs, cache and scratch files to its working directory
+        output = subprocess.run(
+            [sys.executable, '-m', 'benchmarks.startup', '--child', source_path],
+            cwd=work_dir, env=env, capture_output=True, text=True, check=True
+        ).stdout
+    except subprocess.CalledProcessError as e:
+        raise RuntimeError(f"Startup run failed: {e.stderr.strip()}")
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def main(argv: list[str] = None) -> int:
+    """Command-line entry point"""
+    parser = argparse.ArgumentParser(prog="python -m benchmarks.startup", description=__doc__.splitlines()[0])
+    parser.add_argument('--repeat', type=int, default=5, help="cold starts to measure")
+    parser.add_argument('--corpus', default=os.path.join(os.path.dirname(__file__), 'corpus'),
+                        help="directory of the generated corpus")
+    parser.add_argument('--output', default="startup_results.json", help="results file")
+    parser.add_argument('--child', help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.child:
+        _child(args.child)
+        return 0
+
+    # Imported here, the cold start runs in this module and must not load them early
+    from benchmarks.corpus import CASES, ensure_corpus
+    from benchmarks.run import _git_revision
+
+    cases = [case for case in CASES if case.name == 'jpeg-small']
+    source_path = os.path.abspath(ensure_corpus(args.corpus, cases)['jpeg-small'])
+
+    runs = [run_once(source_path) for _ in range(args.repeat)]
+    summary = {metric: statistics.median(run[metric] for run in runs) for metric in METRICS}
+    summary['heavy_modules'] = runs[0]['heavy_modules']
+    results = {
+        'meta': {
+            'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'revision': _git_revision(),
+            'repeat': args.repeat,
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count()
+        },
+        'summary': summary,
+        'runs': runs
+    }
+
+    print(
+        f"import {summary['import_s']:.2f}s  warm-up {summary['warm_up_s']:.2f}s  "
+        f"first result {summary['first_result_s']:.2f}s  total {summary['total_s']:.2f}s"
+    )
+    if summary['heavy_modules']:
+        print(f"Imported by the bot process: {', '.join(summary['heavy_modules'])}")
+
+    with open(args.output, 'w', encoding='utf-8') as f:
+        json.dump(results, f, indent=2)
+    print(f"Results: {args.output}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -5,6 +5,106 @@ load_dotenv()
 
 BOT_TOKEN = os.getenv("BOT_TOKEN")  # The token must be in the .env file.
 
+# How updates are received: "polling" or "webhook"
+BOT_MODE = os.getenv("BOT_MODE", "polling")
+
+# Webhook settings, used when BOT_MODE is "webhook"
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", 8080))
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")  # Public HTTPS base URL, e.g. https://example.com
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")  # Checked against X-Telegram-Bot-Api-Secret-Token
+WEBHOOK_MAX_CONCURRENT_UPDATES = int(os.getenv("WEBHOOK_MAX_CONCURRENT_UPDATES", 40))
+
+# Logging: level, per-logger overrides like "utils.media_processor=WARNING",
+# "json" lines or "text" format, and the share of jobs whose INFO lines are kept
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_LEVELS = os.getenv("LOG_LEVELS", "")
+LOG_FORMAT = os.getenv("LOG_FORMAT", "json")
+LOG_SAMPLE_RATE = float(os.getenv("LOG_SAMPLE_RATE", 1.0))
+
+# Prometheus metrics endpoint. In webhook mode it is served by the webhook server.
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "true").lower() == "true"
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", 9091))
+METRICS_PATH = os.getenv("METRICS_PATH", "/metrics")
+# Readiness probe, served with the metrics and by the webhook server. It fails
+# until every media worker has loaded the media libraries.
+READINESS_PATH = os.getenv("READINESS_PATH", "/ready")
+
+# FSM storage for user sessions: "memory", "sqlite" or "redis"
+FSM_STORAGE = os.getenv("FSM_STORAGE", "memory")
+FSM_SQLITE_PATH = os.getenv("FSM_SQLITE_PATH", "fsm.sqlite3")
+FSM_REDIS_URL = os.getenv("FSM_REDIS_URL", "redis://localhost:6379/0")
+FSM_STATE_TTL = int(os.getenv("FSM_STATE_TTL", 7 * 24 * 3600))  # seconds, 0 keeps sessions forever
+
+# Media processing workers
+WORKER_PROCESSES = int(os.getenv("WORKER_PROCESSES", os.cpu_count() or 1))
+WORKER_QUEUE_SIZE = int(os.getenv("WORKER_QUEUE_SIZE", 32))  # Jobs waiting for a free worker
+WORKER_WARM_UP_TIMEOUT = float(os.getenv("WORKER_WARM_UP_TIMEOUT", 60))  # seconds to wait for workers at startup
+
+# Memory admission control. Before decoding a file, a worker predicts its
+# peak memory and reserves it from a budget shared by all workers, waiting
+# while it doesn't fit. Files over the pixel limits are rejected.
+MEMORY_BUDGET = int(os.getenv("MEMORY_BUDGET", 0))  # MB, 0 for 60% of the host or container memory
+MEMORY_BUDGET_WAIT = float(os.getenv("MEMORY_BUDGET_WAIT", 120))  # seconds a job waits for memory
+MEMORY_ESTIMATE_FACTOR = float(os.getenv("MEMORY_ESTIMATE_FACTOR", 1.0))  # Scales every memory prediction
+MAX_IMAGE_MEGAPIXELS = float(os.getenv("MAX_IMAGE_MEGAPIXELS", 100))  # Decoded size, after JPEG downscaling
+MAX_VIDEO_MEGAPIXELS = float(os.getenv("MAX_VIDEO_MEGAPIXELS", 9))  # Frame size of videos and GIFs
+
+# Where media jobs run: "inline" in the bot process, or "sqlite" (same machine)
+# or "redis" (several machines) to queue them for separate worker processes
+# started with `python worker.py`
+JOB_QUEUE_BACKEND = os.getenv("JOB_QUEUE_BACKEND", "inline")
+JOB_QUEUE_PATH = os.getenv("JOB_QUEUE_PATH", "jobs.sqlite3")
+JOB_QUEUE_REDIS_URL = os.getenv("JOB_QUEUE_REDIS_URL", "redis://localhost:6379/0")
+JOB_QUEUE_VISIBILITY_TIMEOUT = int(os.getenv("JOB_QUEUE_VISIBILITY_TIMEOUT", 300))  # seconds
+JOB_QUEUE_MAX_ATTEMPTS = int(os.getenv("JOB_QUEUE_MAX_ATTEMPTS", 3))
+JOB_QUEUE_POLL_INTERVAL = float(os.getenv("JOB_QUEUE_POLL_INTERVAL", 1))  # seconds
+JOB_QUEUE_CONCURRENCY = int(os.getenv("JOB_QUEUE_CONCURRENCY", WORKER_PROCESSES * 2))  # Jobs per worker process
+
+# Fair scheduling of jobs between users
+SCHEDULER_MAX_CONCURRENT = int(os.getenv("SCHEDULER_MAX_CONCURRENT", WORKER_PROCESSES * 2))
+SCHEDULER_MAX_JOBS_PER_CHAT = int(os.getenv("SCHEDULER_MAX_JOBS_PER_CHAT", 2))
+SCHEDULER_MAX_QUEUED = int(os.getenv("SCHEDULER_MAX_QUEUED", 1000))
+SCHEDULER_MAX_QUEUED_PER_CHAT = int(os.getenv("SCHEDULER_MAX_QUEUED_PER_CHAT", 100))
+SCHEDULER_STATUS_INTERVAL = float(os.getenv("SCHEDULER_STATUS_INTERVAL", 5))  # seconds
+
+# Album (media group) items arriving within this time of each other are processed as one batch
+ALBUM_COLLECT_WINDOW = float(os.getenv("ALBUM_COLLECT_WINDOW", 1.0))  # seconds
+
+# Pacing of messages sent to Telegram, below its flood limits. The global
+# rate applies per process, split it when running several queue workers.
+OUTBOUND_GLOBAL_RATE = float(os.getenv("OUTBOUND_GLOBAL_RATE", 30))  # messages per second
+OUTBOUND_CHAT_RATE = float(os.getenv("OUTBOUND_CHAT_RATE", 1))  # messages per second to one private chat
+OUTBOUND_GROUP_RATE = float(os.getenv("OUTBOUND_GROUP_RATE", 20 / 60))  # messages per second to one group
+OUTBOUND_CHAT_BURST = int(os.getenv("OUTBOUND_CHAT_BURST", 3))  # messages sent to a chat at once
+OUTBOUND_MAX_RETRIES = int(os.getenv("OUTBOUND_MAX_RETRIES", 5))  # retries after a flood error
+
+# Largest file the Bot API lets bots download
+TELEGRAM_DOWNLOAD_LIMIT = 20 * 1024 * 1024  # bytes
+
+# Largest file bots can upload
+TELEGRAM_UPLOAD_LIMIT = 50 * 1024 * 1024  # bytes
+
+# Limits for ZIP archives, checked before anything is extracted
+ARCHIVE_MAX_FILES = int(os.getenv("ARCHIVE_MAX_FILES", 200))
+ARCHIVE_MAX_SIZE = int(os.getenv("ARCHIVE_MAX_SIZE", 200))  # MB, total uncompressed size
+
+# Chunk size for streaming downloads and uploads
+TRANSFER_CHUNK_SIZE = int(os.getenv("TRANSFER_CHUNK_SIZE", 64 * 1024))  # bytes
+
+# Per-job scratch directories for downloads and intermediate files.
+# Point SCRATCH_DIR at a tmpfs like /dev/shm/sticker-bot to keep them in RAM.
+SCRATCH_DIR = os.getenv("SCRATCH_DIR", "scratch")
+SCRATCH_QUOTA = int(os.getenv("SCRATCH_QUOTA", 2048))  # MB, 0 for no limit
+SCRATCH_ORPHAN_AGE = int(os.getenv("SCRATCH_ORPHAN_AGE", 3600))  # seconds before a directory counts as orphaned
+SCRATCH_JANITOR_INTERVAL = int(os.getenv("SCRATCH_JANITOR_INTERVAL", 300))  # seconds
+
+# Cache of processed files
+CACHE_DIR = os.getenv("CACHE_DIR", "cache")
+CACHE_MAX_SIZE = int(os.getenv("CACHE_MAX_SIZE", 512))  # MB
+
 # Telegram static sticker requirements
 STATIC_STICKER_MAX_SIZE = 512  # KB
 STATIC_STICKER_WIDTH = 512
@@ -33,6 +133,43 @@ ANIMATED_EMOJI_FORMAT = 'WEBM'  # Telegram requires WEBM for animated emojis
 ANIMATED_EMOJI_FPS = 30
 ANIMATED_EMOJI_MAX_DURATION = 3  # seconds
 
+# Static images over the size limit are encoded in parallel candidates
+STATIC_ENCODER_THREADS = int(os.getenv("STATIC_ENCODER_THREADS", 3))
+STATIC_MIN_COLORS = int(os.getenv("STATIC_MIN_COLORS", 32))  # Fewest palette colors allowed
+
+# Large static images are decoded at a reduced scale (JPEG) or pre-shrunk with a
+# fast box filter, down to this multiple of the target size, before the final Lanczos resize
+STATIC_REDUCING_GAP = float(os.getenv("STATIC_REDUCING_GAP", 2.0))
+
+# Frame buffers of animated files larger than this are memory-mapped to disk.
+# A 3 second 512x512 sticker at 30 fps needs 71 MB, or 95 MB with transparency.
+FRAME_BUFFER_MEMMAP_THRESHOLD = int(os.getenv("FRAME_BUFFER_MEMMAP_THRESHOLD", 128))  # MB
+
+# GIF frame delays below the minimum are played at the default speed, like browsers do
+GIF_MIN_FRAME_DURATION = 20  # ms
+GIF_DEFAULT_FRAME_DURATION = 100  # ms
+
+# Video encoder for animated files: "ffmpeg" (needs the ffmpeg binary), "pyav"
+# (needs the av package) or "opencv". Only ffmpeg and pyav control the bitrate,
+# tune libvpx and keep the transparency of GIFs. Falls back to opencv if unavailable.
+VIDEO_ENCODER = os.getenv("VIDEO_ENCODER", "ffmpeg")
+FFMPEG_PATH = os.getenv("FFMPEG_PATH", "ffmpeg")
+
+# libvpx-vp9 speed/quality presets for the ffmpeg and pyav encoders
+VP9_PRESETS = {
+    'fast': {'deadline': 'realtime', 'cpu_used': 8, 'crf': 36},
+    'balanced': {'deadline': 'good', 'cpu_used': 4, 'crf': 33},
+    'quality': {'deadline': 'good', 'cpu_used': 1, 'crf': 30},
+}
+VP9_PRESET = os.getenv("VP9_PRESET", "balanced")
+# Every media worker encodes one file, so more threads mostly help with few workers
+VP9_THREADS = int(os.getenv("VP9_THREADS", 1))
+VP9_TILE_COLUMNS = int(os.getenv("VP9_TILE_COLUMNS", 1))  # log2, 512px frames fit 2 tiles
+
+# Encode attempts for animated files to fit the size limit
+RATE_CONTROL_MAX_ATTEMPTS = int(os.getenv("RATE_CONTROL_MAX_ATTEMPTS", 4))
+RATE_CONTROL_MARGIN = 0.92  # Aim slightly below the limit
+
 # Supported formats
 STATIC_IMAGE_FORMATS = ['.jpg', '.jpeg', '.png', '.webp', '.bmp']
 ANIMATED_IMAGE_FORMATS = ['.gif', '.mp4', '.webm', '.avi']
@@ -40,4 +177,5 @@ ANIMATED_IMAGE_FORMATS = ['.gif', '.mp4', '.webm', '.avi']
 
 # Supported formats
 SUPPORTED_IMAGE_FORMATS = ['.jpg', '.jpeg', '.png', '.webp']
-SUPPORTED_VIDEO_FORMATS = ['.mp4', '.webm'] 
\ No newline at end of file
+SUPPORTED_VIDEO_FORMATS = ['.mp4', '.webm']
+ARCHIVE_FORMATS = ['.zip'] 
\ No newline at end of file
@@ -1,26 +1,65 @@
 import asyncio
-import os
 import signal
 import sys
 import logging
 from aiogram import Bot, Dispatcher, types
+from aiogram.exceptions import TelegramBadRequest
 from aiogram.filters import Command
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
-from aiogram.fsm.storage.memory import MemoryStorage
 from contextlib import suppress
 
-from config import BOT_TOKEN, SUPPORTED_IMAGE_FORMATS, SUPPORTED_VIDEO_FORMATS
+from config import (
+    BOT_TOKEN,
+    SUPPORTED_IMAGE_FORMATS,
+    SUPPORTED_VIDEO_FORMATS,
+    WORKER_PROCESSES,
+    WORKER_QUEUE_SIZE,
+    SCHEDULER_MAX_CONCURRENT,
+    SCHEDULER_MAX_JOBS_PER_CHAT,
+    SCHEDULER_MAX_QUEUED,
+    SCHEDULER_MAX_QUEUED_PER_CHAT,
+    SCHEDULER_STATUS_INTERVAL,
+    CACHE_DIR,
+    CACHE_MAX_SIZE,
+    SCRATCH_DIR,
+    SCRATCH_QUOTA,
+    SCRATCH_ORPHAN_AGE,
+    SCRATCH_JANITOR_INTERVAL,
+    BOT_MODE,
+    ALBUM_COLLECT_WINDOW,
+    METRICS_ENABLED,
+    METRICS_HOST,
+    METRICS_PORT,
+    METRICS_PATH,
+    READINESS_PATH,
+    WORKER_WARM_UP_TIMEOUT,
+    MEMORY_BUDGET,
+    OUTBOUND_GLOBAL_RATE,
+    OUTBOUND_CHAT_RATE,
+    OUTBOUND_GROUP_RATE,
+    OUTBOUND_CHAT_BURST,
+    OUTBOUND_MAX_RETRIES
+)
 from keyboards import get_start_keyboard, get_processing_keyboard
-from utils.media_processor import MediaProcessor
-from utils.logger import setup_logger
+from utils.worker_pool import MediaWorkerPool, WorkerPoolBusy
+from utils.admission import MediaProcessingError, MediaTooLarge, memory_budget_bytes
+from utils.scheduler import FairScheduler, SchedulerBusy, ChatQueueFull
+from utils.result_cache import ResultCache
+from utils.job_planner import JobPlan, plan_job
+from utils.job_queue import create_job_queue
+from utils.jobs import MediaJobRunner
+from utils.album import AlbumCollector
+from utils.metrics import Gauge, TEMP_DISK_BYTES, count_job, set_ready, start_metrics_server
+from utils.outbound import OutboundScheduler
+from utils.scratch import ScratchSpace, ScratchQuotaExceeded
+from utils.webhook import run_webhook
+from utils.fsm_storage import create_storage
+from utils.logger import job_id_var, set_job_id, setup_logger
 
 # Initialize the logger
 logger = setup_logger()
 
-# Global variables for storing temporary files
-TEMP_FILES = set()
-
 class UserState(StatesGroup):
     choosing_type = State()
     processing_sticker = State()
@@ -28,25 +67,57 @@ class UserState(StatesGroup):
 
 # Initialize bot and dispatcher
 bot = Bot(token=BOT_TOKEN)
-storage = MemoryStorage()
+# Every message sent to Telegram is paced below its flood limits
+bot.session.middleware(OutboundScheduler(
+    OUTBOUND_GLOBAL_RATE, OUTBOUND_CHAT_RATE, OUTBOUND_CHAT_BURST, OUTBOUND_GROUP_RATE, OUTBOUND_MAX_RETRIES
+))
+storage = create_storage()
 dp = Dispatcher(storage=storage)
 
-def cleanup_temp_files():
-    """Cleaning temporary files"""
-    for file_path in TEMP_FILES:
-        try:
-            if os.path.exists(file_path):
-                os.remove(file_path)
-        except Exception as e:
-            logger.error(f"Error removing temp file {file_path}: {e}")
-    TEMP_FILES.clear()
+# Media processing runs in worker processes to keep the event loop responsive
+worker_pool = MediaWorkerPool(WORKER_PROCESSES, WORKER_QUEUE_SIZE, memory_budget_bytes(MEMORY_BUDGET))
+
+# Jobs from different users are interleaved fairly before reaching the workers
+scheduler = FairScheduler(
+    max_concurrent=SCHEDULER_MAX_CONCURRENT,
+    max_per_chat=SCHEDULER_MAX_JOBS_PER_CHAT,
+    max_queued=SCHEDULER_MAX_QUEUED,
+    max_queued_per_chat=SCHEDULER_MAX_QUEUED_PER_CHAT,
+    update_interval=SCHEDULER_STATUS_INTERVAL
+)
+# One queue status message per chat, edited as its files move up
+status_messages: dict[int, types.Message] = {}
+
+# Processed files are reused when the same source file is sent again
+result_cache = ResultCache(CACHE_DIR, CACHE_MAX_SIZE * 1024 * 1024)
+
+# Downloads and intermediate files of every job live in a directory of their own
+scratch = ScratchSpace(SCRATCH_DIR, SCRATCH_QUOTA * 1024 * 1024, SCRATCH_ORPHAN_AGE)
+
+job_runner = MediaJobRunner(bot, worker_pool, result_cache, scratch)
+
+# Media jobs run in this process unless a durable queue hands them to worker.py
+job_queue = create_job_queue()
+
+Gauge("sticker_scheduler_queued", "Jobs waiting in the scheduler", function=lambda: scheduler.queued)
+Gauge("sticker_scheduler_active", "Jobs started by the scheduler and not finished", function=lambda: scheduler.active)
+Gauge("sticker_cache_bytes", "Size of the processed files cache", function=lambda: result_cache.stats()['size'])
+TEMP_DISK_BYTES.function = scratch.usage
+
+BUSY_MESSAGE = "The bot is busy right now, please try again in a minute."
 
 async def shutdown(dispatcher: Dispatcher):
     """Correct termination of the bot"""
     logger.info("Bot shutdown...")
-    
-    # Clearing temporary files
-    cleanup_temp_files()
+
+    # Stop media workers
+    album_collector.close()
+    scheduler.close()
+    worker_pool.shutdown()
+    logger.info(f"Result cache stats: {result_cache.stats()}")
+    result_cache.close()
+    if job_queue:
+        await job_queue.close()
     
     # Close connections and clear storage
     await dispatcher.storage.close()
@@ -90,97 +161,179 @@ async def back_to_start(message: types.Message, state: FSMContext):
     """Handle returning to start"""
     await cmd_start(message, state)
 
-async def process_media(message: types.Message, is_sticker: bool):
+async def process_media(message: types.Message, plan: JobPlan, is_sticker: bool, job_id: str,
+                        concurrency: int):
     """Process media file and send result back to user"""
-    temp_path = None
-    result_path = None
-    
     try:
-        # Download file
-        logger.info("=== Starting new file processing ===")
-        if message.document:
-            logger.info("Processing document")
-            file_id = message.document.file_id
-            file_name = message.document.file_name
-            logger.info(f"Document name: {file_name}")
-        elif message.photo:
-            logger.info("Processing photo")
-            file_id = message.photo[-1].file_id
-            file_name = f"photo_{file_id}.jpg"
-        elif message.video:
-            logger.info("Processing video")
-            file_id = message.video.file_id
-            file_name = f"video_{file_id}.mp4"
-        else:
-            logger.warning("No media found in message")
-            await message.answer("Please send an image or video file.")
-            return
-
-        logger.info(f"Getting file info for file_id: {file_id}")
-        file = await bot.get_file(file_id)
-        file_path = file.file_path
-        logger.info(f"File path from Telegram: {file_path}")
-        downloaded_file = await bot.download_file(file_path)
-
-        # Save file temporarily
-        temp_path = f"temp_{file_name}"
-        logger.info(f"Saving to temp path: {temp_path}")
-        
-        with open(temp_path, "wb") as f:
-            f.write(downloaded_file.read())
-        
-        logger.info(f"Temp file saved, size: {os.path.getsize(temp_path)} bytes")
-        logger.info(f"Temp file exists: {os.path.exists(temp_path)}")
-
-        # Process file
-        logger.info("=== Starting MediaProcessor ===")
-        processor = MediaProcessor(temp_path, is_sticker)
-        logger.info("Created MediaProcessor instance")
-        result_path, was_modified = processor.process()
-        logger.info(f"Processing completed. Result path: {result_path}")
-        logger.info(f"Result file exists: {os.path.exists(result_path)}")
-        if os.path.exists(result_path):
-            logger.info(f"Result file size: {os.path.getsize(result_path)} bytes")
-
-        if not os.path.exists(result_path):
-            logger.error("Error: Result file does not exist!")
-            await message.answer("Error: Failed to process file")
-            return
+        await job_runner.run(message.chat.id, plan, is_sticker, job_id, concurrency)
+    except WorkerPoolBusy:
+        logger.warning("Worker queue is full, rejecting file")
+        await message.answer(BUSY_MESSAGE)
+    except ScratchQuotaExceeded as e:
+        logger.warning(f"{e}, rejecting file")
+        await message.answer(BUSY_MESSAGE)
+    except MediaTooLarge as e:
+        logger.info(f"Rejected file after download: {e}")
+        await message.answer(str(e))
+    except MediaProcessingError as e:
+        logger.warning(f"Could not convert file: {e}")
+        await message.answer(f"Error processing your file: {str(e)}")
+    except Exception as e:
+        logger.error("=== Error ===")
+        logger.error(f"Error type: {type(e)}")
+        logger.error(f"Error message: {str(e)}")
+        import traceback
+        logger.error(f"Traceback:\n{traceback.format_exc()}")
+        await message.answer(f"Error processing your file: {str(e)}")
 
-        # Send result
-        logger.info("=== Sending file ===")
-        with open(result_path, "rb") as f:
-            file_data = f.read()
-            logger.info(f"Read file data, size: {len(file_data)} bytes")
-            await message.answer_document(
-                types.BufferedInputFile(
-                    file_data,
-                    filename=os.path.basename(result_path)
-                ),
-                caption="Here's your processed file!" + 
-                       (" (No modifications needed)" if not was_modified else "")
+async def process_album_media(message: types.Message, plans: list[JobPlan], is_sticker: bool, job_id: str,
+                              concurrency: int):
+    """Process album files together and send the results back as one group"""
+    try:
+        failed = await job_runner.run_album(message.chat.id, plans, is_sticker, job_id, concurrency)
+        if failed:
+            await message.answer(
+                "Some files could not be processed:\n" +
+                "\n".join(f"{file_name}: {error}" for file_name, error in failed)
             )
-            logger.info("File sent successfully")
-
-        # Cleanup
-        logger.info("=== Cleanup ===")
-        if temp_path and os.path.exists(temp_path):
-            logger.info(f"Removing temp file: {temp_path}")
-            os.remove(temp_path)
-            logger.info(f"Temp file removed: {not os.path.exists(temp_path)}")
-        
-        if result_path and result_path != temp_path and os.path.exists(result_path):
-            logger.info(f"Removing result file: {result_path}")
-            os.remove(result_path)
-            logger.info(f"Result file removed: {not os.path.exists(result_path)}")
-
+    except WorkerPoolBusy:
+        logger.warning("Worker queue is full, rejecting album")
+        await message.answer(BUSY_MESSAGE)
+    except ScratchQuotaExceeded as e:
+        logger.warning(f"{e}, rejecting album")
+        await message.answer(BUSY_MESSAGE)
     except Exception as e:
         logger.error("=== Error ===")
         logger.error(f"Error type: {type(e)}")
         logger.error(f"Error message: {str(e)}")
         import traceback
         logger.error(f"Traceback:\n{traceback.format_exc()}")
-        await message.answer(f"Error processing your file: {str(e)}")
+        await message.answer(f"Error processing your files: {str(e)}")
+
+async def report_queue_status(chat_id: int, files: int, position: int):
+    """Show how many files of a chat wait and where the next one is in the queue"""
+    if files == 0:
+        # Everything started, the queue status is no longer needed
+        status_message = status_messages.pop(chat_id, None)
+        if status_message:
+            with suppress(TelegramBadRequest):
+                await status_message.delete()
+        return
+
+    text = f"Your file is in the queue, position: {position}"
+    if files > 1:
+        text = f"{files} files are in the queue, next at position: {position}"
+    status_message = status_messages.get(chat_id)
+    if status_message:
+        with suppress(TelegramBadRequest):
+            await status_message.edit_text(text)
+    else:
+        status_messages[chat_id] = await bot.send_message(chat_id, text)
+
+scheduler.on_status = report_queue_status
+
+async def submit_media(message: types.Message, plans: list[JobPlan], is_sticker: bool):
+    """Queue planned media files as one job, the chat's queue status is reported by the scheduler"""
+    # The job keeps the correlation ID of the update that planned it
+    job_id = job_id_var.get()
+
+    # With a job queue, separate worker processes pick the job up
+    if job_queue:
+        payload = {'chat_id': message.chat.id, 'is_sticker': is_sticker, 'job_id': job_id}
+        if len(plans) == 1:
+            payload['plan'] = plans[0]._asdict()
+        else:
+            payload['plans'] = [plan._asdict() for plan in plans]
+        job_id = await job_queue.enqueue(message.chat.id, payload)
+        logger.info(f"Enqueued job {job_id}")
+        return
+
+    # Albums and archives take a slot for every file they run at once,
+    # the number of files in an archive is only known after downloading it
+    slots = scheduler.job_slots(scheduler.max_per_chat if plans[0].is_archive else len(plans))
+    if len(plans) == 1:
+        run = lambda: process_media(message, plans[0], is_sticker, job_id, slots)
+    else:
+        run = lambda: process_album_media(message, plans, is_sticker, job_id, slots)
+
+    try:
+        scheduler.submit(
+            message.chat.id,
+            run,
+            cost=sum(plan.cost for plan in plans),
+            slots=slots,
+            files=len(plans)
+        )
+    except ChatQueueFull:
+        logger.warning(f"Too many queued files from chat {message.chat.id}")
+        await message.answer("You have too many files in the queue, please wait until some of them are done.")
+    except SchedulerBusy:
+        logger.warning("Scheduler queue is full, rejecting file")
+        await message.answer(BUSY_MESSAGE)
+
+async def schedule_media(message: types.Message, is_sticker: bool):
+    """Plan media file processing and queue it"""
+    set_job_id()
+    plan = plan_job(message, is_sticker)
+    if plan is None:
+        logger.warning("No media found in message")
+        await message.answer("Please send an image or video file.")
+        return
+
+    if plan.reject_reason:
+        logger.info(f"Rejected file before download: {plan.reject_reason}")
+        count_job(is_sticker, plan, "rejected")
+        await message.answer(plan.reject_reason)
+        return
+
+    # Answer from the cache if this file was already processed, archives are not cached
+    if not plan.is_archive:
+        cache_key = result_cache.make_key(plan.file_unique_id, is_sticker)
+        cached = result_cache.get(cache_key)
+        if cached:
+            logger.info(f"Cache hit for {plan.file_unique_id}")
+            await job_runner.send_cached(message.chat.id, plan.file_name, cache_key, cached)
+            count_job(is_sticker, plan, "cached")
+            return
+
+    await submit_media(message, [plan], is_sticker)
+
+async def schedule_album(messages: list[types.Message], is_sticker: bool):
+    """Plan the files of an album and queue them as one job"""
+    set_job_id()
+    plans = []
+    archives = []
+    skipped = []
+    for message in messages:
+        plan = plan_job(message, is_sticker)
+        if plan is None:
+            continue
+        if plan.reject_reason:
+            logger.info(f"Rejected album file before download: {plan.reject_reason}")
+            count_job(is_sticker, plan, "rejected")
+            skipped.append(f"{plan.file_name}: {plan.reject_reason}")
+        elif plan.is_archive:
+            archives.append(plan)
+        else:
+            plans.append(plan)
+
+    message = messages[0]
+    if skipped:
+        await message.answer("Some files were skipped:\n" + "\n".join(skipped))
+    elif not plans and not archives:
+        await message.answer("Please send an image or video file.")
+
+    # Archives already come back as one file each
+    for plan in archives:
+        await submit_media(message, [plan], is_sticker)
+    if not plans:
+        return
+
+    # Cached files are sent along with the processed ones
+    await submit_media(message, plans, is_sticker)
+
+# Album items arrive as separate messages and are batched by media_group_id
+album_collector = AlbumCollector(ALBUM_COLLECT_WINDOW, schedule_album)
 
 @dp.message(UserState.processing_sticker)
 async def process_sticker_file(message: types.Message):
@@ -188,23 +341,35 @@ async def process_sticker_file(message: types.Message):
     if message.text == "Back to Start":
         return
     
-    logger.info("Message content type: %s", message.content_type)
-    logger.info("Message has photo: %s", bool(message.photo))
-    logger.info("Message has document: %s", bool(message.document))
-    logger.info("Message has video: %s", bool(message.video))
+    # Logged before schedule_media() sets the job ID, so log sampling would keep them all
+    logger.debug("Message content type: %s", message.content_type)
+    logger.debug("Message has photo: %s", bool(message.photo))
+    logger.debug("Message has document: %s", bool(message.document))
+    logger.debug("Message has video: %s", bool(message.video))
     
     if message.document:
-        logger.info("Document mime_type: %s", message.document.mime_type)
-        logger.info("Document file_name: %s", message.document.file_name)
+        logger.debug("Document mime_type: %s", message.document.mime_type)
+        logger.debug("Document file_name: %s", message.document.file_name)
     
-    await process_media(message, is_sticker=True)
+    if message.media_group_id:
+        album_collector.add(message, is_sticker=True)
+        return
+    await schedule_media(message, is_sticker=True)
 
 @dp.message(UserState.processing_emoji)
 async def process_emoji_file(message: types.Message):
     """Handle file for emoji creation"""
     if message.text == "Back to Start":
         return
-    await process_media(message, is_sticker=False)
+    if message.media_group_id:
+        album_collector.add(message, is_sticker=False)
+        return
+    await schedule_media(message, is_sticker=False)
+
+async def ready_after_warm_up():
+    """Keep warming the media workers up and report ready once they all are"""
+    await worker_pool.warm_up_until_ready(WORKER_WARM_UP_TIMEOUT)
+    set_ready()
 
 async def main():
     """Start the bot"""
@@ -218,10 +383,35 @@ async def main():
     # Register the signal handler
     signal.signal(signal.SIGINT, signal_handler)
     
+    # In webhook mode metrics are served by the webhook server itself
+    metrics_runner = None
+    if METRICS_ENABLED and BOT_MODE != "webhook":
+        metrics_runner = await start_metrics_server(METRICS_HOST, METRICS_PORT, METRICS_PATH, READINESS_PATH)
+
+    # Removes directories left behind by crashed runs, starting with the previous one
+    janitor = asyncio.create_task(scratch.run_janitor(SCRATCH_JANITOR_INTERVAL))
+
+    # Updates are taken once every media worker has loaded the media libraries.
+    # With a job queue, media is processed by worker.py instead.
+    warm_up = None
+    if job_queue is None and not await worker_pool.warm_up(WORKER_WARM_UP_TIMEOUT):
+        # Updates are taken anyway, the readiness probe fails until all workers are warm
+        warm_up = asyncio.create_task(ready_after_warm_up())
+    else:
+        set_ready()
+
     try:
-        logger.info("The bot is running. To stop, press Ctrl+C")
-        await dp.start_polling(bot)
+        logger.info(f"The bot is running in {BOT_MODE} mode. To stop, press Ctrl+C")
+        if BOT_MODE == "webhook":
+            await run_webhook(dp, bot)
+        else:
+            await dp.start_polling(bot)
     finally:
+        janitor.cancel()
+        if warm_up:
+            warm_up.cancel()
+        if metrics_runner:
+            await metrics_runner.cleanup()
         await shutdown(dp)
 
 if __name__ == "__main__":
@@ -0,0 +1,267 @@
+import math
+import multiprocessing
+import os
+import time
+from typing import NamedTuple, Optional
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+from config import (
+    MAX_IMAGE_MEGAPIXELS,
+    MAX_VIDEO_MEGAPIXELS,
+    MEMORY_ESTIMATE_FACTOR,
+    STATIC_REDUCING_GAP
+)
+from utils.targets import get_target_params
+
+MB = 1024 * 1024
+
+# The cost model below was fitted to peak RSS and CPU time measured with
+# benchmarks.run, compare it with sticker_memory_prediction_ratio in production.
+
+# Pillow keeps 1, L and P images with a byte per pixel, I;16 with two and
+# every other mode with four
+MODE_BYTES = {'1': 1, 'L': 1, 'P': 1, 'I;16': 2}
+DEFAULT_MODE_BYTES = 4
+# Resizing LA and RGBA images premultiplies a full-size copy first
+ALPHA_MODES = ('LA', 'RGBA')
+ALPHA_FACTOR = 2.0
+# WebP is decoded into a separate buffer and copied
+WEBP_FACTOR = 4.0
+# Resized image and the palette candidates of the PNG encoder
+STATIC_BASE_BYTES = 16 * MB
+
+# OpenCV keeps a few decoded source frames, and one more per decoder thread
+VIDEO_BYTES_PER_PIXEL = 20
+VIDEO_THREAD_BYTES_PER_PIXEL = 1.5
+VIDEO_DECODER_THREADS = min(os.cpu_count() or 1, 16)
+# GIF frames are converted and resized at full canvas size
+GIF_BYTES_PER_PIXEL = 14
+ANIMATED_BASE_BYTES = 16 * MB
+# libvpx buffers about 25 frames ahead, alpha is encoded as a second stream
+ENCODER_BASE_BYTES = 32 * MB
+ENCODER_BYTES_PER_PIXEL = 240
+ENCODER_ALPHA_FACTOR = 1.75
+
+# CPU seconds: static images per decoded pixel, videos and GIFs per decoded
+# source pixel of every frame and the encoder per output pixel
+STATIC_BASE_CPU = 0.5
+STATIC_CPU_PER_PIXEL = 20e-9
+VIDEO_CPU_PER_PIXEL = 5e-9
+GIF_CPU_PER_PIXEL = 25e-9
+ENCODE_CPU_PER_PIXEL = 200e-9
+
+# Share of the host or container memory used when MEMORY_BUDGET is not set
+DEFAULT_BUDGET_SHARE = 0.6
+FALLBACK_BUDGET = 2048 * MB
+
+
+class MediaTooLarge(Exception):
+    """Raised for files that need more pixels or memory than the limits allow"""
+
+
+class MediaProcessingError(Exception):
+    """Raised by MediaProcessor when a file needed converting but couldn't be converted"""
+
+
+class MediaProbe(NamedTuple):
+    kind: str  # "static", "video" or "gif"
+    format: str  # Pillow format of images, the extension of videos
+    mode: str  # Pillow mode of images, empty for videos
+    width: int
+    height: int
+    frames: int  # Source frames of videos, 0 when unknown
+    fps: float  # Source frame rate of videos, 0 when unknown
+    alpha: bool  # The result keeps an alpha channel
+
+
+class CostEstimate(NamedTuple):
+    memory_bytes: int  # Peak memory of the worker process while processing
+    encoder_bytes: int  # Peak memory of the encoder subprocess, if there is one
+    cpu_seconds: float
+
+    @property
+    def total_bytes(self) -> int:
+        return self.memory_bytes + self.encoder_bytes
+
+
+def decoded_size(probe: MediaProbe, is_sticker: bool) -> tuple[int, int]:
+    """Size a static image is decoded at, JPEGs are scaled down while decoding"""
+    width, height = probe.width, probe.height
+    reduced_side = get_target_params(is_sticker, False)['width'] * STATIC_REDUCING_GAP
+    if probe.format != 'JPEG' or max(width, height) <= reduced_side:
+        return width, height
+    # The scale Pillow's draft() picks for the size MediaProcessor requests
+    ratio = reduced_side / max(width, height)
+    requested = (math.ceil(width * ratio), math.ceil(height * ratio))
+    fits = min(width // requested[0], height // requested[1])
+    scale = next(scale for scale in (8, 4, 2, 1) if fits >= scale)
+    return math.ceil(width / scale), math.ceil(height / scale)
+
+
+def estimate_cost(probe: MediaProbe, is_sticker: bool, encoder_in_process: bool) -> CostEstimate:
+    """Predict the peak memory and CPU time of processing a probed file"""
+    if probe.kind == 'static':
+        width, height = decoded_size(probe, is_sticker)
+        pixels = width * height
+        memory = pixels * MODE_BYTES.get(probe.mode, DEFAULT_MODE_BYTES)
+        if probe.mode in ALPHA_MODES:
+            memory *= ALPHA_FACTOR
+        if probe.format == 'WEBP':
+            memory *= WEBP_FACTOR
+        cpu = STATIC_BASE_CPU + pixels * STATIC_CPU_PER_PIXEL * (ALPHA_FACTOR if probe.mode in ALPHA_MODES else 1)
+        return CostEstimate(int((STATIC_BASE_BYTES + memory) * MEMORY_ESTIMATE_FACTOR), 0, cpu)
+
+    params = get_target_params(is_sticker, True)
+    pixels = probe.width * probe.height
+    ratio = min(params['width'] / max(probe.width, 1), params['height'] / max(probe.height, 1))
+    output_pixels = int(probe.width * ratio) * int(probe.height * ratio)
+    max_frames = int(params['fps'] * params['max_duration'])
+    channels = 4 if probe.alpha else 3
+
+    if probe.kind == 'video':
+        source_fps = probe.fps if 0 < probe.fps < 1000 else params['fps']
+        # Every source frame up to the last one used is decoded
+        decoded_frames = math.ceil(source_fps * params['max_duration'])
+        if probe.frames > 0:
+            decoded_frames = min(decoded_frames, probe.frames)
+        stored_frames = min(decoded_frames, max_frames)
+        memory = pixels * (VIDEO_BYTES_PER_PIXEL + VIDEO_THREAD_BYTES_PER_PIXEL * VIDEO_DECODER_THREADS)
+        cpu = decoded_frames * pixels * VIDEO_CPU_PER_PIXEL
+    else:
+        # The number of GIF frames is only known after decoding all of them
+        stored_frames = decoded_frames = max_frames
+        memory = pixels * GIF_BYTES_PER_PIXEL
+        cpu = decoded_frames * pixels * GIF_CPU_PER_PIXEL
+
+    memory += ANIMATED_BASE_BYTES + stored_frames * output_pixels * channels
+    encoder = ENCODER_BASE_BYTES + output_pixels * ENCODER_BYTES_PER_PIXEL * (
+        ENCODER_ALPHA_FACTOR if probe.alpha else 1
+    )
+    cpu += max_frames * output_pixels * ENCODE_CPU_PER_PIXEL
+    if encoder_in_process:
+        memory, encoder = memory + encoder, 0
+    return CostEstimate(
+        int(memory * MEMORY_ESTIMATE_FACTOR), int(encoder * MEMORY_ESTIMATE_FACTOR), cpu
+    )
+
+
+def pixel_limit_reason(is_animated: bool, width: int, height: int) -> Optional[str]:
+    """Why a file with these decoded dimensions is rejected, None if it is within the limits"""
+    limit = MAX_VIDEO_MEGAPIXELS if is_animated else MAX_IMAGE_MEGAPIXELS
+    if width * height <= limit * 1e6:
+        return None
+    media = "Video frames are" if is_animated else "Image is"
+    return f"{media} too large to process ({width}x{height}), up to {limit:g} megapixels are supported"
+
+
+def memory_limit() -> Optional[int]:
+    """Memory of the container, or of the host when not limited, None if unknown"""
+    limits = []
+    for path in ('/sys/fs/cgroup/memory.max', '/sys/fs/cgroup/memory/memory.limit_in_bytes'):
+        try:
+            with open(path) as f:
+                value = f.read().strip()
+        except OSError:
+            continue
+        if value.isdigit():
+            limits.append(int(value))
+    try:
+        limits.append(os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES'))
+    except (AttributeError, ValueError, OSError):
+        pass
+    # An unlimited cgroup reports a huge number, the host memory is lower
+    return min(limits) if limits else None
+
+
+def memory_budget_bytes(megabytes: int) -> int:
+    """The configured budget in bytes, or a share of the memory limit for 0"""
+    if megabytes:
+        return megabytes * MB
+    limit = memory_limit()
+    return int(limit * DEFAULT_BUDGET_SHARE) if limit else FALLBACK_BUDGET
+
+
+class MemoryBudget:
+    """Memory shared by the jobs of all worker processes of a pool
+
+    Created with the pool and inherited by its workers, which reserve the
+    predicted peak memory of a job before decoding it and wait while it
+    doesn't fit next to the jobs already running.
+    """
+
+    def __init__(self, total_bytes: int):
+        self.total_bytes = total_bytes
+        self._reserved = multiprocessing.Value('q', 0, lock=False)
+        self._condition = multiprocessing.Condition()
+
+    @property
+    def reserved(self) -> int:
+        """Bytes reserved by the running jobs"""
+        return self._reserved.value
+
+    def reserve(self, nbytes: int, timeout: float) -> bool:
+        """Wait until nbytes fit the budget and reserve them
+
+        Returns False if they didn't fit within timeout seconds. Raises
+        MediaTooLarge if they would never fit.
+        """
+        if nbytes > self.total_bytes:
+            raise MediaTooLarge(
+                f"File needs about {nbytes // MB} MB of memory to process, "
+                f"more than the {self.total_bytes // MB} MB available"
+            )
+        deadline = time.monotonic() + timeout
+        with self._condition:
+            while self._reserved.value + nbytes > self.total_bytes:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self._condition.wait(remaining)
+            self._reserved.value += nbytes
+        return True
+
+    def release(self, nbytes: int):
+        """Free a reservation, waiting jobs may fit now"""
+        with self._condition:
+            self._reserved.value -= nbytes
+            self._condition.notify_all()
+
+
+def _read_status(field: str) -> Optional[int]:
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith(f"{field}:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+def reset_peak_rss() -> Optional[int]:
+    """Start measuring the peak RSS anew, returns the current RSS or None where unsupported"""
+    try:
+        # Writing 5 resets VmHWM to the current RSS (Linux only)
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        return None
+    return _read_status('VmRSS')
+
+
+def peak_rss() -> Optional[int]:
+    """Peak RSS since the last reset_peak_rss(), None where unsupported"""
+    return _read_status('VmHWM')
+
+
+def cpu_time() -> float:
+    """CPU seconds used by this process and the subprocesses it waited for"""
+    seconds = time.process_time()
+    if resource is not None:
+        children = resource.getrusage(resource.RUSAGE_CHILDREN)
+        seconds += children.ru_utime + children.ru_stime
+    return seconds
@@ -0,0 +1,79 @@
+import asyncio
+import logging
+from typing import Awaitable, Callable
+
+from aiogram import types
+
+logger = logging.getLogger(__name__)
+
+AlbumCallback = Callable[[list[types.Message], bool], Awaitable[None]]
+
+# Telegram albums hold at most this many items
+MAX_ALBUM_SIZE = 10
+
+
+class _Album:
+    __slots__ = ('messages', 'is_sticker', 'timer')
+
+    def __init__(self, is_sticker: bool):
+        self.messages: list[types.Message] = []
+        self.is_sticker = is_sticker
+        self.timer = None
+
+
+class AlbumCollector:
+    """Collect the messages of an album (media group) into one batch
+
+    Telegram delivers every album item as a separate message. Items with
+    the same media_group_id are buffered until no new item arrived for
+    `window` seconds, then handed to the callback together.
+    """
+
+    def __init__(self, window: float, on_album: AlbumCallback):
+        self.window = window
+        self.on_album = on_album
+        self._albums: dict[tuple[int, str], _Album] = {}
+        self._tasks = set()
+
+    def add(self, message: types.Message, is_sticker: bool):
+        """Add an album message, the batch is flushed once the album is complete"""
+        key = (message.chat.id, message.media_group_id)
+        album = self._albums.get(key)
+        if album is None:
+            album = self._albums[key] = _Album(is_sticker)
+        album.messages.append(message)
+
+        if album.timer is not None:
+            album.timer.cancel()
+        if len(album.messages) >= MAX_ALBUM_SIZE:
+            self._flush(key)
+        else:
+            album.timer = asyncio.get_running_loop().call_later(self.window, self._flush, key)
+
+    def _flush(self, key: tuple[int, str]):
+        album = self._albums.pop(key, None)
+        if album is None:
+            return
+        if album.timer is not None:
+            album.timer.cancel()
+
+        # Items may arrive out of order
+        messages = sorted(album.messages, key=lambda message: message.message_id)
+        logger.info(f"Collected album {key[1]} with {len(messages)} files from chat {key[0]}")
+
+        task = asyncio.create_task(self._run(messages, album.is_sticker))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _run(self, messages: list[types.Message], is_sticker: bool):
+        try:
+            await self.on_album(messages, is_sticker)
+        except Exception as e:
+            logger.error(f"Failed to handle album from chat {messages[0].chat.id}: {e}")
+
+    def close(self):
+        """Drop albums that are still being collected"""
+        for album in self._albums.values():
+            if album.timer is not None:
+                album.timer.cancel()
+        self._albums.clear()
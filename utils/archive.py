@@ -0,0 +1,178 @@
+import asyncio
+import json
+import logging
+import os
+import posixpath
+import zipfile
+
+from config import (
+    ARCHIVE_MAX_FILES,
+    ARCHIVE_MAX_SIZE,
+    TELEGRAM_DOWNLOAD_LIMIT,
+    TRANSFER_CHUNK_SIZE,
+    STATIC_IMAGE_FORMATS,
+    ANIMATED_IMAGE_FORMATS
+)
+from utils.scratch import ScratchDir
+from utils.worker_pool import MediaWorkerPool
+
+logger = logging.getLogger(__name__)
+
+MANIFEST_NAME = "manifest.json"
+
+
+class ArchiveError(ValueError):
+    """Raised when an archive can't be converted as a whole"""
+
+
+def _check_limits(archive: zipfile.ZipFile) -> list[zipfile.ZipInfo]:
+    """Check archive limits from its directory, before extracting anything"""
+    entries = archive.infolist()
+    if len(entries) > ARCHIVE_MAX_FILES:
+        raise ArchiveError(f"Archive has too many files ({len(entries)}), the limit is {ARCHIVE_MAX_FILES}")
+
+    # Extraction never reads past the declared sizes, so they bound disk use
+    total_size = sum(entry.file_size for entry in entries)
+    if total_size > ARCHIVE_MAX_SIZE * 1024 * 1024:
+        raise ArchiveError(f"Archive is too large when unpacked, the limit is {ARCHIVE_MAX_SIZE} MB")
+    return entries
+
+
+def _skip_reason(entry: zipfile.ZipInfo) -> str:
+    """Reason to leave an archive entry out, or an empty string"""
+    extension = os.path.splitext(entry.filename)[1].lower()
+    if extension not in STATIC_IMAGE_FORMATS + ANIMATED_IMAGE_FORMATS:
+        return f"Unsupported file format: {extension or 'unknown'}"
+    if entry.flag_bits & 0x1:
+        return "File is encrypted"
+    if entry.file_size > TELEGRAM_DOWNLOAD_LIMIT:
+        return f"File is too large, the limit is {TELEGRAM_DOWNLOAD_LIMIT // 1024 // 1024} MB"
+    return ""
+
+
+def _is_visible(entry: zipfile.ZipInfo) -> bool:
+    """Leave out directories and metadata added by archivers"""
+    if entry.is_dir():
+        return False
+    parts = entry.filename.split('/')
+    return parts[0] != '__MACOSX' and not parts[-1].startswith('.')
+
+
+def _extract(archive: zipfile.ZipFile, entry: zipfile.ZipInfo, destination: str):
+    """Stream one entry to disk in chunks"""
+    written = 0
+    with archive.open(entry) as source, open(destination, 'wb') as target:
+        while chunk := source.read(TRANSFER_CHUNK_SIZE):
+            written += len(chunk)
+            if written > entry.file_size:
+                raise ArchiveError("File is larger than declared in the archive")
+            target.write(chunk)
+
+
+def _output_name(entry_name: str, result_path: str, used: set[str]) -> str:
+    """Name of a result inside the output archive, keeping the source folders"""
+    # Entry names come from the user, drop anything that points outside the archive
+    name = posixpath.normpath('/' + entry_name.replace('\\', '/')).lstrip('/')
+    base = posixpath.splitext(name)[0]
+    extension = os.path.splitext(result_path)[1]
+    output_name = f"{base}{extension}"
+    counter = 1
+    while output_name in used:
+        counter += 1
+        output_name = f"{base}_{counter}{extension}"
+    used.add(output_name)
+    return output_name
+
+
+async def convert_archive(archive_path: str, output_path: str, worker_pool: MediaWorkerPool,
+                          is_sticker: bool, job_dir: ScratchDir, concurrency: int) -> dict:
+    """Convert the media files of a ZIP archive into a new ZIP archive
+
+    Entries are extracted one at a time and at most concurrency of them
+    are on disk and in the worker pool at once, the number of scheduler
+    slots the archive job holds. Files that can't be converted are
+    listed as failed. Results are
+    added to the output archive as they finish, with a manifest of what
+    happened to every file. Extracted entries and their results are
+    written to the job directory. Returns the manifest.
+    """
+    try:
+        archive = zipfile.ZipFile(archive_path)
+    except zipfile.BadZipFile:
+        raise ArchiveError("File is not a valid ZIP archive")
+    output = zipfile.ZipFile(output_path, 'w', zipfile.ZIP_STORED)
+    files = []
+    used_names = {MANIFEST_NAME}
+    output_lock = asyncio.Lock()
+    in_flight = asyncio.Semaphore(max(1, concurrency))
+
+    async def process_entry(entry: zipfile.ZipInfo, temp_path: str, record: dict):
+        result_path = None
+        try:
+            result_path, was_modified = await worker_pool.process(temp_path, is_sticker)
+            async with output_lock:
+                output_name = _output_name(entry.filename, result_path, used_names)
+                await asyncio.to_thread(output.write, result_path, output_name)
+            record.update(
+                status="converted" if was_modified else "unchanged",
+                output=output_name,
+                output_size=os.path.getsize(result_path)
+            )
+        except Exception as e:
+            logger.error(f"Failed to convert {entry.filename} from archive: {e}")
+            record.update(status="failed", error=str(e))
+        finally:
+            in_flight.release()
+            for path in {temp_path, result_path}:
+                if path and os.path.exists(path):
+                    os.remove(path)
+
+    try:
+        entries = [entry for entry in _check_limits(archive) if _is_visible(entry)]
+        logger.info(f"Converting archive with {len(entries)} files")
+
+        tasks = []
+        for entry in entries:
+            record = {'name': entry.filename, 'size': entry.file_size}
+            files.append(record)
+
+            skip_reason = _skip_reason(entry)
+            if skip_reason:
+                record.update(status="skipped", error=skip_reason)
+                continue
+
+            await in_flight.acquire()
+            temp_path = job_dir.file(entry.filename)
+            try:
+                await asyncio.to_thread(_extract, archive, entry, temp_path)
+            except Exception as e:
+                in_flight.release()
+                if os.path.exists(temp_path):
+                    os.remove(temp_path)
+                logger.error(f"Failed to extract {entry.filename} from archive: {e}")
+                record.update(status="failed", error=str(e))
+                continue
+            tasks.append(asyncio.create_task(process_entry(entry, temp_path, record)))
+
+        await asyncio.gather(*tasks)
+
+        manifest = {
+            'files': files,
+            'converted': sum(record['status'] in ("converted", "unchanged") for record in files),
+            'skipped': sum(record['status'] == "skipped" for record in files),
+            'failed': sum(record['status'] == "failed" for record in files)
+        }
+        output.writestr(MANIFEST_NAME, json.dumps(manifest, indent=2, ensure_ascii=False))
+        return manifest
+
+    finally:
+        output.close()
+        archive.close()
+
+
+def archive_caption(manifest: dict) -> str:
+    """Caption summarizing a converted archive"""
+    caption = f"Here's your converted archive! {manifest['converted']} of {len(manifest['files'])} files converted"
+    if manifest['skipped'] or manifest['failed']:
+        caption += f", {manifest['skipped']} skipped, {manifest['failed']} failed (see {MANIFEST_NAME})"
+    return caption
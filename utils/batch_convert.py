@@ -0,0 +1,196 @@
+import argparse
+import csv
+import json
+import logging
+import os
+import shutil
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from config import (
+    STATIC_IMAGE_FORMATS,
+    ANIMATED_IMAGE_FORMATS,
+    STATIC_STICKER_FORMAT,
+    ANIMATED_STICKER_FORMAT,
+    STATIC_EMOJI_FORMAT,
+    ANIMATED_EMOJI_FORMAT
+)
+from utils.media_processor import MediaProcessor
+
+logger = logging.getLogger(__name__)
+
+# Report columns, in CSV order
+REPORT_FIELDS = [
+    'source', 'output', 'status', 'seconds', 'source_size', 'output_size',
+    'decode_passes', 'encode_attempts', 'error'
+]
+
+# Extensions a processed file can end up with
+OUTPUT_EXTENSIONS = {
+    f".{output_format.lower()}"
+    for output_format in (STATIC_STICKER_FORMAT, ANIMATED_STICKER_FORMAT, STATIC_EMOJI_FORMAT, ANIMATED_EMOJI_FORMAT)
+}
+
+
+def find_media_files(source_dir: str, exclude_dir: str = None) -> list[str]:
+    """Find supported media files under a directory, as paths relative to it"""
+    exclude_dir = exclude_dir and os.path.abspath(exclude_dir)
+    files = []
+    for root, dirs, names in os.walk(source_dir):
+        # Outputs may be written inside the source tree, don't convert them again
+        dirs[:] = sorted(
+            d for d in dirs
+            if not d.startswith('.') and os.path.abspath(os.path.join(root, d)) != exclude_dir
+        )
+        for name in sorted(names):
+            if os.path.splitext(name)[1].lower() in STATIC_IMAGE_FORMATS + ANIMATED_IMAGE_FORMATS:
+                files.append(os.path.relpath(os.path.join(root, name), source_dir))
+    return files
+
+
+def find_up_to_date_output(source_path: str, output_base: str) -> str:
+    """Existing output newer than its source, or an empty string"""
+    source_mtime = os.path.getmtime(source_path)
+    for extension in OUTPUT_EXTENSIONS:
+        output_path = output_base + extension
+        if os.path.exists(output_path) and os.path.getmtime(output_path) >= source_mtime:
+            return output_path
+    return ""
+
+
+def convert_file(source_path: str, output_base: str, is_sticker: bool) -> dict:
+    """Convert one file in a worker process and move the result next to output_base
+
+    The source is copied to a scratch directory first, as MediaProcessor
+    writes its results next to the file it processes. Files that can't be
+    converted are recorded as failed and nothing is written for them.
+    """
+    record = {
+        'source': source_path,
+        'output': None,
+        'status': 'failed',
+        'seconds': None,
+        'source_size': os.path.getsize(source_path),
+        'output_size': None,
+        'decode_passes': None,
+        'encode_attempts': None,
+        'error': None
+    }
+    scratch_dir = tempfile.mkdtemp(prefix="convert_")
+    try:
+        work_path = os.path.join(scratch_dir, os.path.basename(source_path))
+        shutil.copyfile(source_path, work_path)
+
+        start = time.perf_counter()
+        processor = MediaProcessor(work_path, is_sticker)
+        try:
+            # Raises MediaProcessingError for files it can't convert
+            result_path, was_modified = processor.process()
+        finally:
+            record['seconds'] = round(time.perf_counter() - start, 3)
+            record['decode_passes'] = processor.decode_passes
+            record['encode_attempts'] = processor.encode_attempts
+
+        output_path = output_base + os.path.splitext(result_path)[1].lower()
+        os.makedirs(os.path.dirname(output_path) or '.', exist_ok=True)
+        shutil.move(result_path, output_path)
+        del processor
+
+        record.update(
+            output=output_path,
+            status='converted' if was_modified else 'unchanged',
+            output_size=os.path.getsize(output_path)
+        )
+    except Exception as e:
+        record['error'] = str(e)
+    finally:
+        shutil.rmtree(scratch_dir, ignore_errors=True)
+    return record
+
+
+def write_report(records: list[dict], report_path: str):
+    """Write the report as CSV or JSON, chosen by the file extension"""
+    os.makedirs(os.path.dirname(report_path) or '.', exist_ok=True)
+    if report_path.lower().endswith('.csv'):
+        with open(report_path, 'w', newline='', encoding='utf-8') as f:
+            writer = csv.DictWriter(f, fieldnames=REPORT_FIELDS)
+            writer.writeheader()
+            writer.writerows(records)
+    else:
+        with open(report_path, 'w', encoding='utf-8') as f:
+            json.dump(records, f, indent=2, ensure_ascii=False)
+
+
+def convert_directory(source_dir: str, output_dir: str, is_sticker: bool,
+                      jobs: int, force: bool = False) -> list[dict]:
+    """Convert all media files under source_dir into output_dir, keeping the folder structure"""
+    records = []
+    pending = {}
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        for relative_path in find_media_files(source_dir, exclude_dir=output_dir):
+            source_path = os.path.join(source_dir, relative_path)
+            output_base = os.path.join(output_dir, os.path.splitext(relative_path)[0])
+
+            existing = "" if force else find_up_to_date_output(source_path, output_base)
+            if existing:
+                records.append({
+                    **dict.fromkeys(REPORT_FIELDS),
+                    'source': source_path,
+                    'output': existing,
+                    'status': 'up-to-date',
+                    'source_size': os.path.getsize(source_path),
+                    'output_size': os.path.getsize(existing)
+                })
+                continue
+
+            future = executor.submit(convert_file, source_path, output_base, is_sticker)
+            pending[future] = source_path
+
+        for future in as_completed(pending):
+            record = future.result()
+            records.append(record)
+            if record['status'] == 'failed':
+                logger.error(f"failed: {record['source']} ({record['seconds']}s): {record['error']}")
+            else:
+                logger.info(f"{record['status']}: {record['source']} -> {record['output']} ({record['seconds']}s)")
+
+    records.sort(key=lambda record: record['source'])
+    return records
+
+
+def main(argv: list[str] = None) -> int:
+    """Command-line entry point"""
+    parser = argparse.ArgumentParser(
+        prog="python -m utils.media_processor",
+        description="Convert media files to Telegram stickers or emoji without the bot"
+    )
+    commands = parser.add_subparsers(dest='command', required=True)
+    convert = commands.add_parser('convert', help="convert all media files under a directory")
+    convert.add_argument('source', help="directory with source files")
+    convert.add_argument('--mode', choices=['sticker', 'emoji'], default='sticker')
+    convert.add_argument('-o', '--output', help="output directory (default: <source>_<mode>s)")
+    convert.add_argument('-j', '--jobs', type=int, default=os.cpu_count() or 1, help="worker processes")
+    convert.add_argument('--report', help="report file, .json or .csv (default: <output>/report.json)")
+    convert.add_argument('--force', action='store_true', help="convert files with up-to-date outputs too")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.WARNING, format='%(asctime)s - %(levelname)s - %(message)s')
+    logger.setLevel(logging.INFO)
+
+    if not os.path.isdir(args.source):
+        parser.error(f"not a directory: {args.source}")
+    output_dir = args.output or f"{os.path.normpath(args.source)}_{args.mode}s"
+    report_path = args.report or os.path.join(output_dir, "report.json")
+
+    start = time.perf_counter()
+    records = convert_directory(args.source, output_dir, args.mode == 'sticker', args.jobs, args.force)
+    write_report(records, report_path)
+
+    counts = {}
+    for record in records:
+        counts[record['status']] = counts.get(record['status'], 0) + 1
+    summary = ", ".join(f"{count} {status}" for status, count in sorted(counts.items()))
+    print(f"{len(records)} files in {time.perf_counter() - start:.1f}s: {summary or 'nothing to do'}")
+    print(f"Report: {report_path}")
+    return 1 if counts.get('failed') else 0
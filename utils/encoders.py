@@ -0,0 +1,196 @@
+import functools
+import logging
+import shutil
+import subprocess
+import tempfile
+from fractions import Fraction
+from typing import Optional
+
+import cv2
+import numpy
+
+from config import (
+    VIDEO_ENCODER,
+    FFMPEG_PATH,
+    VP9_PRESETS,
+    VP9_PRESET,
+    VP9_THREADS,
+    VP9_TILE_COLUMNS
+)
+
+logger = logging.getLogger(__name__)
+
+
+def _vp9_preset() -> dict:
+    if VP9_PRESET not in VP9_PRESETS:
+        raise ValueError(f"Unknown VP9 preset: {VP9_PRESET}")
+    return VP9_PRESETS[VP9_PRESET]
+
+
+class VideoEncoder:
+    """Encodes a stack of frames to a VP9 WEBM file
+
+    Frames are BGR, or BGRA when the encoder supports alpha and the
+    source has transparency. timeline lists the frame shown at every
+    output timestamp, so repeated frames are stored only once.
+    """
+    name = ""
+    supports_bitrate = False
+    supports_alpha = False
+    in_process = True  # Encodes in the worker process, its memory counts there
+
+    def unavailable_reason(self) -> Optional[str]:
+        """Why the encoder can't be used here, None if it can"""
+        return None
+
+    def encode(self, frames: numpy.ndarray, timeline: list[int], output_path: str,
+               fps: float, bitrate: Optional[int]):
+        raise NotImplementedError
+
+
+class OpenCVEncoder(VideoEncoder):
+    """cv2.VideoWriter, always available but without any encoder settings"""
+    name = "opencv"
+
+    def encode(self, frames: numpy.ndarray, timeline: list[int], output_path: str,
+               fps: float, bitrate: Optional[int]):
+        height, width = frames.shape[1:3]
+        # OpenCV's writer has no bitrate control and fails to open when
+        # given writer properties, so size is controlled via frames only
+        out = cv2.VideoWriter(
+            output_path,
+            cv2.VideoWriter_fourcc(*'VP90'),
+            fps,
+            (width, height)
+        )
+        if not out.isOpened():
+            raise RuntimeError(f"Failed to open video writer for {output_path}")
+        for index in timeline:
+            out.write(frames[index][:, :, :3])
+        out.release()
+
+
+class FFmpegEncoder(VideoEncoder):
+    """libvpx-vp9 in an ffmpeg subprocess, fed raw frames through a pipe"""
+    name = "ffmpeg"
+    supports_bitrate = True
+    supports_alpha = True
+    in_process = False
+
+    def unavailable_reason(self) -> Optional[str]:
+        if shutil.which(FFMPEG_PATH) is None:
+            return f"{FFMPEG_PATH} not found"
+        # Builds without libvpx exist, and a broken binary fails right here
+        try:
+            result = subprocess.run(
+                [FFMPEG_PATH, '-hide_banner', '-encoders'],
+                capture_output=True, text=True, timeout=30
+            )
+        except (OSError, subprocess.SubprocessError) as e:
+            return f"{FFMPEG_PATH} could not be run: {e}"
+        if result.returncode != 0:
+            return f"{FFMPEG_PATH} -encoders failed with code {result.returncode}"
+        if 'libvpx-vp9' not in result.stdout:
+            return f"{FFMPEG_PATH} was built without libvpx-vp9"
+        return None
+
+    def encode(self, frames: numpy.ndarray, timeline: list[int], output_path: str,
+               fps: float, bitrate: Optional[int]):
+        height, width, channels = frames.shape[1:4]
+        alpha = channels == 4
+        preset = _vp9_preset()
+        command = [
+            FFMPEG_PATH, '-hide_banner', '-loglevel', 'error', '-y',
+            '-f', 'rawvideo', '-pix_fmt', 'bgra' if alpha else 'bgr24',
+            '-s', f"{width}x{height}", '-r', str(fps), '-i', '-',
+            '-an', '-c:v', 'libvpx-vp9', '-pix_fmt', 'yuva420p' if alpha else 'yuv420p',
+            '-deadline', preset['deadline'], '-cpu-used', str(preset['cpu_used']),
+            '-row-mt', '1', '-tile-columns', str(VP9_TILE_COLUMNS), '-threads', str(VP9_THREADS),
+            # With a bitrate, crf caps the quality (constrained quality mode)
+            '-crf', str(preset['crf']), '-b:v', str(bitrate or 0),
+            '-f', 'webm', output_path
+        ]
+
+        # stderr goes to a file, a full pipe would block ffmpeg while frames are written
+        with tempfile.TemporaryFile() as errors:
+            process = subprocess.Popen(command, stdin=subprocess.PIPE, stderr=errors)
+            try:
+                for index in timeline:
+                    process.stdin.write(numpy.ascontiguousarray(frames[index]).data)
+                process.stdin.close()
+            except BrokenPipeError:
+                # ffmpeg exited early, its error output says why
+                pass
+            finally:
+                returncode = process.wait()
+            if returncode != 0:
+                errors.seek(0)
+                message = errors.read().decode(errors='replace').strip()
+                raise RuntimeError(f"ffmpeg failed with code {returncode}: {message}")
+
+
+class PyAVEncoder(VideoEncoder):
+    """libvpx-vp9 through the av package, in the worker process itself"""
+    name = "pyav"
+    supports_bitrate = True
+    supports_alpha = True
+
+    def unavailable_reason(self) -> Optional[str]:
+        try:
+            import av
+        except ImportError:
+            return "the av package is not installed"
+        try:
+            av.codec.Codec('libvpx-vp9', 'w')
+        except Exception:
+            return "the av package was built without libvpx-vp9"
+        return None
+
+    def encode(self, frames: numpy.ndarray, timeline: list[int], output_path: str,
+               fps: float, bitrate: Optional[int]):
+        import av
+
+        height, width, channels = frames.shape[1:4]
+        frame_format = 'bgra' if channels == 4 else 'bgr24'
+        preset = _vp9_preset()
+        rate = Fraction(fps).limit_denominator(1001)
+
+        container = av.open(output_path, 'w', format='webm')
+        try:
+            stream = container.add_stream('libvpx-vp9', rate=rate)
+            stream.width = width
+            stream.height = height
+            stream.pix_fmt = 'yuva420p' if channels == 4 else 'yuv420p'
+            stream.thread_count = VP9_THREADS
+            stream.options = {
+                'deadline': preset['deadline'],
+                'cpu-used': str(preset['cpu_used']),
+                'row-mt': '1',
+                'tile-columns': str(VP9_TILE_COLUMNS),
+                'crf': str(preset['crf']),
+                'b': str(bitrate or 0)
+            }
+            for pts, index in enumerate(timeline):
+                frame = av.VideoFrame.from_ndarray(numpy.ascontiguousarray(frames[index]), format=frame_format)
+                frame.pts = pts
+                frame.time_base = 1 / rate
+                container.mux(stream.encode(frame))
+            container.mux(stream.encode())
+        finally:
+            container.close()
+
+
+ENCODERS = {encoder.name: encoder for encoder in (OpenCVEncoder, FFmpegEncoder, PyAVEncoder)}
+
+
+@functools.lru_cache(maxsize=None)
+def get_encoder(name: str = VIDEO_ENCODER) -> VideoEncoder:
+    """Encoder by name, falls back to OpenCV when it can't be used here"""
+    if name not in ENCODERS:
+        raise ValueError(f"Unknown video encoder: {name}")
+    encoder = ENCODERS[name]()
+    reason = encoder.unavailable_reason()
+    if reason:
+        logger.warning(f"Video encoder {name} is not available ({reason}), using opencv")
+        return OpenCVEncoder()
+    return encoder
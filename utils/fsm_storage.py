@@ -0,0 +1,108 @@
+import asyncio
+import json
+import logging
+import sqlite3
+import threading
+import time
+from typing import Any, Mapping, Optional
+
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, DefaultKeyBuilder, StateType, StorageKey
+from aiogram.fsm.storage.memory import MemoryStorage
+
+from config import FSM_STORAGE, FSM_REDIS_URL, FSM_SQLITE_PATH, FSM_STATE_TTL
+
+logger = logging.getLogger(__name__)
+
+# Expired sessions are purged at most this often
+PURGE_INTERVAL = 60  # seconds
+
+
+class SQLiteStorage(BaseStorage):
+    """FSM storage in a SQLite database, with expiry of idle sessions
+
+    The database runs in WAL mode, so several bot processes on the same
+    machine can share it.
+    """
+
+    def __init__(self, path: str, ttl: Optional[int] = None):
+        self.ttl = ttl
+        self._key_builder = DefaultKeyBuilder(with_bot_id=True, with_destiny=True)
+        self._lock = threading.Lock()
+        self._last_purge = 0.0
+
+        self._db = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS fsm ("
+            "key TEXT PRIMARY KEY, state TEXT, data TEXT NOT NULL DEFAULT '{}', expires_at REAL)"
+        )
+        self._db.commit()
+
+    def _expires_at(self) -> Optional[float]:
+        return time.time() + self.ttl if self.ttl else None
+
+    def _read(self, key: str) -> tuple[Optional[str], dict]:
+        with self._lock:
+            row = self._db.execute(
+                "SELECT state, data, expires_at FROM fsm WHERE key = ?", (key,)
+            ).fetchone()
+        if row is None:
+            return None, {}
+        state, data, expires_at = row
+        if expires_at is not None and expires_at < time.time():
+            return None, {}
+        return state, json.loads(data)
+
+    def _write(self, key: str, column: str, value: Any):
+        now = time.time()
+        with self._lock:
+            # An expired session starts over instead of keeping its other column
+            self._db.execute("DELETE FROM fsm WHERE key = ? AND expires_at < ?", (key, now))
+            self._db.execute(
+                f"INSERT INTO fsm (key, {column}, expires_at) VALUES (?, ?, ?) "
+                f"ON CONFLICT(key) DO UPDATE SET {column} = excluded.{column}, expires_at = excluded.expires_at",
+                (key, value, self._expires_at())
+            )
+            if self.ttl and now - self._last_purge > PURGE_INTERVAL:
+                self._db.execute("DELETE FROM fsm WHERE expires_at < ?", (now,))
+                self._last_purge = now
+            self._db.commit()
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        value = state.state if isinstance(state, State) else state
+        await asyncio.to_thread(self._write, self._key_builder.build(key), "state", value)
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        state, _ = await asyncio.to_thread(self._read, self._key_builder.build(key))
+        return state
+
+    async def set_data(self, key: StorageKey, data: Mapping[str, Any]) -> None:
+        await asyncio.to_thread(self._write, self._key_builder.build(key), "data", json.dumps(dict(data)))
+
+    async def get_data(self, key: StorageKey) -> dict[str, Any]:
+        _, data = await asyncio.to_thread(self._read, self._key_builder.build(key))
+        return data
+
+    async def close(self) -> None:
+        with self._lock:
+            self._db.close()
+
+
+def create_storage() -> BaseStorage:
+    """Create the FSM storage selected in config"""
+    if FSM_STORAGE == "redis":
+        # Needs the redis package, only imported when this backend is used
+        from aiogram.fsm.storage.redis import RedisStorage
+        logger.info(f"Using Redis FSM storage at {FSM_REDIS_URL}")
+        return RedisStorage.from_url(
+            FSM_REDIS_URL,
+            state_ttl=FSM_STATE_TTL or None,
+            data_ttl=FSM_STATE_TTL or None
+        )
+    if FSM_STORAGE == "sqlite":
+        logger.info(f"Using SQLite FSM storage at {FSM_SQLITE_PATH}")
+        return SQLiteStorage(FSM_SQLITE_PATH, ttl=FSM_STATE_TTL or None)
+    if FSM_STORAGE != "memory":
+        raise ValueError(f"Unknown FSM storage: {FSM_STORAGE}")
+    return MemoryStorage()
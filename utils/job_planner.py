@@ -0,0 +1,127 @@
+import logging
+import mimetypes
+import os
+from typing import NamedTuple, Optional
+
+from aiogram import types
+
+from config import (
+    TELEGRAM_DOWNLOAD_LIMIT,
+    STATIC_IMAGE_FORMATS,
+    ANIMATED_IMAGE_FORMATS,
+    ARCHIVE_FORMATS
+)
+from utils.admission import pixel_limit_reason
+from utils.targets import get_target_params
+
+logger = logging.getLogger(__name__)
+
+# Cost units per megapixel, a 512x512 static image costs about 1
+STATIC_COST_PER_MEGAPIXEL = 3.0
+DECODE_COST_PER_MEGAPIXEL = 0.3
+ENCODE_COST_PER_MEGAPIXEL = 1.5
+# Assumed megapixels per megabyte when only the file size is known
+MEGAPIXELS_PER_MEGABYTE = 4.0
+
+
+class JobPlan(NamedTuple):
+    file_id: str
+    file_unique_id: str
+    file_name: str
+    file_size: Optional[int]
+    width: Optional[int]
+    height: Optional[int]
+    duration: Optional[int]
+    is_animated: Optional[bool]  # None when it is only known after download
+    cost: float  # Relative processing cost, used for scheduling
+    reject_reason: Optional[str]  # Set when the job should not be run
+    is_archive: bool = False  # A ZIP archive of media files
+
+
+def _pick_photo_size(photo: list[types.PhotoSize], target_size: int) -> types.PhotoSize:
+    """Pick the smallest photo size that still covers the target size"""
+    for size in sorted(photo, key=lambda size: size.width * size.height):
+        if max(size.width, size.height) >= target_size:
+            return size
+    return max(photo, key=lambda size: size.width * size.height)
+
+
+def _estimate_cost(is_sticker: bool, is_animated: Optional[bool], file_size: Optional[int],
+                   width: Optional[int], height: Optional[int], duration: Optional[int]) -> float:
+    """Estimate processing cost from the metadata known before download"""
+    if width and height:
+        megapixels = width * height / 1e6
+    else:
+        megapixels = (file_size or 0) / 1024 / 1024 * MEGAPIXELS_PER_MEGABYTE
+
+    if not is_animated:
+        return 0.2 + megapixels * STATIC_COST_PER_MEGAPIXEL
+
+    target_params = get_target_params(is_sticker, is_animated=True)
+    output_megapixels = target_params['width'] * target_params['height'] / 1e6
+    seconds = min(duration or target_params['max_duration'], target_params['max_duration'])
+    frames = seconds * target_params['fps']
+    return 0.2 + frames * (megapixels * DECODE_COST_PER_MEGAPIXEL + output_megapixels * ENCODE_COST_PER_MEGAPIXEL)
+
+
+def plan_job(message: types.Message, is_sticker: bool) -> Optional[JobPlan]:
+    """Plan processing of a message from Telegram metadata, before downloading it
+
+    Returns None if the message has no media.
+    """
+    width = height = duration = None
+    if message.document:
+        media = message.document
+        file_name = media.file_name
+        if not file_name:
+            extension = mimetypes.guess_extension(media.mime_type or '') or ''
+            file_name = f"document_{media.file_id}{extension}"
+        extension = os.path.splitext(file_name)[1].lower()
+        # Whether a GIF is animated is only known after download
+        is_animated = None if extension == '.gif' else extension in ANIMATED_IMAGE_FORMATS
+    elif message.photo:
+        target_size = get_target_params(is_sticker, is_animated=False)['width']
+        media = _pick_photo_size(message.photo, target_size)
+        file_name = f"photo_{media.file_id}.jpg"
+        width, height = media.width, media.height
+        is_animated = False
+    elif message.video:
+        media = message.video
+        file_name = f"video_{media.file_id}.mp4"
+        width, height, duration = media.width, media.height, media.duration
+        is_animated = True
+    else:
+        return None
+
+    file_size = media.file_size
+    extension = os.path.splitext(file_name)[1].lower()
+
+    # Archives are costed like a static image of the same size
+    is_archive = extension in ARCHIVE_FORMATS
+    if is_archive:
+        is_animated = False
+
+    reject_reason = None
+    if extension not in STATIC_IMAGE_FORMATS + ANIMATED_IMAGE_FORMATS + ARCHIVE_FORMATS:
+        reject_reason = f"Unsupported file format: {extension or 'unknown'}"
+    elif file_size and file_size > TELEGRAM_DOWNLOAD_LIMIT:
+        reject_reason = f"File is too large, bots can only download files up to {TELEGRAM_DOWNLOAD_LIMIT // 1024 // 1024} MB"
+    elif is_animated and width and height:
+        # Videos come with their dimensions, images are checked once the worker decodes them
+        reject_reason = pixel_limit_reason(True, width, height)
+
+    plan = JobPlan(
+        file_id=media.file_id,
+        file_unique_id=media.file_unique_id,
+        file_name=file_name,
+        file_size=file_size,
+        width=width,
+        height=height,
+        duration=duration,
+        is_animated=is_animated,
+        cost=_estimate_cost(is_sticker, is_animated, file_size, width, height, duration),
+        reject_reason=reject_reason,
+        is_archive=is_archive
+    )
+    logger.info(f"Planned job: {plan}")
+    return plan
@@ -0,0 +1,311 @@
+import asyncio
+import json
+import logging
+import sqlite3
+import threading
+import time
+from typing import NamedTuple, Optional
+
+from config import (
+    JOB_QUEUE_BACKEND,
+    JOB_QUEUE_PATH,
+    JOB_QUEUE_REDIS_URL,
+    JOB_QUEUE_VISIBILITY_TIMEOUT,
+    JOB_QUEUE_MAX_ATTEMPTS
+)
+
+logger = logging.getLogger(__name__)
+
+# Delay before a failed job is retried, multiplied by the attempt number
+RETRY_DELAY = 10  # seconds
+
+# Queued jobs a Redis claim looks at to find one of a chat with few running jobs
+REDIS_CLAIM_WINDOW = 50
+
+
+class QueuedJob(NamedTuple):
+    id: int
+    payload: dict
+    attempts: int
+
+
+class JobQueue:
+    """Durable queue of media jobs between the bot and its workers
+
+    A claimed job is leased to its worker for visibility_timeout seconds.
+    If the worker dies without acknowledging it, the lease runs out and
+    another worker picks the job up again. Jobs of chats with fewer
+    running jobs are claimed first. Jobs failing max_attempts times are
+    kept as dead for inspection.
+    """
+    visibility_timeout = 0
+
+    async def enqueue(self, chat_id: int, payload: dict) -> int:
+        """Add a job to the queue"""
+        raise NotImplementedError
+
+    async def claim(self) -> Optional[QueuedJob]:
+        """Take the next available job, if any"""
+        raise NotImplementedError
+
+    async def extend(self, job_id: int):
+        """Renew the lease of a running job"""
+        raise NotImplementedError
+
+    async def ack(self, job_id: int):
+        """Remove a finished job"""
+        raise NotImplementedError
+
+    async def fail(self, job: QueuedJob, error: str) -> bool:
+        """Schedule a failed job for retry, returns False if it ran out of attempts"""
+        raise NotImplementedError
+
+    async def close(self):
+        """Release the connection to the queue"""
+
+
+class SQLiteJobQueue(JobQueue):
+    """Job queue in a SQLite database
+
+    The database uses WAL mode, so the bot and its workers have to run on
+    the same host, it doesn't work on network filesystems.
+    """
+
+    def __init__(self, path: str, visibility_timeout: int, max_attempts: int):
+        self.visibility_timeout = visibility_timeout
+        self.max_attempts = max_attempts
+        self._lock = threading.Lock()
+
+        self._db = sqlite3.connect(path, check_same_thread=False, timeout=30, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS jobs ("
+            "id INTEGER PRIMARY KEY AUTOINCREMENT, chat_id INTEGER NOT NULL, payload TEXT NOT NULL, "
+            "status TEXT NOT NULL DEFAULT 'queued', attempts INTEGER NOT NULL DEFAULT 0, "
+            "available_at REAL NOT NULL, last_error TEXT)"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, available_at)")
+
+    def _enqueue(self, chat_id: int, payload: dict) -> int:
+        with self._lock:
+            cursor = self._db.execute(
+                "INSERT INTO jobs (chat_id, payload, available_at) VALUES (?, ?, ?)",
+                (chat_id, json.dumps(payload), time.time())
+            )
+            return cursor.lastrowid
+
+    def _claim(self) -> Optional[QueuedJob]:
+        now = time.time()
+        with self._lock:
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                while True:
+                    # Queued jobs and running jobs whose lease ran out are available.
+                    # Chats with fewer running jobs go first, so one chat's batch
+                    # doesn't occupy every worker.
+                    row = self._db.execute(
+                        "SELECT id, payload, attempts FROM jobs AS job "
+                        "WHERE status IN ('queued', 'running') AND available_at <= ? "
+                        "ORDER BY (SELECT COUNT(*) FROM jobs AS other WHERE other.chat_id = job.chat_id "
+                        "AND other.status = 'running' AND other.available_at > ?), id "
+                        "LIMIT 1",
+                        (now, now)
+                    ).fetchone()
+                    if row is None:
+                        self._db.execute("COMMIT")
+                        return None
+
+                    job_id, payload, attempts = row
+                    if attempts < self.max_attempts:
+                        break
+                    # Its workers kept dying, e.g. killed for running out of memory
+                    self._db.execute(
+                        "UPDATE jobs SET status = 'dead', last_error = 'lease expired' WHERE id = ?", (job_id,)
+                    )
+                    logger.error(f"Job {job_id} ran out of attempts after its lease expired")
+
+                self._db.execute(
+                    "UPDATE jobs SET status = 'running', attempts = attempts + 1, available_at = ? WHERE id = ?",
+                    (now + self.visibility_timeout, job_id)
+                )
+                self._db.execute("COMMIT")
+            except Exception:
+                self._db.execute("ROLLBACK")
+                raise
+        return QueuedJob(job_id, json.loads(payload), attempts + 1)
+
+    def _extend(self, job_id: int):
+        with self._lock:
+            self._db.execute(
+                "UPDATE jobs SET available_at = ? WHERE id = ? AND status = 'running'",
+                (time.time() + self.visibility_timeout, job_id)
+            )
+
+    def _ack(self, job_id: int):
+        with self._lock:
+            self._db.execute("DELETE FROM jobs WHERE id = ?", (job_id,))
+
+    def _fail(self, job_id: int, attempts: int, error: str) -> bool:
+        with self._lock:
+            if attempts >= self.max_attempts:
+                self._db.execute(
+                    "UPDATE jobs SET status = 'dead', last_error = ? WHERE id = ?", (error, job_id)
+                )
+                return False
+            self._db.execute(
+                "UPDATE jobs SET status = 'queued', available_at = ?, last_error = ? WHERE id = ?",
+                (time.time() + RETRY_DELAY * attempts, error, job_id)
+            )
+            return True
+
+    async def enqueue(self, chat_id: int, payload: dict) -> int:
+        return await asyncio.to_thread(self._enqueue, chat_id, payload)
+
+    async def claim(self) -> Optional[QueuedJob]:
+        return await asyncio.to_thread(self._claim)
+
+    async def extend(self, job_id: int):
+        await asyncio.to_thread(self._extend, job_id)
+
+    async def ack(self, job_id: int):
+        await asyncio.to_thread(self._ack, job_id)
+
+    async def fail(self, job: QueuedJob, error: str) -> bool:
+        return await asyncio.to_thread(self._fail, job.id, job.attempts, error)
+
+    async def close(self):
+        with self._lock:
+            self._db.close()
+
+
+# Runs atomically on the Redis server. Requeues jobs whose lease ran out,
+# or marks them dead without attempts left, then leases the first queued
+# job of the chat with the fewest running jobs among the first ARGV[5].
+# Returns the job id, payload and attempts, 0 if there is none, followed
+# by the ids of jobs that just died.
+_REDIS_CLAIM = """
+local queued, running, dead = KEYS[1], KEYS[2], KEYS[3]
+local now, lease, max_attempts = tonumber(ARGV[1]), tonumber(ARGV[2]), tonumber(ARGV[3])
+local prefix = ARGV[4]
+
+local died = {}
+for _, id in ipairs(redis.call('ZRANGEBYSCORE', running, '-inf', now)) do
+    redis.call('ZREM', running, id)
+    if tonumber(redis.call('HGET', prefix .. id, 'attempts')) >= max_attempts then
+        redis.call('HSET', prefix .. id, 'last_error', 'lease expired')
+        redis.call('SADD', dead, id)
+        table.insert(died, id)
+    else
+        redis.call('ZADD', queued, now, id)
+    end
+end
+
+local running_per_chat = {}
+for _, id in ipairs(redis.call('ZRANGE', running, 0, -1)) do
+    local chat_id = redis.call('HGET', prefix .. id, 'chat_id')
+    running_per_chat[chat_id] = (running_per_chat[chat_id] or 0) + 1
+end
+
+local best, best_running
+for _, id in ipairs(redis.call('ZRANGEBYSCORE', queued, '-inf', now, 'LIMIT', 0, tonumber(ARGV[5]))) do
+    local count = running_per_chat[redis.call('HGET', prefix .. id, 'chat_id')] or 0
+    if best == nil or count < best_running then
+        best, best_running = id, count
+        if count == 0 then
+            break
+        end
+    end
+end
+
+if best == nil then
+    return {0, '', 0, unpack(died)}
+end
+redis.call('ZREM', queued, best)
+redis.call('ZADD', running, now + lease, best)
+local attempts = redis.call('HINCRBY', prefix .. best, 'attempts', 1)
+return {best, redis.call('HGET', prefix .. best, 'payload'), attempts, unpack(died)}
+"""
+
+
+class RedisJobQueue(JobQueue):
+    """Job queue in Redis, for workers on other machines than the bot
+
+    Jobs are hashes, with sorted sets of queued jobs by the time they
+    become available and running jobs by the end of their lease. Lease
+    times come from the clocks of the bot and the workers, which are
+    expected to be in sync.
+    """
+
+    def __init__(self, url: str, visibility_timeout: int, max_attempts: int, key_prefix: str = "sticker-jobs"):
+        # Needs the redis package, only imported when this backend is used
+        from redis.asyncio import Redis
+        self.visibility_timeout = visibility_timeout
+        self.max_attempts = max_attempts
+        self._redis = Redis.from_url(url, decode_responses=True)
+        self._claim_script = self._redis.register_script(_REDIS_CLAIM)
+        self._job_prefix = f"{key_prefix}:job:"
+        self._next_id = f"{key_prefix}:next-id"
+        self._queued = f"{key_prefix}:queued"
+        self._running = f"{key_prefix}:running"
+        self._dead = f"{key_prefix}:dead"
+
+    async def enqueue(self, chat_id: int, payload: dict) -> int:
+        job_id = await self._redis.incr(self._next_id)
+        async with self._redis.pipeline(transaction=True) as pipe:
+            pipe.hset(f"{self._job_prefix}{job_id}", mapping={
+                'chat_id': chat_id, 'payload': json.dumps(payload), 'attempts': 0
+            })
+            pipe.zadd(self._queued, {job_id: time.time()})
+            await pipe.execute()
+        return job_id
+
+    async def claim(self) -> Optional[QueuedJob]:
+        job_id, payload, attempts, *died = await self._claim_script(
+            keys=[self._queued, self._running, self._dead],
+            args=[time.time(), self.visibility_timeout, self.max_attempts, self._job_prefix, REDIS_CLAIM_WINDOW]
+        )
+        for dead_id in died:
+            # Its workers kept dying, e.g. killed for running out of memory
+            logger.error(f"Job {dead_id} ran out of attempts after its lease expired")
+        if not int(job_id):
+            return None
+        return QueuedJob(int(job_id), json.loads(payload), int(attempts))
+
+    async def extend(self, job_id: int):
+        # Only while it is running, a job taken over or finished stays as it is
+        await self._redis.zadd(self._running, {job_id: time.time() + self.visibility_timeout}, xx=True)
+
+    async def ack(self, job_id: int):
+        async with self._redis.pipeline(transaction=True) as pipe:
+            pipe.zrem(self._running, job_id)
+            pipe.zrem(self._queued, job_id)
+            pipe.delete(f"{self._job_prefix}{job_id}")
+            await pipe.execute()
+
+    async def fail(self, job: QueuedJob, error: str) -> bool:
+        retry = job.attempts < self.max_attempts
+        async with self._redis.pipeline(transaction=True) as pipe:
+            pipe.zrem(self._running, job.id)
+            pipe.hset(f"{self._job_prefix}{job.id}", 'last_error', error)
+            if retry:
+                pipe.zadd(self._queued, {job.id: time.time() + RETRY_DELAY * job.attempts})
+            else:
+                pipe.sadd(self._dead, job.id)
+            await pipe.execute()
+        return retry
+
+    async def close(self):
+        await self._redis.aclose()
+
+
+def create_job_queue() -> Optional[JobQueue]:
+    """Create the job queue selected in config, None when jobs run in the bot"""
+    if JOB_QUEUE_BACKEND == "redis":
+        logger.info(f"Using Redis job queue at {JOB_QUEUE_REDIS_URL}")
+        return RedisJobQueue(JOB_QUEUE_REDIS_URL, JOB_QUEUE_VISIBILITY_TIMEOUT, JOB_QUEUE_MAX_ATTEMPTS)
+    if JOB_QUEUE_BACKEND == "sqlite":
+        logger.info(f"Using SQLite job queue at {JOB_QUEUE_PATH}")
+        return SQLiteJobQueue(JOB_QUEUE_PATH, JOB_QUEUE_VISIBILITY_TIMEOUT, JOB_QUEUE_MAX_ATTEMPTS)
+    if JOB_QUEUE_BACKEND != "inline":
+        raise ValueError(f"Unknown job queue backend: {JOB_QUEUE_BACKEND}")
+    return None
@@ -0,0 +1,381 @@
+import asyncio
+import logging
+import os
+import time
+from typing import NamedTuple, Optional, Union
+
+from aiogram import Bot, types
+from aiogram.exceptions import TelegramBadRequest
+
+from config import (
+    TRANSFER_CHUNK_SIZE,
+    TELEGRAM_UPLOAD_LIMIT,
+    FRAME_BUFFER_MEMMAP_THRESHOLD,
+    SCHEDULER_MAX_JOBS_PER_CHAT
+)
+from utils.admission import MediaTooLarge
+from utils.archive import convert_archive, archive_caption
+from utils.job_planner import JobPlan
+from utils.logger import set_job_id
+from utils.targets import get_target_params
+from utils.metrics import DOWNLOAD_SECONDS, UPLOAD_SECONDS, JOBS_IN_FLIGHT, count_job
+from utils.result_cache import ResultCache, CachedResult
+from utils.scratch import ScratchSpace, ScratchDir, ScratchQuotaExceeded
+from utils.worker_pool import MediaWorkerPool, WorkerPoolBusy
+
+logger = logging.getLogger(__name__)
+
+
+def result_caption(was_modified: bool) -> str:
+    """Caption for a processed file"""
+    return "Here's your processed file!" + (" (No modifications needed)" if not was_modified else "")
+
+
+def result_file_name(file_name: str, result_path: str) -> str:
+    """Name a result is sent under: the user's file name with the result's extension"""
+    base = os.path.splitext(os.path.basename(file_name))[0] or "file"
+    return base + os.path.splitext(result_path)[1]
+
+
+def scratch_estimate(plan: JobPlan, is_sticker: bool) -> int:
+    """Disk a job may need at its peak: the download, the result and spilled frames"""
+    file_size = plan.file_size or 0
+    if plan.is_archive:
+        # Entries are converted a few at a time, the output is capped by the upload limit
+        return file_size + TELEGRAM_UPLOAD_LIMIT
+    expected = file_size * 2
+    if plan.is_animated is not False:
+        params = get_target_params(is_sticker, True)
+        # Four channels for transparent GIFs
+        frame_buffer = params['fps'] * params['max_duration'] * params['width'] * params['height'] * 4
+        if frame_buffer > FRAME_BUFFER_MEMMAP_THRESHOLD * 1024 * 1024:
+            expected += frame_buffer
+    return expected
+
+
+class AlbumItem(NamedTuple):
+    file_name: str
+    media: Union[str, types.FSInputFile]  # Telegram file_id or a local file to upload
+    was_modified: bool
+    cache_key: Optional[str]
+    path: Optional[str]  # Local result, cached once it is sent
+    outcome: str
+
+
+class MediaJobRunner:
+    """Download a planned media file, process it and send the result to the chat
+
+    Shared by the bot process, which runs jobs inline, and by queue workers.
+    """
+
+    def __init__(self, bot: Bot, worker_pool: MediaWorkerPool, result_cache: ResultCache,
+                 scratch: ScratchSpace):
+        self.bot = bot
+        self.worker_pool = worker_pool
+        self.result_cache = result_cache
+        self.scratch = scratch
+
+    async def send_cached(self, chat_id: int, file_name: str, cache_key: str, cached: CachedResult):
+        """Send a cached result, by file_id when Telegram still has it"""
+        if cached.file_id:
+            try:
+                await self.bot.send_document(chat_id, cached.file_id, caption=result_caption(cached.was_modified))
+                return
+            except TelegramBadRequest as e:
+                logger.warning(f"Cached file_id rejected, uploading from cache: {e}")
+                self.result_cache.forget_file_id(cache_key)
+
+        start = time.perf_counter()
+        sent = await self.bot.send_document(
+            chat_id,
+            types.FSInputFile(
+                cached.path, filename=result_file_name(file_name, cached.path), chunk_size=TRANSFER_CHUNK_SIZE
+            ),
+            caption=result_caption(cached.was_modified)
+        )
+        UPLOAD_SECONDS.observe(time.perf_counter() - start)
+        self.result_cache.put(cache_key, cached.path, cached.was_modified, sent.document and sent.document.file_id)
+
+    async def _download(self, plan: JobPlan, job_dir: ScratchDir) -> str:
+        """Download a file into the job directory"""
+        logger.info(f"Getting file info for file_id: {plan.file_id}")
+        start = time.perf_counter()
+        file = await self.bot.get_file(plan.file_id)
+        file_path = file.file_path
+        logger.info(f"File path from Telegram: {file_path}")
+
+        # Stream the file to disk chunk by chunk instead of buffering it in memory
+        temp_path = job_dir.file(plan.file_name)
+        logger.info(f"Saving to temp path: {temp_path}")
+        await self.bot.download_file(file_path, destination=temp_path, chunk_size=TRANSFER_CHUNK_SIZE)
+        DOWNLOAD_SECONDS.observe(time.perf_counter() - start)
+
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(f"Temp file saved, size: {os.path.getsize(temp_path)} bytes")
+        return temp_path
+
+    async def _download_and_process(self, plan: JobPlan, is_sticker: bool,
+                                    job_dir: ScratchDir) -> tuple[str, bool]:
+        """Download a file and process it in a worker, the result is written next to the download"""
+        temp_path = await self._download(plan, job_dir)
+
+        # Process file
+        logger.info("=== Starting MediaProcessor ===")
+        result_path, was_modified = await self.worker_pool.process(temp_path, is_sticker)
+        logger.info(f"Processing completed. Result path: {result_path}")
+
+        if not os.path.exists(result_path):
+            raise RuntimeError("Failed to process file")
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(f"Result file size: {os.path.getsize(result_path)} bytes")
+        return result_path, was_modified
+
+    def _create_job_dir(self, plans: list[JobPlan], is_sticker: bool) -> ScratchDir:
+        """Scratch directory for a job, removed with all its files when the job ends"""
+        expected = sum(scratch_estimate(plan, is_sticker) for plan in plans)
+        job_dir = self.scratch.create(expected)
+        logger.info(f"Job directory: {job_dir.path}")
+        return job_dir
+
+    async def run(self, chat_id: int, plan: JobPlan, is_sticker: bool, job_id: Optional[str] = None,
+                  concurrency: int = SCHEDULER_MAX_JOBS_PER_CHAT):
+        """Run a media job
+
+        Log records of the job carry job_id, a new one if not given.
+        Archives convert concurrency files at a time, the scheduler slots
+        the job holds.
+        Raises WorkerPoolBusy when the workers can't take the job,
+        ScratchQuotaExceeded when there is no disk space for it,
+        MediaTooLarge when the file exceeds the processing limits,
+        MediaProcessingError when it can't be converted and any other
+        exception when processing fails.
+        """
+        set_job_id(job_id)
+        outcome = "failed"
+        JOBS_IN_FLIGHT.inc()
+
+        try:
+            logger.info("=== Starting new file processing ===")
+            # Converted archives are large and their caption lists what
+            # happened to every file, they are not cached
+            cache_key = None if plan.is_archive else self.result_cache.make_key(plan.file_unique_id, is_sticker)
+
+            # The file may have been processed while this job was waiting,
+            # the lookup was counted when the job was planned
+            cached = cache_key and self.result_cache.peek(cache_key)
+            if cached:
+                logger.info(f"Cache hit for {plan.file_unique_id}")
+                await self.send_cached(chat_id, plan.file_name, cache_key, cached)
+                outcome = "cached"
+                return
+
+            # Don't download anything if the workers can't take the job
+            if self.worker_pool.is_full():
+                raise WorkerPoolBusy(f"Worker queue is full ({self.worker_pool.pending} jobs pending)")
+            job_dir = self._create_job_dir([plan], is_sticker)
+
+            # Everything the job writes is removed with its directory,
+            # whether it succeeds, fails or is cancelled
+            with job_dir:
+                if plan.is_archive:
+                    result_path, caption = await self._download_and_convert_archive(
+                        plan, is_sticker, job_dir, concurrency
+                    )
+                    was_modified = True
+                else:
+                    result_path, was_modified = await self._download_and_process(plan, is_sticker, job_dir)
+                    caption = result_caption(was_modified)
+
+                # Send result
+                logger.info("=== Sending file ===")
+                start = time.perf_counter()
+                sent = await self.bot.send_document(
+                    chat_id,
+                    types.FSInputFile(
+                        result_path,
+                        filename=result_file_name(plan.file_name, result_path),
+                        chunk_size=TRANSFER_CHUNK_SIZE
+                    ),
+                    caption=caption
+                )
+                UPLOAD_SECONDS.observe(time.perf_counter() - start)
+                logger.info("File sent successfully")
+                outcome = "converted" if was_modified else "unchanged"
+
+                # Remember the result and its Telegram file_id for repeated files,
+                # failed conversions raise before getting here
+                if cache_key:
+                    self.result_cache.put(
+                        cache_key, result_path, was_modified, sent.document and sent.document.file_id
+                    )
+
+        except (WorkerPoolBusy, ScratchQuotaExceeded):
+            outcome = "busy"
+            raise
+        except MediaTooLarge:
+            outcome = "rejected"
+            raise
+        finally:
+            JOBS_IN_FLIGHT.dec()
+            count_job(is_sticker, plan, outcome)
+
+    async def _download_and_convert_archive(self, plan: JobPlan, is_sticker: bool, job_dir: ScratchDir,
+                                            concurrency: int) -> tuple[str, str]:
+        """Download a ZIP archive and convert its files, returns the result archive and its caption"""
+        temp_path = await self._download(plan, job_dir)
+
+        logger.info("=== Converting archive ===")
+        result_path = f"{os.path.splitext(temp_path)[0]}_processed.zip"
+        manifest = await convert_archive(temp_path, result_path, self.worker_pool, is_sticker, job_dir, concurrency)
+        logger.info(
+            f"Archive converted: {manifest['converted']} converted, "
+            f"{manifest['skipped']} skipped, {manifest['failed']} failed"
+        )
+
+        if not manifest['converted']:
+            raise RuntimeError("No files in the archive could be converted")
+        if os.path.getsize(result_path) > TELEGRAM_UPLOAD_LIMIT:
+            raise RuntimeError(
+                f"Converted archive is larger than {TELEGRAM_UPLOAD_LIMIT // 1024 // 1024} MB, "
+                f"please send fewer files at once"
+            )
+        return result_path, archive_caption(manifest)
+
+    async def _prepare_album_item(self, plan: JobPlan, is_sticker: bool, job_dir: ScratchDir) -> AlbumItem:
+        """Get the result for one album file from the cache or a worker"""
+        cache_key = self.result_cache.make_key(plan.file_unique_id, is_sticker)
+        cached = self.result_cache.get(cache_key)
+        if cached:
+            logger.info(f"Cache hit for {plan.file_unique_id}")
+            if cached.file_id:
+                return AlbumItem(plan.file_name, cached.file_id, cached.was_modified, cache_key, None, "cached")
+            media = types.FSInputFile(
+                cached.path, filename=result_file_name(plan.file_name, cached.path), chunk_size=TRANSFER_CHUNK_SIZE
+            )
+            return AlbumItem(plan.file_name, media, cached.was_modified, cache_key, cached.path, "cached")
+
+        result_path, was_modified = await self._download_and_process(plan, is_sticker, job_dir)
+        media = types.FSInputFile(
+            result_path,
+            filename=result_file_name(plan.file_name, result_path),
+            chunk_size=TRANSFER_CHUNK_SIZE
+        )
+        outcome = "converted" if was_modified else "unchanged"
+        return AlbumItem(plan.file_name, media, was_modified, cache_key, result_path, outcome)
+
+    async def _send_album(self, chat_id: int, items: list[AlbumItem]) -> list[types.Message]:
+        """Send results as one media group, or a single document"""
+        start = time.perf_counter()
+        if len(items) == 1:
+            item = items[0]
+            sent = [await self.bot.send_document(chat_id, item.media, caption=result_caption(item.was_modified))]
+        else:
+            sent = await self.bot.send_media_group(chat_id, [
+                types.InputMediaDocument(media=item.media, caption=result_caption(item.was_modified))
+                for item in items
+            ])
+        UPLOAD_SECONDS.observe(time.perf_counter() - start)
+        return sent
+
+    async def run_album(self, chat_id: int, plans: list[JobPlan], is_sticker: bool,
+                        job_id: Optional[str] = None,
+                        concurrency: int = SCHEDULER_MAX_JOBS_PER_CHAT) -> list[tuple[str, str]]:
+        """Run the jobs of an album, concurrency at a time, and send the results together
+
+        concurrency is the number of scheduler slots the album holds, so an
+        album never runs more files at once than a chat is allowed to. Returns (file name, error) for every file that failed. Raises
+        WorkerPoolBusy or ScratchQuotaExceeded when the album can't be
+        taken and any other exception when no file could be processed.
+        """
+        set_job_id(job_id)
+        outcomes = {plan.file_unique_id: "failed" for plan in plans}
+        JOBS_IN_FLIGHT.inc()
+
+        try:
+            logger.info(f"=== Starting album processing, {len(plans)} files ===")
+
+            # Take the album only if the workers can queue the files it runs at once
+            concurrency = max(1, min(concurrency, len(plans)))
+            free = self.worker_pool.max_pending - self.worker_pool.pending
+            if free < concurrency:
+                outcomes = dict.fromkeys(outcomes, "busy")
+                raise WorkerPoolBusy(f"Worker queue is full ({self.worker_pool.pending} jobs pending)")
+
+            try:
+                job_dir = self._create_job_dir(plans, is_sticker)
+            except ScratchQuotaExceeded:
+                outcomes = dict.fromkeys(outcomes, "busy")
+                raise
+
+            with job_dir:
+                return await self._process_and_send_album(
+                    chat_id, plans, is_sticker, job_dir, outcomes, concurrency
+                )
+
+        finally:
+            JOBS_IN_FLIGHT.dec()
+            for plan in plans:
+                count_job(is_sticker, plan, outcomes[plan.file_unique_id])
+
+    async def _process_and_send_album(self, chat_id: int, plans: list[JobPlan], is_sticker: bool,
+                                      job_dir: ScratchDir, outcomes: dict[str, str],
+                                      concurrency: int) -> list[tuple[str, str]]:
+        """Prepare the album files and send them, outcomes are updated per file"""
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def prepare(plan: JobPlan) -> AlbumItem:
+            async with semaphore:
+                return await self._prepare_album_item(plan, is_sticker, job_dir)
+
+        prepared = await asyncio.gather(*(prepare(plan) for plan in plans), return_exceptions=True)
+        items = []
+        failed = []
+        for plan, item in zip(plans, prepared):
+            if isinstance(item, Exception):
+                logger.error(f"Failed to process album file {plan.file_name}: {item}")
+                failed.append((plan.file_name, str(item)))
+                if isinstance(item, MediaTooLarge):
+                    outcomes[plan.file_unique_id] = "rejected"
+                elif isinstance(item, WorkerPoolBusy):
+                    outcomes[plan.file_unique_id] = "busy"
+            else:
+                items.append(item)
+
+        if not items:
+            raise RuntimeError(failed[0][1])
+
+        logger.info(f"=== Sending album of {len(items)} files ===")
+        try:
+            sent = await self._send_album(chat_id, items)
+        except TelegramBadRequest as e:
+            # A cached file_id may have expired, upload those files instead
+            if not any(item.cache_key and item.path is None for item in items):
+                raise
+            logger.warning(f"Cached file_id rejected, uploading album from cache: {e}")
+            items = [self._reupload_item(item) for item in items]
+            sent = await self._send_album(chat_id, items)
+        logger.info("Album sent successfully")
+        for plan, item in zip(plans, prepared):
+            if not isinstance(item, Exception):
+                outcomes[plan.file_unique_id] = item.outcome
+
+        # Remember uploaded results and their Telegram file_ids
+        for item, message in zip(items, sent):
+            if item.cache_key and item.path:
+                self.result_cache.put(
+                    item.cache_key, item.path, item.was_modified, message.document and message.document.file_id
+                )
+        return failed
+
+    def _reupload_item(self, item: AlbumItem) -> AlbumItem:
+        """Replace a cached file_id with the cached file"""
+        if not item.cache_key or item.path:
+            return item
+        self.result_cache.forget_file_id(item.cache_key)
+        cached = self.result_cache.peek(item.cache_key)
+        if cached is None:
+            raise RuntimeError(f"Cached result for {item.file_name} is gone")
+        media = types.FSInputFile(
+            cached.path, filename=result_file_name(item.file_name, cached.path), chunk_size=TRANSFER_CHUNK_SIZE
+        )
+        return item._replace(media=media, path=cached.path)
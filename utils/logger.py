@@ -1,23 +1,112 @@
+import atexit
+import contextvars
+import json
 import logging
+import multiprocessing
 import os
-from logging.handlers import RotatingFileHandler
+import queue
+import uuid
+import zlib
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+from typing import Optional
+
+from config import LOG_LEVEL, LOG_LEVELS, LOG_FORMAT, LOG_SAMPLE_RATE
+
+# Correlation ID of the job being handled, attached to every log record
+job_id_var: contextvars.ContextVar[Optional[str]] = contextvars.ContextVar('job_id', default=None)
+
+# Queue feeding the file handler from media worker processes, see worker_log_queue()
+_worker_queue = None
+
+
+def set_job_id(job_id: Optional[str] = None) -> str:
+    """Set the correlation ID for log records of the current task, a new one by default"""
+    job_id = job_id or uuid.uuid4().hex[:12]
+    job_id_var.set(job_id)
+    return job_id
+
+
+class JobContextFilter(logging.Filter):
+    """Attach the job ID and drop INFO and DEBUG records of jobs left out of the sample
+
+    Sampling is decided per job, so a sampled job keeps all its lines.
+    Warnings, errors and records outside of jobs are always kept.
+    """
+
+    def __init__(self, sample_rate: float = 1.0):
+        super().__init__()
+        self.sample_rate = sample_rate
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if not hasattr(record, 'job_id'):
+            record.job_id = job_id_var.get()
+        if record.job_id is None or record.levelno >= logging.WARNING or self.sample_rate >= 1:
+            return True
+        return zlib.crc32(record.job_id.encode()) / 2**32 < self.sample_rate
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            'time': self.formatTime(record, '%Y-%m-%dT%H:%M:%S') + f".{int(record.msecs):03d}",
+            'level': record.levelname,
+            'logger': record.name,
+            'process': record.process,
+            'job_id': getattr(record, 'job_id', None),
+            'message': record.getMessage()
+        }
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False)
+
+
+class TextFormatter(logging.Formatter):
+    """The classic log line, with the job ID when there is one"""
+
+    def __init__(self):
+        super().__init__('%(asctime)s - %(levelname)s - %(job_prefix)s%(message)s', datefmt='%Y-%m-%d %H:%M:%S')
+
+    def format(self, record: logging.LogRecord) -> str:
+        job_id = getattr(record, 'job_id', None)
+        record.job_prefix = f"[{job_id}] " if job_id else ""
+        return super().format(record)
+
+
+def _apply_levels():
+    logging.getLogger().setLevel(LOG_LEVEL)
+    # Per-logger overrides, e.g. "utils.media_processor=WARNING,aiogram=INFO"
+    for override in filter(None, (item.strip() for item in LOG_LEVELS.split(','))):
+        name, _, level = override.partition('=')
+        logging.getLogger(name.strip()).setLevel(level.strip().upper())
+
+
+def _queue_handler(log_queue) -> QueueHandler:
+    handler = QueueHandler(log_queue)
+    handler.addFilter(JobContextFilter(LOG_SAMPLE_RATE))
+    return handler
+
 
 def setup_logger():
-    """Configuring a logger with file rotation"""
+    """Configure non-blocking logging to a rotating file
+
+    Records are put on a queue and written by a background thread, so
+    logging never waits for the disk in the event loop.
+    """
+    global _worker_queue
+    if _worker_queue is not None:
+        # Already set up in this process
+        return logging.getLogger()
+
     # Create a directory for logs if it does not exist
     log_dir = "logs"
     if not os.path.exists(log_dir):
         os.makedirs(log_dir)
-    
+
     # Path to log file
     log_file = os.path.join(log_dir, "bot.log")
-    
-    # Setting up formatting
-    formatter = logging.Formatter(
-        '%(asctime)s - %(levelname)s - %(message)s',
-        datefmt='%Y-%m-%d %H:%M:%S'
-    )
-    
+
     # Create a handler for a file with rotation
     # Maximum file size is 10MB, we store the last 5 files
     file_handler = RotatingFileHandler(
@@ -26,11 +115,43 @@ def setup_logger():
         backupCount=5,
         encoding='utf-8'
     )
-    file_handler.setFormatter(formatter)
-    
+    file_handler.setFormatter(JsonFormatter() if LOG_FORMAT == "json" else TextFormatter())
+
+    log_queue = queue.SimpleQueue()
+    listener = QueueListener(log_queue, file_handler, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+
+    # Media worker processes log through a queue of their own to the same file
+    _worker_queue = multiprocessing.Queue()
+    worker_listener = QueueListener(_worker_queue, file_handler, respect_handler_level=True)
+    worker_listener.start()
+    atexit.register(worker_listener.stop)
+
     # Setting up the root logger
     logger = logging.getLogger()
-    logger.setLevel(logging.INFO)
-    logger.addHandler(file_handler)
-    
-    return logger 
\ No newline at end of file
+    logger.addHandler(_queue_handler(log_queue))
+    _apply_levels()
+
+    return logger
+
+
+def worker_log_queue():
+    """Queue for worker process logs, None if logging was not set up"""
+    return _worker_queue
+
+
+def init_worker_logging(log_queue):
+    """Send the logs of a worker process to the parent's log file
+
+    Used as ProcessPoolExecutor initializer. Without a queue the worker
+    keeps the logging setup it was started with.
+    """
+    if log_queue is None:
+        return
+    root = logging.getLogger()
+    # Handlers inherited from the parent would write to its in-process queue
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+    root.addHandler(_queue_handler(log_queue))
+    _apply_levels()
@@ -1,47 +1,62 @@
+import math
 import os
+import shutil
+import tempfile
+import time
 import cv2
 import numpy
 import logging
+from typing import Optional
 from PIL import Image
+from utils.admission import MediaProbe, MediaProcessingError
+from utils.encoders import OpenCVEncoder, get_encoder
+from utils.rate_control import RateController
+from utils.static_encoder import encode_png_to_limit
+from utils.targets import get_target_params
 from config import (
-    STATIC_STICKER_MAX_SIZE,
-    STATIC_STICKER_WIDTH,
-    STATIC_STICKER_HEIGHT,
-    STATIC_STICKER_FORMAT,
-    ANIMATED_STICKER_MAX_SIZE,
-    ANIMATED_STICKER_WIDTH,
-    ANIMATED_STICKER_HEIGHT,
-    ANIMATED_STICKER_FORMAT,
-    ANIMATED_STICKER_FPS,
-    ANIMATED_STICKER_MAX_DURATION,
-    STATIC_EMOJI_MAX_SIZE,
-    STATIC_EMOJI_WIDTH,
-    STATIC_EMOJI_HEIGHT,
-    STATIC_EMOJI_FORMAT,
-    ANIMATED_EMOJI_MAX_SIZE,
-    ANIMATED_EMOJI_WIDTH,
-    ANIMATED_EMOJI_HEIGHT,
-    ANIMATED_EMOJI_FORMAT,
-    ANIMATED_EMOJI_FPS,
-    ANIMATED_EMOJI_MAX_DURATION,
     STATIC_IMAGE_FORMATS,
-    ANIMATED_IMAGE_FORMATS
+    ANIMATED_IMAGE_FORMATS,
+    FRAME_BUFFER_MEMMAP_THRESHOLD,
+    STATIC_REDUCING_GAP,
+    GIF_MIN_FRAME_DURATION,
+    GIF_DEFAULT_FRAME_DURATION
 )
 
 logger = logging.getLogger(__name__)
 
+
+def warm_up():
+    """Load image plugins and video codecs, so the first job doesn't wait for them"""
+    Image.init()
+    encode_png_to_limit(Image.new('RGB', (16, 16)), 1024)
+    with tempfile.TemporaryDirectory(prefix="warm_up_") as temp_dir:
+        path = os.path.join(temp_dir, "warm_up.webm")
+        get_encoder().encode(numpy.zeros((2, 16, 16, 3), dtype=numpy.uint8), [0, 1], path, 30, None)
+        cap = cv2.VideoCapture(path)
+        cap.read()
+        cap.release()
+
+
 class MediaProcessor:
     def __init__(self, file_path: str, is_sticker: bool = True):
         self.file_path = file_path
         self.is_sticker = is_sticker
         self.is_animated = self._check_if_animated()
+        self.encoder = get_encoder()
         self.temp_files = []
+        self.decode_passes = 0  # Times the source was decoded, for diagnostics
+        self.encode_attempts = 0
+        self.encode_times = []  # Seconds per encode attempt
+        self.stage_times = {}  # Seconds spent in decode, resize and encode
+        self.final_size = None  # Bytes of the processed file, None if it wasn't processed
         
     def __del__(self):
         """Cleanup temporary files"""
         for temp_file in self.temp_files:
             try:
-                if os.path.exists(temp_file):
+                if os.path.isdir(temp_file):
+                    shutil.rmtree(temp_file)
+                elif os.path.exists(temp_file):
                     os.remove(temp_file)
             except Exception as e:
                 logger.error(f"Error removing temp file {temp_file}: {e}")
@@ -63,57 +78,74 @@ class MediaProcessor:
             
         return False
     
+    def probe(self) -> Optional[MediaProbe]:
+        """Read the dimensions of the source without decoding it, None if it can't be read"""
+        file_ext = os.path.splitext(self.file_path)[1].lower()
+        try:
+            if self.is_animated and file_ext != '.gif':
+                cap = cv2.VideoCapture(self.file_path)
+                try:
+                    if not cap.isOpened():
+                        return None
+                    return MediaProbe(
+                        'video', file_ext.lstrip('.'), '',
+                        int(cap.get(cv2.CAP_PROP_FRAME_WIDTH)), int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT)),
+                        max(int(cap.get(cv2.CAP_PROP_FRAME_COUNT)), 0), cap.get(cv2.CAP_PROP_FPS), False
+                    )
+                finally:
+                    cap.release()
+
+            with Image.open(self.file_path) as img:
+                alpha = img.mode in ('RGBA', 'LA', 'PA') or img.info.get('transparency') is not None
+                if self.is_animated:
+                    # GIF transparency is kept only if the encoder can store it
+                    return MediaProbe(
+                        'gif', img.format, img.mode, img.width, img.height, 0, 0.0,
+                        alpha and self.encoder.supports_alpha
+                    )
+                return MediaProbe('static', img.format, img.mode, img.width, img.height, 1, 0.0, alpha)
+        except Exception as e:
+            logger.warning(f"Could not probe {self.file_path}: {e}")
+            return None
+
     def get_target_params(self):
         """Get target parameters based on file type and destination"""
-        if self.is_sticker:
-            if self.is_animated:
-                return {
-                    'max_size': ANIMATED_STICKER_MAX_SIZE,
-                    'width': ANIMATED_STICKER_WIDTH,
-                    'height': ANIMATED_STICKER_HEIGHT,
-                    'format': ANIMATED_STICKER_FORMAT,
-                    'fps': ANIMATED_STICKER_FPS,
-                    'max_duration': ANIMATED_STICKER_MAX_DURATION
-                }
-            else:
-                return {
-                    'max_size': STATIC_STICKER_MAX_SIZE,
-                    'width': STATIC_STICKER_WIDTH,
-                    'height': STATIC_STICKER_HEIGHT,
-                    'format': STATIC_STICKER_FORMAT
-                }
-        else:
-            if self.is_animated:
-                return {
-                    'max_size': ANIMATED_EMOJI_MAX_SIZE,
-                    'width': ANIMATED_EMOJI_WIDTH,
-                    'height': ANIMATED_EMOJI_HEIGHT,
-                    'format': ANIMATED_EMOJI_FORMAT,
-                    'fps': ANIMATED_EMOJI_FPS,
-                    'max_duration': ANIMATED_EMOJI_MAX_DURATION
-                }
-            else:
-                return {
-                    'max_size': STATIC_EMOJI_MAX_SIZE,
-                    'width': STATIC_EMOJI_WIDTH,
-                    'height': STATIC_EMOJI_HEIGHT,
-                    'format': STATIC_EMOJI_FORMAT
-                }
+        return get_target_params(self.is_sticker, self.is_animated)
     
+    def _add_stage_time(self, stage: str, start: float):
+        """Add the time since start to a processing stage"""
+        self.stage_times[stage] = self.stage_times.get(stage, 0.0) + time.perf_counter() - start
+
     def check_size_requirements(self) -> bool:
         """Check if file meets size requirements"""
         file_size = os.path.getsize(self.file_path) / 1024  # Convert to KB
         target_params = self.get_target_params()
         return file_size <= target_params['max_size']
     
-    def process_static_image(self) -> str:
-        """Process static image file according to requirements"""
+    def process_static_image(self, img: Optional[Image.Image] = None) -> str:
+        """Process static image file according to requirements
+
+        img is the source already opened by process(), so it is decoded only once.
+        """
         target_params = self.get_target_params()
         
         try:
-            img = Image.open(self.file_path)
+            start = time.perf_counter()
+            if img is None:
+                img = Image.open(self.file_path)
+            # The source dimensions, the image may be decoded at a smaller scale
+            width, height = img.size
+            target_size = target_params['width']  # 512 for stickers
+            reduced_side = target_size * STATIC_REDUCING_GAP
+            if img.format == 'JPEG' and max(width, height) > reduced_side:
+                # JPEG decodes at 1/2, 1/4 or 1/8 scale for a fraction of the time and memory
+                scale = reduced_side / max(width, height)
+                img.draft(img.mode, (math.ceil(width * scale), math.ceil(height * scale)))
+            img.load()
+            self.decode_passes += 1
+            self._add_stage_time('decode', start)
             logger.info(f"Opened image: {self.file_path}")
-            logger.info(f"Original size: {img.size}")
+            logger.info(f"Original size: {(width, height)}, decoded at: {img.size}")
             
             # Convert RGBA to RGB if needed
             if img.mode == 'RGBA' and target_params['format'] != 'PNG':
@@ -122,13 +154,11 @@ class MediaProcessor:
                 background.paste(img, mask=img.split()[3])
                 img = background
 
-            # Get current dimensions
-            width, height = img.size
+            # Target dimensions are computed from the source, not the reduced decode
             logger.info(f"Current dimensions: {width}x{height}")
             
             # Check if we need to resize
             max_side = max(width, height)
-            target_size = target_params['width']  # 512 for stickers
             
             if max_side != target_size:
                 # Calculate scaling ratio to make the larger side exactly 512
@@ -158,20 +188,34 @@ class MediaProcessor:
                         new_width_int = round(new_height_int * (width / height))
                 
                 logger.info(f"Final dimensions after adjustment: {new_width_int}x{new_height_int}")
-                # Resize image using high-quality Lanczos resampling
-                img = img.resize((new_width_int, new_height_int), Image.Resampling.LANCZOS)
+                # Resize image using high-quality Lanczos resampling, large images
+                # are first shrunk with reduce() to STATIC_REDUCING_GAP times the target
+                start = time.perf_counter()
+                img = img.resize(
+                    (new_width_int, new_height_int),
+                    Image.Resampling.LANCZOS,
+                    reducing_gap=STATIC_REDUCING_GAP
+                )
+                self._add_stage_time('resize', start)
             
             # Save processed image
             output_path = f"{os.path.splitext(self.file_path)[0]}_processed.{target_params['format'].lower()}"
             self.temp_files.append(output_path)
             logger.info(f"Saving to: {output_path}")
             
+            start = time.perf_counter()
             if target_params['format'] == 'PNG':
-                img.save(output_path, 'PNG', optimize=True)
+                encoded = encode_png_to_limit(img, target_params['max_size'] * 1024)
+                logger.info(f"Selected encoding: {encoded.name}")
+                with open(output_path, 'wb') as f:
+                    f.write(encoded.data)
             else:
                 img.save(output_path, target_params['format'], quality=95, method=6)
-            
-            logger.info(f"Saved file size: {os.path.getsize(output_path)} bytes")
+            self._add_stage_time('encode', start)
+            self.encode_times.append(time.perf_counter() - start)
+            self.encode_attempts = 1
+            self.final_size = os.path.getsize(output_path)
+            logger.debug(f"Saved file size: {self.final_size} bytes")
             return output_path
             
         except Exception as e:
@@ -194,19 +238,78 @@ class MediaProcessor:
             logger.error(f"Error processing animated file: {str(e)}")
             return self.file_path
 
+    def _allocate_frames(self, count: int, height: int, width: int, channels: int = 3) -> numpy.ndarray:
+        """Allocate a BGR (or BGRA) frame buffer, backed by a file for large targets"""
+        shape = (count, height, width, channels)
+        if count * height * width * channels <= FRAME_BUFFER_MEMMAP_THRESHOLD * 1024 * 1024:
+            return numpy.empty(shape, dtype=numpy.uint8)
+
+        buffer_path = f"{os.path.splitext(self.file_path)[0]}_frames.raw"
+        self.temp_files.append(buffer_path)
+        logger.info(f"Using memory-mapped frame buffer: {buffer_path}")
+        return numpy.memmap(buffer_path, dtype=numpy.uint8, mode='w+', shape=shape)
+
+    def _encode_to_limit(self, frames: numpy.ndarray, timeline: list[int], output_path: str,
+                         target_params: dict):
+        """Encode frames to WEBM, retrying with smaller settings until the file fits"""
+        fps = target_params['fps']
+        controller = RateController(
+            target_params['max_size'] * 1024,
+            duration=len(timeline) / fps,
+            supports_bitrate=self.encoder.supports_bitrate
+        )
+
+        settings = controller.first()
+        while settings is not None:
+            attempt_frames = frames
+            if settings.scale < 1:
+                start = time.perf_counter()
+                height, width = frames.shape[1:3]
+                size = (max(int(width * settings.scale), 2), max(int(height * settings.scale), 2))
+                attempt_frames = numpy.stack([
+                    cv2.resize(frame, size, interpolation=cv2.INTER_AREA) for frame in frames
+                ])
+                self._add_stage_time('resize', start)
+
+            start = time.perf_counter()
+            try:
+                self.encoder.encode(
+                    attempt_frames,
+                    timeline[::settings.fps_divisor],
+                    output_path,
+                    fps / settings.fps_divisor,
+                    settings.bitrate
+                )
+            except Exception as e:
+                if isinstance(self.encoder, OpenCVEncoder):
+                    raise
+                # Start over with OpenCV rather than returning the unconverted source
+                logger.warning(f"Video encoder {self.encoder.name} failed ({e}), retrying with opencv")
+                self.encoder = OpenCVEncoder()
+                return self._encode_to_limit(frames, timeline, output_path, target_params)
+            self._add_stage_time('encode', start)
+            self.encode_times.append(time.perf_counter() - start)
+            file_size = os.path.getsize(output_path)
+            logger.info(f"Encode attempt {controller.attempts + 1} ({settings}): {file_size/1024:.2f}KB")
+            settings = controller.next(file_size)
+
+        self.encode_attempts = controller.attempts
+        self.final_size = file_size
+        if not controller.fits:
+            logger.warning(
+                f"Size limit of {target_params['max_size']}KB not reached "
+                f"after {controller.attempts} attempts"
+            )
+        logger.info(
+            f"Final file size: {file_size/1024:.2f}KB after {controller.attempts} encode attempts, "
+            f"decode passes: {self.decode_passes}"
+        )
+
     def _process_animated_gif(self, target_params: dict) -> str:
         """Convert GIF to WEBM"""
         try:
-            # Create a temporary directory for frames
-            temp_dir = f"temp_frames_{os.path.basename(self.file_path)}"
-            os.makedirs(temp_dir, exist_ok=True)
-            self.temp_files.append(temp_dir)
-            logger.info(f"Created temp directory: {temp_dir}")
-            
             # Open GIF
             img = Image.open(self.file_path)
-            frame_count = 0
-            frames = []
             logger.info(f"Original GIF dimensions: {img.width}x{img.height}")
             
             # Calculate new dimensions (keep proportions)
@@ -219,81 +322,66 @@ class MediaProcessor:
             
             logger.info(f"Target dimensions: {new_width}x{new_height}")
             
-            # Extract and save frames
+            # Transparency is kept only if the encoder can store it
+            alpha = self.encoder.supports_alpha and (
+                img.mode in ('RGBA', 'LA', 'PA') or img.info.get('transparency') is not None
+            )
+            if alpha:
+                logger.info("Keeping GIF transparency")
+            
+            # Every output frame shows the GIF frame displayed at its timestamp.
+            # Only frames that appear in the output are converted and resized,
+            # once, into a frame stack reused by every encode attempt.
+            fps = target_params['fps']
+            max_frames = int(fps * target_params['max_duration'])
+            frames = self._allocate_frames(
+                min(getattr(img, 'n_frames', 1), max_frames), new_height, new_width, 4 if alpha else 3
+            )
+            self.decode_passes += 1
+            timeline = []
+            frame_count = 0
+            frame_start = 0
+            decode_start = time.perf_counter()
+            resize_time = 0.0
             try:
-                while True:
-                    # Limit the number of frames
-                    if frame_count >= target_params['fps'] * target_params['max_duration']:
-                        break
-                        
-                    # Save the frame
-                    frame_path = os.path.join(temp_dir, f"frame_{frame_count:04d}.png")
-                    
-                    frame = img.copy()
-                    frame = frame.resize((new_width, new_height), Image.Resampling.LANCZOS)
-                    frame.save(frame_path)
-                    frames.append(frame_path)
-                    
-                    frame_count += 1
+                while len(timeline) < max_frames:
+                    duration = img.info.get('duration') or 0
+                    if duration < GIF_MIN_FRAME_DURATION:
+                        # Browsers show frames with tiny delays at the default speed
+                        duration = GIF_DEFAULT_FRAME_DURATION
+                    frame_end = frame_start + duration
+
+                    shown_from = len(timeline)
+                    while len(timeline) < max_frames and len(timeline) * 1000 / fps < frame_end:
+                        timeline.append(frame_count)
+
+                    if len(timeline) > shown_from:
+                        frame = img.convert('RGBA' if alpha else 'RGB')
+                        resize_start = time.perf_counter()
+                        frame = frame.resize((new_width, new_height), Image.Resampling.LANCZOS)
+                        resize_time += time.perf_counter() - resize_start
+                        # PIL gives RGB(A), the encoders expect BGR(A)
+                        frames[frame_count] = numpy.asarray(frame)[:, :, [2, 1, 0, 3] if alpha else [2, 1, 0]]
+                        frame_count += 1
+
+                    frame_start = frame_end
                     img.seek(img.tell() + 1)
             except EOFError:
                 pass
+            frames = frames[:frame_count]
+            self.stage_times['resize'] = self.stage_times.get('resize', 0.0) + resize_time
+            self._add_stage_time('decode', decode_start + resize_time)
             
-            logger.info(f"Extracted {frame_count} frames")
+            logger.info(f"Extracted {frame_count} frames for {len(timeline)} output frames")
             
-            if not frames:
+            if not frame_count:
                 raise ValueError("No frames extracted from GIF")
             
             # Create WEBM from frames
             output_path = f"{os.path.splitext(self.file_path)[0]}_processed.{target_params['format'].lower()}"
             logger.info(f"Creating WEBM file: {output_path}")
             
-            # Open the first frame to get the dimensions
-            first_frame = cv2.imread(frames[0])
-            height, width = first_frame.shape[:2]
-            
-            # Create a video writer
-            fourcc = cv2.VideoWriter_fourcc(*'VP90')
-            out = cv2.VideoWriter(
-                output_path,
-                fourcc,
-                target_params['fps'],
-                (width, height)
-            )
-            
-            # Recording frames
-            for frame_path in frames:
-                frame = cv2.imread(frame_path)
-                out.write(frame)
-            
-            out.release()
-            logger.info(f"Initial WEBM created, size: {os.path.getsize(output_path)/1024:.2f}KB")
-            
-            # Check the file size and reduce the bitrate if necessary
-            while os.path.getsize(output_path) / 1024 > target_params['max_size']:
-                # Reduce bitrate by 20% at each iteration
-                bitrate = int(os.path.getsize(output_path) * 0.8)
-                logger.info(f"Reducing bitrate to {bitrate} bytes")
-                
-                out = cv2.VideoWriter(
-                    output_path,
-                    fourcc,
-                    target_params['fps'],
-                    (width, height),
-                    params=[
-                        cv2.VIDEOWRITER_PROP_QUALITY, 95,
-                        cv2.VIDEOWRITER_PROP_BITRATE, bitrate
-                    ]
-                )
-                
-                for frame_path in frames:
-                    frame = cv2.imread(frame_path)
-                    out.write(frame)
-                
-                out.release()
-                logger.info(f"Current file size: {os.path.getsize(output_path)/1024:.2f}KB")
-            
-            logger.info(f"Final file size: {os.path.getsize(output_path)/1024:.2f}KB")
+            self._encode_to_limit(frames, timeline, output_path, target_params)
             return output_path
             
         except Exception as e:
@@ -307,12 +395,15 @@ class MediaProcessor:
         try:
             # Open the video
             cap = cv2.VideoCapture(self.file_path)
+            self.decode_passes += 1
             logger.info("Opened video file")
             
             # Get video parameters
             width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
             height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
-            logger.info(f"Original video dimensions: {width}x{height}")
+            source_fps = cap.get(cv2.CAP_PROP_FPS)
+            source_frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+            logger.info(f"Original video: {width}x{height}, {source_fps:.2f} fps, {source_frames} frames")
             
             # Calculate new dimensions (keep proportions)
             ratio = min(
@@ -328,75 +419,60 @@ class MediaProcessor:
             output_path = f"{os.path.splitext(self.file_path)[0]}_processed.{target_params['format'].lower()}"
             logger.info(f"Output path: {output_path}")
             
-            # Create a video writer
-            fourcc = cv2.VideoWriter_fourcc(*'VP90')
-            out = cv2.VideoWriter(
-                output_path,
-                fourcc,
-                target_params['fps'],
-                (new_width, new_height)
-            )
+            fps = target_params['fps']
+            max_frames = int(fps * target_params['max_duration'])
+            if not 0 < source_fps < 1000:
+                # Unknown frame rate, assume it matches the target
+                source_fps = fps
+            
+            # Source frame shown at each output timestamp
+            wanted = []
+            for output_index in range(max_frames):
+                source_index = int(output_index * source_fps / fps + 1e-6)
+                if source_frames > 0 and source_index >= source_frames:
+                    break
+                wanted.append(source_index)
+            selected = sorted(set(wanted))
+            logger.info(f"Selected {len(selected)} source frames for {len(wanted)} output frames")
             
+            # Decode and resize selected frames once, every encode attempt
+            # reuses the buffer. Skipped frames are only grabbed, not decoded.
+            frames = self._allocate_frames(len(selected), new_height, new_width)
             frame_count = 0
-            max_frames = int(target_params['fps'] * target_params['max_duration'])
-            logger.info(f"Processing frames (max {max_frames} frames)")
-            
-            # Process each frame
-            while cap.isOpened() and frame_count < max_frames:
+            position = 0
+            decode_start = time.perf_counter()
+            resize_time = 0.0
+            for source_index in selected:
+                while position < source_index and cap.grab():
+                    position += 1
+                if position < source_index:
+                    break
+                
                 ret, frame = cap.read()
                 if not ret:
                     break
+                position += 1
                 
-                # Resize frame
-                frame = cv2.resize(frame, (new_width, new_height))
-                out.write(frame)
+                resize_start = time.perf_counter()
+                cv2.resize(frame, (new_width, new_height), dst=frames[frame_count])
+                resize_time += time.perf_counter() - resize_start
                 frame_count += 1
+            frames = frames[:frame_count]
+            self.stage_times['resize'] = self.stage_times.get('resize', 0.0) + resize_time
+            self._add_stage_time('decode', decode_start + resize_time)
             
             logger.info(f"Processed {frame_count} frames")
             
             # Freeing up resources
             cap.release()
-            out.release()
             
-            # Check the file size and reduce the bitrate if necessary
-            initial_size = os.path.getsize(output_path) / 1024
-            logger.info(f"Initial file size: {initial_size:.2f}KB")
+            if not frame_count:
+                raise ValueError("No frames decoded from video")
             
-            while os.path.getsize(output_path) / 1024 > target_params['max_size']:
-                # Reduce bitrate by 20% at each iteration
-                bitrate = int(os.path.getsize(output_path) * 0.8)
-                logger.info(f"Reducing bitrate to {bitrate} bytes")
-                
-                cap = cv2.VideoCapture(self.file_path)
-                out = cv2.VideoWriter(
-                    output_path,
-                    fourcc,
-                    target_params['fps'],
-                    (new_width, new_height),
-                    params=[
-                        cv2.VIDEOWRITER_PROP_QUALITY, 95,
-                        cv2.VIDEOWRITER_PROP_BITRATE, bitrate
-                    ]
-                )
-                
-                frame_count = 0
-                while cap.isOpened() and frame_count < max_frames:
-                    ret, frame = cap.read()
-                    if not ret:
-                        break
-                    
-                    frame = cv2.resize(frame, (new_width, new_height))
-                    out.write(frame)
-                    frame_count += 1
-                
-                cap.release()
-                out.release()
-                
-                current_size = os.path.getsize(output_path) / 1024
-                logger.info(f"Current file size: {current_size:.2f}KB")
+            slots = {source_index: slot for slot, source_index in enumerate(selected[:frame_count])}
+            timeline = [slots[source_index] for source_index in wanted if source_index in slots]
             
-            final_size = os.path.getsize(output_path) / 1024
-            logger.info(f"Final file size: {final_size:.2f}KB")
+            self._encode_to_limit(frames, timeline, output_path, target_params)
             return output_path
             
         except Exception as e:
@@ -405,8 +481,22 @@ class MediaProcessor:
             logger.error(f"Traceback:\n{traceback.format_exc()}")
             return self.file_path
     
+    def _check_output(self, output_path: str) -> str:
+        """Raise if conversion failed, warn if the processed file still doesn't fit the size limit"""
+        # The processing steps log their error and hand back the source
+        if output_path == self.file_path:
+            raise MediaProcessingError("The file could not be converted, it may be damaged")
+        max_size = self.get_target_params()['max_size']
+        output_size = os.path.getsize(output_path) / 1024
+        if output_size > max_size:
+            logger.warning(f"Processed file is {output_size:.2f}KB, over the {max_size}KB limit")
+        return output_path
+
     def process(self) -> tuple[str, bool]:
-        """Process media file and return path to processed file and whether it was modified"""
+        """Process media file and return path to processed file and whether it was modified
+
+        Raises MediaProcessingError when the file needs converting but can't be.
+        """
         try:
             logger.info("Starting process method")
             # Checking supported formats
@@ -431,32 +521,45 @@ class MediaProcessor:
                 logger.info("Format conversion needed or file is animated")
                 if self.is_animated:
                     logger.info("Processing animated file")
-                    return self.process_animated(), True
+                    return self._check_output(self.process_animated()), True
                 else:
                     logger.info("Processing static image for format conversion")
-                    return self.process_static_image(), True
+                    with Image.open(self.file_path) as img:
+                        return self._check_output(self.process_static_image(img)), True
             
-            # For static images, first check and adjust resolution if needed
+            # For static images, first check and adjust resolution if needed.
+            # Opening reads only the header, the same handle is decoded if processing is needed.
             if not self.is_animated:
-                img = Image.open(self.file_path)
-                width, height = img.size
-                max_side = max(width, height)
-                target_size = target_params['width']
-                
-                if max_side != target_size:
-                    logger.info("Resolution adjustment needed")
-                    return self.process_static_image(), True
-                
-                # If resolution is correct, check file size
-                if not self.check_size_requirements():
-                    logger.info("File needs optimization for size")
-                    return self.process_static_image(), True
+                with Image.open(self.file_path) as img:
+                    width, height = img.size
+                    max_side = max(width, height)
+                    target_size = target_params['width']
+                    
+                    if max_side != target_size:
+                        logger.info("Resolution adjustment needed")
+                        return self._check_output(self.process_static_image(img)), True
+                    
+                    # If resolution is correct, check file size
+                    if not self.check_size_requirements():
+                        logger.info("File needs optimization for size")
+                        return self._check_output(self.process_static_image(img)), True
             
             logger.info("No processing needed")
             return self.file_path, False
             
+        except MediaProcessingError:
+            raise
         except Exception as e:
             logger.error(f"Error in process method: {str(e)}")
             import traceback
             logger.error(f"Process method traceback: {traceback.format_exc()}")
-            return self.file_path, False 
\ No newline at end of file
+            # Errors may name the scratch paths of the file or its result,
+            # users only know the file name
+            message = str(e).replace(os.path.dirname(self.file_path) + os.sep, "")
+            raise MediaProcessingError(message) from e
+
+
+if __name__ == "__main__":
+    import sys
+    from utils.batch_convert import main
+    sys.exit(main())
@@ -0,0 +1,269 @@
+import logging
+import math
+from typing import Callable, Optional
+
+from aiohttp import web
+
+logger = logging.getLogger(__name__)
+
+# Bucket upper bounds in seconds, from fast static images to slow video encodes
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+# Actual usage divided by the prediction, above 1 the prediction was too low
+RATIO_BUCKETS = (0.25, 0.5, 0.75, 0.9, 1, 1.1, 1.25, 1.5, 2, 4)
+# Bucket upper bounds in bytes, around the 64 KB, 100 KB, 256 KB and 512 KB size limits
+SIZE_BUCKETS = tuple(kilobytes * 1024 for kilobytes in (16, 32, 64, 100, 128, 192, 256, 384, 512, 1024))
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def _escape(value: str) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(labels: dict) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in labels.items()) + "}"
+
+
+def _format_value(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    type = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self._values = {}
+        REGISTRY.append(self)
+
+    def _key(self, labels: dict) -> tuple:
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name} expects labels {self.labelnames}, got {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def _samples(self):
+        """Yield (suffix, labels, value) for the exposition format"""
+        for key, value in sorted(self._values.items()):
+            yield "", dict(zip(self.labelnames, key)), value
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type}"]
+        for suffix, labels, value in self._samples():
+            lines.append(f"{self.name}{suffix}{_format_labels(labels)} {_format_value(value)}")
+        return "\n".join(lines)
+
+
+class Counter(_Metric):
+    """Value that only goes up"""
+    type = "counter"
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    """Value that goes up and down, or is read from a function when scraped"""
+    type = "gauge"
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = (),
+                 function: Optional[Callable[[], float]] = None):
+        super().__init__(name, documentation, labelnames)
+        self.function = function
+
+    def set(self, value: float, **labels):
+        self._values[self._key(labels)] = value
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount: float = 1, **labels):
+        self.inc(-amount, **labels)
+
+    def _samples(self):
+        if self.function is not None:
+            try:
+                self._values[()] = self.function()
+            except Exception as e:
+                logger.warning(f"Failed to read gauge {self.name}: {e}")
+        yield from super()._samples()
+
+
+class Histogram(_Metric):
+    """Distribution of observed values in cumulative buckets"""
+    type = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = (),
+                 buckets: tuple = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets) + (math.inf,)
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        state = self._values.get(key)
+        if state is None:
+            state = self._values[key] = {'counts': [0] * len(self.buckets), 'sum': 0.0, 'count': 0}
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                state['counts'][index] += 1
+                break
+        state['sum'] += value
+        state['count'] += 1
+
+    def _samples(self):
+        for key, state in sorted(self._values.items()):
+            labels = dict(zip(self.labelnames, key))
+            cumulative = 0
+            for bound, count in zip(self.buckets, state['counts']):
+                cumulative += count
+                yield "_bucket", {**labels, 'le': _format_value(bound)}, cumulative
+            yield "_sum", labels, state['sum']
+            yield "_count", labels, state['count']
+
+
+# Every metric created registers itself here and is rendered in order
+REGISTRY: list[_Metric] = []
+
+
+def render() -> str:
+    """All metrics in the Prometheus text exposition format"""
+    return "\n".join(metric.render() for metric in REGISTRY) + "\n"
+
+
+# Set once the process has warmed up and takes work, see readiness_handler
+_ready = False
+
+
+def set_ready(ready: bool = True):
+    """Mark the process as ready, or not, for the readiness probe"""
+    global _ready
+    _ready = ready
+
+
+JOBS = Counter(
+    "sticker_jobs_total", "Media jobs by mode, media type and outcome",
+    ("mode", "type", "outcome")
+)
+JOBS_IN_FLIGHT = Gauge("sticker_jobs_in_flight", "Media jobs being downloaded, processed or sent")
+DOWNLOAD_SECONDS = Histogram("sticker_download_seconds", "Time to download a file from Telegram")
+UPLOAD_SECONDS = Histogram("sticker_upload_seconds", "Time to send results to Telegram")
+STAGE_SECONDS = Histogram(
+    "sticker_stage_seconds", "Time spent per processing stage in a worker",
+    ("stage",)
+)
+ENCODE_ATTEMPT_SECONDS = Histogram("sticker_encode_attempt_seconds", "Time of a single encode attempt")
+ENCODE_RETRIES = Counter(
+    "sticker_encode_retries_total", "Encode attempts beyond the first one, to fit the size limit",
+    ("mode",)
+)
+RESULTS = Counter(
+    "sticker_results_total", "Processed files by whether they had to be modified",
+    ("mode", "modified")
+)
+RESULT_BYTES = Histogram(
+    "sticker_result_bytes", "Size of the files the workers produced",
+    ("mode",), buckets=SIZE_BUCKETS
+)
+CACHE_LOOKUPS = Counter(
+    "sticker_cache_lookups_total", "Result cache lookups of jobs by result, hit or miss",
+    ("result",)
+)
+READY = Gauge("sticker_ready", "1 once the media workers are warmed up and work is taken", function=lambda: int(_ready))
+WORKER_PENDING = Gauge("sticker_worker_pending", "Jobs running or waiting in the worker pool")
+# Read from the scratch space of the process, see ScratchSpace.usage
+TEMP_DISK_BYTES = Gauge(
+    "sticker_temp_disk_bytes", "Scratch disk reserved by running jobs and used by other processes sharing it"
+)
+# Set by the worker pool, see MemoryBudget
+MEMORY_BUDGET_BYTES = Gauge("sticker_memory_budget_bytes", "Memory the media workers may reserve for jobs")
+MEMORY_RESERVED_BYTES = Gauge("sticker_memory_reserved_bytes", "Predicted memory of the jobs being processed")
+MEMORY_WAIT_SECONDS = Histogram("sticker_memory_wait_seconds", "Time a job waited for memory before decoding")
+MEMORY_PREDICTION_RATIO = Histogram(
+    "sticker_memory_prediction_ratio", "Peak memory of a job divided by its predicted memory",
+    ("kind",), buckets=RATIO_BUCKETS
+)
+CPU_PREDICTION_RATIO = Histogram(
+    "sticker_cpu_prediction_ratio", "CPU time of a job divided by its predicted CPU time",
+    ("kind",), buckets=RATIO_BUCKETS
+)
+
+
+def mode_label(is_sticker: bool) -> str:
+    return "sticker" if is_sticker else "emoji"
+
+
+def count_job(is_sticker: bool, plan, outcome: str):
+    """Count a finished job of a JobPlan by its outcome"""
+    if plan.is_archive:
+        media_type = "archive"
+    elif plan.is_animated is None:
+        # Only GIFs are planned without knowing if they are animated
+        media_type = "gif"
+    else:
+        media_type = "animated" if plan.is_animated else "static"
+    JOBS.inc(mode=mode_label(is_sticker), type=media_type, outcome=outcome)
+
+
+def observe_processing(is_sticker: bool, was_modified: bool, stats: dict):
+    """Record the stats a worker returned for a processed file"""
+    mode = mode_label(is_sticker)
+    RESULTS.inc(mode=mode, modified=str(was_modified).lower())
+    for stage, seconds in stats.get('stage_times', {}).items():
+        STAGE_SECONDS.observe(seconds, stage=stage)
+    for seconds in stats.get('encode_times', []):
+        ENCODE_ATTEMPT_SECONDS.observe(seconds)
+    if stats.get('encode_attempts', 0) > 1:
+        ENCODE_RETRIES.inc(stats['encode_attempts'] - 1, mode=mode)
+    if stats.get('final_size') is not None:
+        RESULT_BYTES.observe(stats['final_size'], mode=mode)
+
+    admission = stats.get('admission')
+    if admission:
+        MEMORY_WAIT_SECONDS.observe(admission['memory_wait'])
+        if admission['peak_memory'] is not None and admission['predicted_memory']:
+            MEMORY_PREDICTION_RATIO.observe(
+                admission['peak_memory'] / admission['predicted_memory'], kind=admission['kind']
+            )
+        if admission['predicted_cpu']:
+            CPU_PREDICTION_RATIO.observe(admission['cpu_seconds'] / admission['predicted_cpu'], kind=admission['kind'])
+
+
+async def metrics_handler(request: web.Request) -> web.Response:
+    """Serve all metrics for scraping"""
+    return web.Response(body=render().encode('utf-8'), headers={'Content-Type': CONTENT_TYPE})
+
+
+async def readiness_handler(request: web.Request) -> web.Response:
+    """Readiness probe, fails until the process has warmed up"""
+    if _ready:
+        return web.Response(text="ready")
+    return web.Response(status=503, text="warming up")
+
+
+async def start_metrics_server(host: str, port: int, path: str,
+                               readiness_path: Optional[str] = None) -> Optional[web.AppRunner]:
+    """Serve metrics, and the readiness probe if a path is given, on a separate HTTP server
+
+    Returns the server runner to clean up.
+    """
+    app = web.Application()
+    app.router.add_get(path, metrics_handler)
+    if readiness_path:
+        app.router.add_get(readiness_path, readiness_handler)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    try:
+        await web.TCPSite(runner, host, port).start()
+    except OSError as e:
+        logger.error(f"Failed to start metrics server on {host}:{port}: {e}")
+        await runner.cleanup()
+        return None
+    logger.info(f"Metrics server listening on {host}:{port}{path}")
+    return runner
@@ -0,0 +1,271 @@
+import asyncio
+import itertools
+import logging
+import time
+from typing import Any, Optional
+
+from aiogram import Bot
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware, NextRequestMiddlewareType
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.methods import (
+    TelegramMethod,
+    SendDocument,
+    SendMediaGroup,
+    SendMessage,
+    EditMessageText,
+    EditMessageCaption,
+    DeleteMessage
+)
+
+from utils.metrics import Counter, Gauge, Histogram
+
+logger = logging.getLogger(__name__)
+
+# Lower values are sent first: results, then replies, then status updates
+PRIORITY_RESULT = 0
+PRIORITY_REPLY = 1
+PRIORITY_STATUS = 2
+
+RESULT_METHODS = (SendDocument, SendMediaGroup)
+STATUS_METHODS = (EditMessageText, EditMessageCaption, DeleteMessage)
+# A waiting edit is dropped when a newer edit or a delete of the same message comes in
+EDIT_METHODS = (EditMessageText, EditMessageCaption)
+
+# The global rate halves on every flood error and recovers by this share of
+# the configured rate with every successful request
+RATE_RECOVERY = 0.02
+MIN_RATE_SHARE = 0.1
+
+# Chat buckets are forgotten once there are this many and they are full again
+MAX_IDLE_BUCKETS = 10000
+
+RETRY_AFTER = Counter(
+    "sticker_outbound_retry_after_total", "Requests Telegram asked to repeat later",
+    ("method",)
+)
+COALESCED = Counter("sticker_outbound_coalesced_total", "Status edits replaced by a newer one before sending")
+WAIT_SECONDS = Histogram("sticker_outbound_wait_seconds", "Time a request waited for its send slot")
+
+
+class TokenBucket:
+    """Allows rate requests per second on average and bursts of up to burst requests"""
+
+    def __init__(self, rate: float, burst: float):
+        self.base_rate = rate
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+
+    def _refill(self, now: float):
+        # A bucket created during a dispatch round is newer than the round's now
+        if now > self.updated:
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+
+    def delay(self, cost: float, now: float) -> float:
+        """Seconds until a request of cost can be sent"""
+        self._refill(now)
+        # Requests larger than the burst put the bucket in debt instead of waiting forever
+        missing = min(cost, self.burst) - self.tokens
+        return max(self.paused_until - now, missing / self.rate if missing > 0 else 0.0)
+
+    def take(self, cost: float, now: float):
+        self._refill(now)
+        self.tokens -= cost
+
+    def pause(self, seconds: float, now: float):
+        """Send nothing for seconds, after Telegram asked to retry later"""
+        self.paused_until = max(self.paused_until, now + seconds)
+        self.tokens = min(self.tokens, 0)
+
+    def is_idle(self, now: float) -> bool:
+        self._refill(now)
+        return self.tokens >= self.burst and self.paused_until <= now
+
+
+class _Superseded(Exception):
+    """A waiting edit was replaced, its caller gets the newer request's result"""
+
+    def __init__(self, result: asyncio.Future):
+        self.result = result
+
+
+class _Waiter:
+    def __init__(self, priority: int, sequence: int, chat_id: Any, cost: int, key: Optional[tuple]):
+        self.order = (priority, sequence)
+        self.chat_id = chat_id
+        self.cost = cost
+        self.key = key
+        self.created = time.monotonic()
+        self.granted = asyncio.get_running_loop().create_future()
+
+
+class OutboundScheduler(BaseRequestMiddleware):
+    """Paces messages sent to Telegram below its flood limits
+
+    Installed as a request middleware of the bot session, so every send,
+    edit and delete waits for a slot in the global and the per-chat token
+    bucket. Results are sent before replies and status updates. When
+    Telegram still answers with retry_after, the chat is paused, the
+    global rate is lowered and the request is repeated, so results are
+    never lost to rate limiting.
+    """
+
+    def __init__(self, global_rate: float, chat_rate: float, chat_burst: int,
+                 group_rate: float, max_retries: int):
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.group_rate = group_rate
+        self.max_retries = max_retries
+        self._global = TokenBucket(global_rate, global_rate)
+        self._chats: dict[Any, TokenBucket] = {}
+        self._waiting: list[_Waiter] = []
+        self._edits: dict[tuple, _Waiter] = {}
+        self._sequence = itertools.count()
+        self._wake: Optional[asyncio.Event] = None
+        self._dispatcher: Optional[asyncio.Task] = None
+        Gauge("sticker_outbound_waiting", "Requests waiting for a send slot", function=lambda: len(self._waiting))
+
+    async def __call__(self, make_request: NextRequestMiddlewareType, bot: Bot, method: TelegramMethod):
+        chat_id = getattr(method, 'chat_id', None)
+        if chat_id is None or not isinstance(method, RESULT_METHODS + (SendMessage,) + STATUS_METHODS):
+            return await make_request(bot, method)
+
+        # Shared with the edits this request replaces, across its retries
+        result = asyncio.get_running_loop().create_future()
+        try:
+            response = await self._send(make_request, bot, method, chat_id, result)
+        except asyncio.CancelledError:
+            result.cancel()
+            raise
+        except Exception as e:
+            if not result.done():
+                result.set_exception(e)
+                # Nobody may be waiting for it, don't warn about an unretrieved exception
+                result.exception()
+            raise
+        if not result.done():
+            result.set_result(response)
+        return response
+
+    async def _send(self, make_request: NextRequestMiddlewareType, bot: Bot, method: TelegramMethod,
+                    chat_id: Any, result: asyncio.Future):
+        for attempt in range(self.max_retries + 1):
+            waiter = self._enqueue(method, chat_id, result)
+            try:
+                await waiter.granted
+            except _Superseded as superseded:
+                return await superseded.result
+            finally:
+                self._forget(waiter)
+            WAIT_SECONDS.observe(time.monotonic() - waiter.created)
+
+            try:
+                response = await make_request(bot, method)
+            except TelegramRetryAfter as e:
+                RETRY_AFTER.inc(method=type(method).__name__)
+                self._on_retry_after(chat_id, e.retry_after)
+                if attempt == self.max_retries:
+                    raise
+                logger.warning(f"Flood limit for chat {chat_id}, retrying {type(method).__name__} in {e.retry_after}s")
+                continue
+
+            self._global.rate = min(self._global.base_rate, self._global.rate + self._global.base_rate * RATE_RECOVERY)
+            return response
+
+    def _enqueue(self, method: TelegramMethod, chat_id: Any, result: asyncio.Future) -> _Waiter:
+        if isinstance(method, RESULT_METHODS):
+            priority = PRIORITY_RESULT
+        elif isinstance(method, STATUS_METHODS):
+            priority = PRIORITY_STATUS
+        else:
+            priority = PRIORITY_REPLY
+        # Telegram counts every file of a media group as a message
+        cost = len(method.media) if isinstance(method, SendMediaGroup) else 1
+        key = None
+        if isinstance(method, STATUS_METHODS) and getattr(method, 'message_id', None) is not None:
+            key = (chat_id, method.message_id)
+
+        waiter = _Waiter(priority, next(self._sequence), chat_id, cost, key)
+        if key is not None:
+            replaced = self._edits.get(key)
+            if replaced is not None and not replaced.granted.done():
+                COALESCED.inc()
+                replaced.granted.set_exception(_Superseded(result))
+            if isinstance(method, EDIT_METHODS):
+                self._edits[key] = waiter
+        self._waiting.append(waiter)
+        self._notify()
+        return waiter
+
+    def _forget(self, waiter: _Waiter):
+        if waiter in self._waiting:
+            self._waiting.remove(waiter)
+        if waiter.key is not None and self._edits.get(waiter.key) is waiter:
+            del self._edits[waiter.key]
+
+    def _on_retry_after(self, chat_id: Any, retry_after: float):
+        now = time.monotonic()
+        self._chat_bucket(chat_id).pause(retry_after, now)
+        self._global.rate = max(self._global.rate / 2, self._global.base_rate * MIN_RATE_SHARE)
+
+    def _chat_bucket(self, chat_id: Any) -> TokenBucket:
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            # Group chats have negative IDs and a much lower limit
+            is_group = isinstance(chat_id, str) or chat_id < 0
+            rate = self.group_rate if is_group else self.chat_rate
+            bucket = self._chats[chat_id] = TokenBucket(rate, self.chat_burst)
+        return bucket
+
+    def _notify(self):
+        if self._dispatcher is None or self._dispatcher.done():
+            self._wake = asyncio.Event()
+            self._dispatcher = asyncio.create_task(self._dispatch())
+        self._wake.set()
+
+    async def _dispatch(self):
+        """Grant send slots in priority order as the buckets allow"""
+        while True:
+            self._wake.clear()
+            timeout = self._grant()
+            if len(self._chats) > MAX_IDLE_BUCKETS:
+                now = time.monotonic()
+                waiting_chats = {waiter.chat_id for waiter in self._waiting}
+                for chat_id in [chat_id for chat_id, bucket in self._chats.items()
+                                if chat_id not in waiting_chats and bucket.is_idle(now)]:
+                    del self._chats[chat_id]
+            try:
+                await asyncio.wait_for(self._wake.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    def _grant(self) -> Optional[float]:
+        """Grant every request that can be sent now, returns seconds until the next one can"""
+        now = time.monotonic()
+        next_delay = None
+        blocked_chats = set()
+        for waiter in sorted(self._waiting, key=lambda waiter: waiter.order):
+            if waiter.granted.done() or waiter.chat_id in blocked_chats:
+                continue
+            chat_bucket = self._chat_bucket(waiter.chat_id)
+            global_delay = self._global.delay(waiter.cost, now)
+            chat_delay = chat_bucket.delay(waiter.cost, now)
+            if global_delay <= 0 and chat_delay <= 0:
+                self._global.take(waiter.cost, now)
+                chat_bucket.take(waiter.cost, now)
+                waiter.granted.set_result(None)
+                continue
+
+            if chat_delay > 0:
+                # Other chats may go ahead, later requests to this chat keep their order
+                blocked_chats.add(waiter.chat_id)
+                delay = max(chat_delay, global_delay)
+                next_delay = delay if next_delay is None else min(next_delay, delay)
+                continue
+            # Only the global limit holds it back, nothing of lower priority may take the slot
+            next_delay = global_delay if next_delay is None else min(next_delay, global_delay)
+            break
+        return next_delay
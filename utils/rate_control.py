@@ -0,0 +1,120 @@
+import logging
+import math
+from typing import NamedTuple, Optional
+
+from config import RATE_CONTROL_MAX_ATTEMPTS, RATE_CONTROL_MARGIN
+
+logger = logging.getLogger(__name__)
+
+MIN_BITRATE = 16_000  # bits per second
+MAX_FPS_DIVISOR = 3  # 30 fps -> 10 fps at most
+MIN_SCALE = 0.25
+
+# Default exponents of size ~ value ** exponent, used until attempts
+# give enough data to fit them
+DEFAULT_EXPONENTS = {
+    'bitrate': 1.0,
+    'scale': 2.0,
+}
+
+
+class EncodeSettings(NamedTuple):
+    bitrate: Optional[int]  # bits per second, None lets the encoder decide
+    scale: float  # Factor applied to frame dimensions
+    fps_divisor: int  # Keep every n-th frame
+
+
+class RateController:
+    """Pick encode settings that land under a size limit in few attempts
+
+    The first attempt targets the bitrate that fits the limit over the
+    clip duration. Later attempts correct it with a size model fitted from
+    previous attempts. When the encoder has no bitrate control, or ignores
+    it, the frame rate and then the resolution are lowered instead.
+    """
+
+    def __init__(self, max_bytes: int, duration: float, supports_bitrate: bool,
+                 max_attempts: int = RATE_CONTROL_MAX_ATTEMPTS):
+        self.max_bytes = max_bytes
+        self.target_bytes = max_bytes * RATE_CONTROL_MARGIN
+        self.max_attempts = max_attempts
+        self.history: list[tuple[EncodeSettings, int]] = []
+
+        bitrate = None
+        if supports_bitrate:
+            bitrate = max(int(self.target_bytes * 8 / max(duration, 0.1)), MIN_BITRATE)
+        self._settings = EncodeSettings(bitrate=bitrate, scale=1.0, fps_divisor=1)
+
+    @property
+    def attempts(self) -> int:
+        """Number of finished encode attempts"""
+        return len(self.history)
+
+    @property
+    def fits(self) -> bool:
+        """Whether the last attempt is within the size limit"""
+        return bool(self.history) and self.history[-1][1] <= self.max_bytes
+
+    def first(self) -> EncodeSettings:
+        """Settings for the first attempt"""
+        return self._settings
+
+    def next(self, size: int) -> Optional[EncodeSettings]:
+        """Record the size of the last attempt and get settings for the next one
+
+        Returns None when the result fits or no more attempts should be made.
+        """
+        self.history.append((self._settings, size))
+        if self.fits or self.attempts >= self.max_attempts:
+            return None
+
+        settings = self._settings
+        ratio = self.target_bytes / size
+        if settings.bitrate is not None and not self._bitrate_ignored():
+            bitrate = int(settings.bitrate * self._factor('bitrate', ratio))
+            if bitrate >= MIN_BITRATE:
+                self._settings = settings._replace(bitrate=bitrate)
+                return self._settings
+
+        # Drop frames first, size is roughly proportional to the frame count
+        fps_divisor = settings.fps_divisor
+        if fps_divisor < MAX_FPS_DIVISOR:
+            fps_divisor = min(MAX_FPS_DIVISOR, math.ceil(fps_divisor / ratio))
+            ratio *= fps_divisor / settings.fps_divisor
+
+        # Lower the resolution if dropping frames is not enough
+        scale = settings.scale
+        if ratio < 1:
+            scale *= self._factor('scale', ratio)
+            if scale < MIN_SCALE:
+                return None
+            logger.warning(f"Reducing resolution to {scale:.0%} to fit the size limit")
+
+        self._settings = settings._replace(fps_divisor=fps_divisor, scale=scale)
+        return self._settings
+
+    def _bitrate_ignored(self) -> bool:
+        """Check if the encoder didn't react to the last bitrate change"""
+        if len(self.history) < 2:
+            return False
+        (previous, previous_size), (last, last_size) = self.history[-2:]
+        if previous.bitrate is None or last.bitrate is None:
+            return False
+        return last.bitrate < previous.bitrate * 0.85 and last_size > previous_size * 0.95
+
+    def _factor(self, lever: str, ratio: float) -> float:
+        """Factor for a setting that should change the size by ratio"""
+        exponent = DEFAULT_EXPONENTS[lever]
+
+        # Fit the exponent from the last two attempts that only differ in this setting
+        if len(self.history) >= 2:
+            (previous, previous_size), (last, last_size) = self.history[-2:]
+            if previous._replace(**{lever: getattr(last, lever)}) == last:
+                value_ratio = getattr(last, lever) / getattr(previous, lever)
+                if value_ratio != 1 and previous_size and last_size:
+                    fitted = math.log(last_size / previous_size) / math.log(value_ratio)
+                    if 0.2 <= fitted <= 4:
+                        exponent = fitted
+
+        factor = ratio ** (1 / exponent)
+        return min(max(factor, 0.3), 0.95)
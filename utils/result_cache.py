@@ -0,0 +1,153 @@
+import hashlib
+import json
+import logging
+import os
+import shutil
+import sqlite3
+import time
+from typing import NamedTuple, Optional
+
+from utils.metrics import CACHE_LOOKUPS
+from utils.targets import get_target_params
+
+logger = logging.getLogger(__name__)
+
+
+class CachedResult(NamedTuple):
+    path: str
+    file_name: str
+    file_id: Optional[str]
+    was_modified: bool
+
+
+class ResultCache:
+    """Disk cache of processed files with LRU eviction
+
+    Entries are keyed by the Telegram file_unique_id of the source and the
+    target profile, so the same meme sent again is answered without
+    downloading or processing it. The file_id of the document we sent is
+    stored too, which lets a hit be resent without uploading anything.
+    """
+
+    def __init__(self, directory: str, max_bytes: int):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+
+        os.makedirs(directory, exist_ok=True)
+        # The bot and queue workers share the index, WAL lets them read while
+        # one of them writes and the timeout waits out the writer
+        self._db = sqlite3.connect(os.path.join(directory, "index.sqlite3"), timeout=30)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS results ("
+            "key TEXT PRIMARY KEY, file_name TEXT NOT NULL, size INTEGER NOT NULL, "
+            "file_id TEXT, was_modified INTEGER NOT NULL, last_used REAL NOT NULL)"
+        )
+        self._db.commit()
+
+    @staticmethod
+    def make_key(file_unique_id: str, is_sticker: bool) -> str:
+        """Build cache key from the source file and the target profile"""
+        # Target parameters are part of the key, so changing the limits
+        # in config.py doesn't serve results made for the old ones
+        profile = json.dumps([
+            get_target_params(is_sticker, is_animated=False),
+            get_target_params(is_sticker, is_animated=True)
+        ], sort_keys=True)
+        return hashlib.sha256(f"{file_unique_id}:{profile}".encode()).hexdigest()
+
+    def _path(self, key: str, file_name: str) -> str:
+        return os.path.join(self.directory, key + os.path.splitext(file_name)[1])
+
+    def get(self, key: str) -> Optional[CachedResult]:
+        """Look up a processed file, counted as a hit or a miss
+
+        Call it once per job, later lookups of the same job use peek().
+        """
+        cached = self.peek(key)
+        if cached:
+            self.hits += 1
+            CACHE_LOOKUPS.inc(result="hit")
+        else:
+            self.misses += 1
+            CACHE_LOOKUPS.inc(result="miss")
+        return cached
+
+    def peek(self, key: str) -> Optional[CachedResult]:
+        """Look up a processed file without counting the lookup"""
+        row = self._db.execute(
+            "SELECT file_name, file_id, was_modified FROM results WHERE key = ?", (key,)
+        ).fetchone()
+
+        if row is not None:
+            file_name, file_id, was_modified = row
+            path = self._path(key, file_name)
+            if os.path.exists(path):
+                self._db.execute("UPDATE results SET last_used = ? WHERE key = ?", (time.time(), key))
+                self._db.commit()
+                return CachedResult(path, file_name, file_id, bool(was_modified))
+
+            # The file was removed behind our back
+            self._db.execute("DELETE FROM results WHERE key = ?", (key,))
+            self._db.commit()
+        return None
+
+    def put(self, key: str, result_path: str, was_modified: bool, file_id: Optional[str] = None):
+        """Store a processed file"""
+        file_name = os.path.basename(result_path)
+        path = self._path(key, file_name)
+        # A cached file is stored again when it got a new file_id
+        if os.path.abspath(result_path) != os.path.abspath(path):
+            shutil.copyfile(result_path, path)
+
+        self._db.execute(
+            "INSERT OR REPLACE INTO results (key, file_name, size, file_id, was_modified, last_used) "
+            "VALUES (?, ?, ?, ?, ?, ?)",
+            (key, file_name, os.path.getsize(path), file_id, int(was_modified), time.time())
+        )
+        self._db.commit()
+        self._evict()
+
+    def forget_file_id(self, key: str):
+        """Drop a file_id that Telegram no longer accepts"""
+        self._db.execute("UPDATE results SET file_id = NULL WHERE key = ?", (key,))
+        self._db.commit()
+
+    def _evict(self):
+        """Remove least recently used entries until the cache fits its size limit"""
+        total = self._db.execute("SELECT COALESCE(SUM(size), 0) FROM results").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+
+        rows = self._db.execute("SELECT key, file_name, size FROM results ORDER BY last_used").fetchall()
+        for key, file_name, size in rows:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(self._path(key, file_name))
+            except FileNotFoundError:
+                pass
+            self._db.execute("DELETE FROM results WHERE key = ?", (key,))
+            total -= size
+            logger.info(f"Evicted cached result {key}")
+        self._db.commit()
+
+    def stats(self) -> dict:
+        """Get cache counters"""
+        entries, size = self._db.execute(
+            "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM results"
+        ).fetchone()
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+            'entries': entries,
+            'size': size
+        }
+
+    def close(self):
+        """Close the cache index"""
+        self._db.close()
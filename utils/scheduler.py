@@ -0,0 +1,257 @@
+import asyncio
+import heapq
+import logging
+import time
+from collections import deque
+from typing import Awaitable, Callable, Optional
+
+logger = logging.getLogger(__name__)
+
+JobFactory = Callable[[], Awaitable[None]]
+StatusCallback = Callable[[int, int, int], Awaitable[None]]
+
+
+class SchedulerBusy(Exception):
+    """Raised when the scheduler can't accept more jobs"""
+
+
+class ChatQueueFull(SchedulerBusy):
+    """Raised when a chat has too many queued jobs"""
+
+
+class _Job:
+    __slots__ = ('chat_id', 'run', 'cost', 'slots', 'files')
+
+    def __init__(self, chat_id: int, run: JobFactory, cost: float, slots: int, files: int):
+        self.chat_id = chat_id
+        self.run = run
+        self.cost = cost
+        self.slots = slots
+        self.files = files
+
+
+class _ChatStatus:
+    __slots__ = ('last_status', 'last_update', 'notify_task')
+
+    def __init__(self):
+        self.last_status = None
+        self.last_update = 0.0
+        self.notify_task = None
+
+
+class FairScheduler:
+    """Weighted-fair scheduler over per-chat job queues
+
+    Every chat accumulates the cost of the jobs it has been served, and
+    the next free slot goes to the waiting chat with the lowest total.
+    A user sending a large batch only competes with other users one job
+    at a time, so light users don't wait behind the whole batch.
+
+    A job that runs several files at once, like an album, takes that many
+    slots of the global and the per-chat limits while it runs.
+
+    on_status is called per chat with the number of files waiting and the
+    queue position of the next one, at most once per update_interval, and
+    with zeros once nothing of the chat waits anymore.
+    """
+
+    def __init__(self, max_concurrent: int, max_per_chat: int,
+                 max_queued: int, max_queued_per_chat: int,
+                 update_interval: float, on_status: Optional[StatusCallback] = None):
+        self.max_concurrent = max_concurrent
+        self.max_per_chat = max_per_chat
+        self.max_queued = max_queued
+        self.max_queued_per_chat = max_queued_per_chat
+        self.update_interval = update_interval
+        self.on_status = on_status
+
+        self._queues: dict[int, deque[_Job]] = {}
+        self._running: dict[int, int] = {}  # Slots taken per chat
+        self._served: dict[int, float] = {}
+        self._active = 0
+        self._used_slots = 0
+        self._queued = 0
+        self._status: dict[int, _ChatStatus] = {}
+        self._flush_handle: Optional[asyncio.TimerHandle] = None
+        self._tasks = set()
+
+    @property
+    def active(self) -> int:
+        """Number of running jobs"""
+        return self._active
+
+    @property
+    def queued(self) -> int:
+        """Number of jobs waiting to run"""
+        return self._queued
+
+    def job_slots(self, files: int) -> int:
+        """Slots a job of this many files takes, the files run at most this many at a time"""
+        return max(1, min(files, self.max_per_chat, self.max_concurrent))
+
+    def submit(self, chat_id: int, run: JobFactory, cost: float = 1.0,
+               slots: int = 1, files: int = 1):
+        """Queue a job for a chat
+
+        slots is the number of files the job runs at once, see job_slots(),
+        files the number it reports as waiting.
+        """
+        if self._queued >= self.max_queued:
+            raise SchedulerBusy(f"Scheduler queue is full ({self._queued} jobs)")
+
+        queue = self._queues.get(chat_id)
+        if queue is not None and len(queue) >= self.max_queued_per_chat:
+            raise ChatQueueFull(f"Chat {chat_id} has {len(queue)} queued jobs")
+
+        if queue is None:
+            queue = self._queues[chat_id] = deque()
+        if chat_id not in self._served:
+            # New chats start level with the least served active chat,
+            # so they neither jump ahead forever nor wait behind history
+            self._served[chat_id] = min(self._served.values(), default=0.0)
+
+        queue.append(_Job(chat_id, run, cost, self.job_slots(slots), files))
+        self._queued += 1
+        logger.info(f"Queued job for chat {chat_id} ({self._queued} queued, {self._active} running)")
+
+        self._dispatch()
+        self._update_positions()
+
+    def _eligible(self, chat_id: int) -> bool:
+        queue = self._queues.get(chat_id)
+        return (bool(queue)
+                and self._running.get(chat_id, 0) + queue[0].slots <= self.max_per_chat)
+
+    def _dispatch(self):
+        """Start jobs while there are free slots"""
+        while self._used_slots < self.max_concurrent:
+            candidates = [chat_id for chat_id in self._queues if self._eligible(chat_id)]
+            if not candidates:
+                return
+
+            chat_id = min(candidates, key=self._served.__getitem__)
+            job = self._queues[chat_id][0]
+            # Wait for enough slots rather than letting smaller jobs pass forever
+            if self._used_slots + job.slots > self.max_concurrent:
+                return
+            self._queues[chat_id].popleft()
+            self._queued -= 1
+            self._active += 1
+            self._used_slots += job.slots
+            self._running[chat_id] = self._running.get(chat_id, 0) + job.slots
+            self._served[chat_id] += job.cost
+            self._spawn(self._run(job))
+
+    async def _run(self, job: _Job):
+        try:
+            await job.run()
+        except Exception as e:
+            logger.error(f"Job for chat {job.chat_id} failed: {e}")
+        finally:
+            self._active -= 1
+            self._used_slots -= job.slots
+            self._running[job.chat_id] -= job.slots
+            self._forget(job.chat_id)
+            self._dispatch()
+            self._update_positions()
+
+    def _forget(self, chat_id: int):
+        """Drop state of chats without queued or running jobs"""
+        if not self._queues.get(chat_id) and not self._running.get(chat_id):
+            self._queues.pop(chat_id, None)
+            self._running.pop(chat_id, None)
+            self._served.pop(chat_id, None)
+
+    def _predicted_order(self) -> list[_Job]:
+        """Order in which waiting jobs would start if nothing else arrived"""
+        heap = []
+        for chat_id, queue in self._queues.items():
+            if queue:
+                heap.append((self._served[chat_id], chat_id, 0))
+        heapq.heapify(heap)
+
+        order = []
+        while heap:
+            served, chat_id, index = heapq.heappop(heap)
+            queue = self._queues[chat_id]
+            job = queue[index]
+            order.append(job)
+            if index + 1 < len(queue):
+                heapq.heappush(heap, (served + job.cost, chat_id, index + 1))
+        return order
+
+    def _update_positions(self):
+        """Report the queue status of every chat with waiting files, throttled per chat"""
+        if self.on_status is None:
+            return
+        waiting: dict[int, tuple[int, int]] = {}
+        for position, job in enumerate(self._predicted_order(), start=1):
+            files, next_position = waiting.get(job.chat_id, (0, position))
+            waiting[job.chat_id] = (files + job.files, next_position)
+
+        now = time.monotonic()
+        flush_delay = None
+        for chat_id, status in waiting.items():
+            chat_status = self._status.setdefault(chat_id, _ChatStatus())
+            if status == chat_status.last_status:
+                continue
+            delay = chat_status.last_update + self.update_interval - now
+            if delay > 0:
+                flush_delay = delay if flush_delay is None else min(flush_delay, delay)
+                continue
+            chat_status.last_status = status
+            chat_status.last_update = now
+            self._notify(chat_id, chat_status, *status)
+
+        # Chats whose files all started are told right away
+        for chat_id in [chat_id for chat_id in self._status if chat_id not in waiting]:
+            chat_status = self._status.pop(chat_id)
+            if chat_status.last_status is not None:
+                self._notify(chat_id, chat_status, 0, 0)
+
+        # Throttled updates are sent once their interval is over, even if
+        # nothing else happens in the queue until then
+        if flush_delay is not None:
+            self._schedule_flush(flush_delay)
+
+    def _schedule_flush(self, delay: float):
+        """Update positions again after delay, unless an earlier update is already scheduled"""
+        loop = asyncio.get_running_loop()
+        if self._flush_handle is not None:
+            if self._flush_handle.when() <= loop.time() + delay:
+                return
+            self._flush_handle.cancel()
+        self._flush_handle = loop.call_later(delay, self._flush)
+
+    def _flush(self):
+        self._flush_handle = None
+        self._update_positions()
+
+    def _notify(self, chat_id: int, chat_status: _ChatStatus, files: int, position: int):
+        """Run status callback after the previous one for the same chat"""
+        previous = chat_status.notify_task
+
+        async def notify():
+            if previous is not None:
+                await asyncio.gather(previous, return_exceptions=True)
+            try:
+                await self.on_status(chat_id, files, position)
+            except Exception as e:
+                logger.warning(f"Failed to report queue status to chat {chat_id}: {e}")
+
+        chat_status.notify_task = self._spawn(notify())
+
+    def _spawn(self, coro) -> asyncio.Task:
+        task = asyncio.create_task(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return task
+
+    def close(self):
+        """Drop queued jobs"""
+        self._queues.clear()
+        self._queued = 0
+        self._status.clear()
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
@@ -0,0 +1,167 @@
+import asyncio
+import logging
+import os
+import shutil
+import time
+import uuid
+
+logger = logging.getLogger(__name__)
+
+# Job directories are named job-<pid>-<random>, so the owner can be checked
+DIR_PREFIX = "job-"
+
+
+class ScratchQuotaExceeded(Exception):
+    """Raised when a job doesn't fit the scratch disk quota"""
+
+
+def _dir_size(path: str) -> int:
+    total = 0
+    for root, _, names in os.walk(path):
+        for name in names:
+            try:
+                total += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass
+    return total
+
+
+def _owner_alive(name: str) -> bool:
+    """Whether the process that created a job directory still runs
+
+    Directories of this process are only alive while their job is, and the
+    janitor skips those. One with our pid left over is from an earlier run
+    that had the same pid, as is common for the main process of a container.
+    """
+    try:
+        pid = int(name[len(DIR_PREFIX):].split('-')[0])
+    except ValueError:
+        return False
+    if pid == os.getpid():
+        return False
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class ScratchDir:
+    """Directory of one job, removed with everything in it when the job ends"""
+
+    def __init__(self, space: 'ScratchSpace', path: str, reserved: int):
+        self.space = space
+        self.path = path
+        self.reserved = reserved
+
+    def file(self, name: str) -> str:
+        """Path for a new file in the directory, unique even for repeated names
+
+        Every file gets a subdirectory of its own, so it keeps the name the
+        user knows and results and errors derived from it do too.
+        """
+        name = os.path.basename(name.replace('\\', '/'))
+        if name in ('', '.', '..'):
+            name = "file"
+        directory = os.path.join(self.path, uuid.uuid4().hex[:8])
+        os.makedirs(directory)
+        return os.path.join(directory, name)
+
+    def __enter__(self) -> 'ScratchDir':
+        return self
+
+    def __exit__(self, *exc_info):
+        self.space.release(self)
+
+
+class ScratchSpace:
+    """Per-job scratch directories under one root, with a disk quota
+
+    The root can be on a tmpfs such as /dev/shm to keep temp files in RAM.
+    A job reserves its expected disk use when its directory is created and
+    is refused if that would exceed the quota. Directories left behind by
+    crashed processes are removed by the janitor.
+    """
+
+    def __init__(self, root: str, quota_bytes: int, orphan_age: float):
+        self.root = root
+        self.quota_bytes = quota_bytes
+        self.orphan_age = orphan_age
+        self._active: dict[str, ScratchDir] = {}
+        self._reserved = 0
+        # Disk used by directories of other processes, measured by the janitor
+        self._foreign_usage = 0
+        os.makedirs(root, exist_ok=True)
+
+    @property
+    def reserved(self) -> int:
+        """Bytes reserved by the active jobs of this process"""
+        return self._reserved
+
+    def create(self, expected_bytes: int = 0) -> ScratchDir:
+        """Create a job directory, raises ScratchQuotaExceeded if it doesn't fit the quota"""
+        if self.quota_bytes and self._foreign_usage + self._reserved + expected_bytes > self.quota_bytes:
+            raise ScratchQuotaExceeded(
+                f"Scratch space is full ({(self._foreign_usage + self._reserved) // 1024 // 1024} MB in use)"
+            )
+        path = os.path.join(self.root, f"{DIR_PREFIX}{os.getpid()}-{uuid.uuid4().hex[:12]}")
+        scratch_dir = ScratchDir(self, path, expected_bytes)
+        # Registered first, the janitor removes directories of this process it doesn't know
+        self._active[path] = scratch_dir
+        self._reserved += expected_bytes
+        try:
+            os.makedirs(path)
+        except OSError:
+            self.release(scratch_dir)
+            raise
+        return scratch_dir
+
+    def release(self, scratch_dir: ScratchDir):
+        """Remove a job directory and free its reservation"""
+        if self._active.pop(scratch_dir.path, None) is not None:
+            self._reserved -= scratch_dir.reserved
+        shutil.rmtree(scratch_dir.path, ignore_errors=True)
+
+    def usage(self) -> int:
+        """Bytes counted against the quota: reserved by the jobs of this process
+        and used by other processes as of the last janitor sweep
+
+        Cheap enough to read on every metrics scrape, nothing is walked.
+        """
+        return self._foreign_usage + self._reserved
+
+    def sweep(self) -> int:
+        """Remove orphaned job directories, returns how many were removed"""
+        removed = 0
+        foreign_usage = 0
+        now = time.time()
+        with os.scandir(self.root) as entries:
+            for entry in entries:
+                if entry.path in self._active or not entry.is_dir(follow_symlinks=False):
+                    continue
+                try:
+                    age = now - entry.stat().st_mtime
+                except OSError:
+                    continue
+                # Other live processes may share the root, their directories are
+                # only removed once they are older than any job could run
+                if not entry.name.startswith(DIR_PREFIX) or not _owner_alive(entry.name) or age > self.orphan_age:
+                    logger.warning(f"Removing orphaned scratch directory {entry.path}")
+                    shutil.rmtree(entry.path, ignore_errors=True)
+                    removed += 1
+                else:
+                    foreign_usage += _dir_size(entry.path)
+        self._foreign_usage = foreign_usage
+        return removed
+
+    async def run_janitor(self, interval: float):
+        """Sweep orphaned directories periodically until cancelled"""
+        while True:
+            try:
+                await asyncio.to_thread(self.sweep)
+            except Exception as e:
+                logger.error(f"Scratch janitor failed: {e}")
+            await asyncio.sleep(interval)
+
@@ -0,0 +1,97 @@
+import io
+import logging
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import NamedTuple
+
+from PIL import Image
+
+from config import STATIC_ENCODER_THREADS, STATIC_MIN_COLORS
+
+logger = logging.getLogger(__name__)
+
+# Image modes PNG can store as they are
+PNG_MODES = ('1', 'L', 'LA', 'I', 'P', 'RGB', 'RGBA')
+
+# Lossless candidates, all give the same image so the first one that fits wins.
+# The default level is fast and usually fits, it is tried on its own first.
+DEFAULT_CANDIDATE = ('png', {'compress_level': 6})
+LOSSLESS_CANDIDATES = [
+    ('png-level9', {'compress_level': 9}),
+    ('png-optimized', {'optimize': True}),
+]
+
+# Palette sizes for lossy candidates, from best to worst quality
+PALETTE_COLORS = [256, 128, 64, 32, 16]
+
+
+class EncodedImage(NamedTuple):
+    name: str
+    data: bytes
+
+
+def _encode_png(img: Image.Image, name: str, options: dict, colors: int = None) -> EncodedImage:
+    """Encode image as PNG, quantized to a palette if colors is given"""
+    if colors is not None:
+        if img.mode not in ('RGB', 'RGBA'):
+            img = img.convert('RGBA')
+        img = img.quantize(colors, method=Image.Quantize.FASTOCTREE)
+    buffer = io.BytesIO()
+    img.save(buffer, 'PNG', **options)
+    return EncodedImage(name, buffer.getvalue())
+
+
+def encode_png_to_limit(img: Image.Image, max_bytes: int) -> EncodedImage:
+    """Encode image as the best quality PNG that fits max_bytes
+
+    The default PNG encoding is tried first and returned if it fits. Only
+    then the slower lossless candidates and palette-quantized ones with
+    decreasing color counts down to STATIC_MIN_COLORS are tried, the
+    candidates of a tier in parallel. Candidates that haven't started are
+    cancelled once the outcome is known. If nothing fits, the smallest
+    candidate is returned.
+    """
+    if img.mode not in PNG_MODES:
+        img = img.convert('RGB')
+
+    name, options = DEFAULT_CANDIDATE
+    smallest = _encode_png(img, name, options)
+    if len(smallest.data) <= max_bytes:
+        return smallest
+
+    # Decode before the image is shared between threads
+    img.load()
+    executor = ThreadPoolExecutor(max_workers=STATIC_ENCODER_THREADS)
+    try:
+        # Slower lossless tier: the first encoding that fits is good enough
+        futures = [
+            executor.submit(_encode_png, img, name, options)
+            for name, options in LOSSLESS_CANDIDATES
+        ]
+        for future in as_completed(futures):
+            encoded = future.result()
+            if len(encoded.data) <= max_bytes:
+                return encoded
+            if len(encoded.data) < len(smallest.data):
+                smallest = encoded
+
+        # Lossy tier: take the most colors that fit
+        futures = [
+            executor.submit(_encode_png, img, f"png-{colors}-colors", {'compress_level': 9}, colors)
+            for colors in PALETTE_COLORS
+            if colors >= STATIC_MIN_COLORS
+        ]
+        for future in futures:
+            encoded = future.result()
+            if len(encoded.data) <= max_bytes:
+                return encoded
+            if len(encoded.data) < len(smallest.data):
+                smallest = encoded
+    finally:
+        # Running encodes are waited for, they would compete with other jobs
+        executor.shutdown(wait=True, cancel_futures=True)
+
+    logger.warning(
+        f"No PNG encoding fits {max_bytes / 1024:.0f}KB, "
+        f"smallest is {smallest.name} at {len(smallest.data) / 1024:.2f}KB"
+    )
+    return smallest
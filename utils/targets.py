@@ -0,0 +1,60 @@
+from config import (
+    STATIC_STICKER_MAX_SIZE,
+    STATIC_STICKER_WIDTH,
+    STATIC_STICKER_HEIGHT,
+    STATIC_STICKER_FORMAT,
+    ANIMATED_STICKER_MAX_SIZE,
+    ANIMATED_STICKER_WIDTH,
+    ANIMATED_STICKER_HEIGHT,
+    ANIMATED_STICKER_FORMAT,
+    ANIMATED_STICKER_FPS,
+    ANIMATED_STICKER_MAX_DURATION,
+    STATIC_EMOJI_MAX_SIZE,
+    STATIC_EMOJI_WIDTH,
+    STATIC_EMOJI_HEIGHT,
+    STATIC_EMOJI_FORMAT,
+    ANIMATED_EMOJI_MAX_SIZE,
+    ANIMATED_EMOJI_WIDTH,
+    ANIMATED_EMOJI_HEIGHT,
+    ANIMATED_EMOJI_FORMAT,
+    ANIMATED_EMOJI_FPS,
+    ANIMATED_EMOJI_MAX_DURATION
+)
+
+
+def get_target_params(is_sticker: bool, is_animated: bool) -> dict:
+    """Get target parameters for destination and file type"""
+    if is_sticker:
+        if is_animated:
+            return {
+                'max_size': ANIMATED_STICKER_MAX_SIZE,
+                'width': ANIMATED_STICKER_WIDTH,
+                'height': ANIMATED_STICKER_HEIGHT,
+                'format': ANIMATED_STICKER_FORMAT,
+                'fps': ANIMATED_STICKER_FPS,
+                'max_duration': ANIMATED_STICKER_MAX_DURATION
+            }
+        else:
+            return {
+                'max_size': STATIC_STICKER_MAX_SIZE,
+                'width': STATIC_STICKER_WIDTH,
+                'height': STATIC_STICKER_HEIGHT,
+                'format': STATIC_STICKER_FORMAT
+            }
+    else:
+        if is_animated:
+            return {
+                'max_size': ANIMATED_EMOJI_MAX_SIZE,
+                'width': ANIMATED_EMOJI_WIDTH,
+                'height': ANIMATED_EMOJI_HEIGHT,
+                'format': ANIMATED_EMOJI_FORMAT,
+                'fps': ANIMATED_EMOJI_FPS,
+                'max_duration': ANIMATED_EMOJI_MAX_DURATION
+            }
+        else:
+            return {
+                'max_size': STATIC_EMOJI_MAX_SIZE,
+                'width': STATIC_EMOJI_WIDTH,
+                'height': STATIC_EMOJI_HEIGHT,
+                'format': STATIC_EMOJI_FORMAT
+            }
@@ -0,0 +1,79 @@
+import asyncio
+import logging
+
+from aiogram import Bot, Dispatcher
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+from aiohttp import web
+
+from config import (
+    WEBHOOK_HOST,
+    WEBHOOK_PORT,
+    WEBHOOK_PATH,
+    WEBHOOK_URL,
+    WEBHOOK_SECRET,
+    WEBHOOK_MAX_CONCURRENT_UPDATES,
+    METRICS_ENABLED,
+    METRICS_PATH,
+    READINESS_PATH
+)
+from utils.metrics import metrics_handler, readiness_handler
+
+logger = logging.getLogger(__name__)
+
+
+def _concurrency_limit(limit: int):
+    """Middleware limiting the number of updates handled at the same time"""
+    semaphore = asyncio.Semaphore(limit)
+
+    @web.middleware
+    async def middleware(request: web.Request, handler):
+        async with semaphore:
+            return await handler(request)
+
+    return middleware
+
+
+def build_webhook_app(dp: Dispatcher, bot: Bot) -> web.Application:
+    """Create aiohttp application feeding webhook updates to the dispatcher"""
+    app = web.Application(middlewares=[_concurrency_limit(WEBHOOK_MAX_CONCURRENT_UPDATES)])
+
+    # Updates are handled before responding, so the middleware limit applies
+    # to them. Handlers only queue the heavy work, so responses stay fast.
+    SimpleRequestHandler(
+        dispatcher=dp,
+        bot=bot,
+        handle_in_background=False,
+        secret_token=WEBHOOK_SECRET
+    ).register(app, path=WEBHOOK_PATH)
+    if METRICS_ENABLED:
+        app.router.add_get(METRICS_PATH, metrics_handler)
+    app.router.add_get(READINESS_PATH, readiness_handler)
+    setup_application(app, dp, bot=bot)
+    return app
+
+
+async def run_webhook(dp: Dispatcher, bot: Bot):
+    """Receive updates through a webhook until cancelled"""
+    app = build_webhook_app(dp, bot)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, WEBHOOK_HOST, WEBHOOK_PORT)
+    await site.start()
+    logger.info(f"Webhook server listening on {WEBHOOK_HOST}:{WEBHOOK_PORT}{WEBHOOK_PATH}")
+
+    # Without a public URL the server only takes locally posted updates, for testing
+    if WEBHOOK_URL:
+        await bot.set_webhook(
+            f"{WEBHOOK_URL.rstrip('/')}{WEBHOOK_PATH}",
+            secret_token=WEBHOOK_SECRET,
+            max_connections=min(WEBHOOK_MAX_CONCURRENT_UPDATES, 100),
+            allowed_updates=dp.resolve_used_update_types()
+        )
+        logger.info(f"Webhook set to {WEBHOOK_URL.rstrip('/')}{WEBHOOK_PATH}")
+    else:
+        logger.warning("WEBHOOK_URL is not set, the webhook is not registered with Telegram")
+
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
@@ -0,0 +1,238 @@
+import asyncio
+import logging
+import multiprocessing
+import os
+import queue
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import NamedTuple, Optional
+
+from config import MEMORY_BUDGET_WAIT
+from utils.admission import (
+    MediaTooLarge,
+    MemoryBudget,
+    CostEstimate,
+    cpu_time,
+    decoded_size,
+    estimate_cost,
+    peak_rss,
+    pixel_limit_reason,
+    reset_peak_rss
+)
+from utils.logger import init_worker_logging, job_id_var, set_job_id, worker_log_queue
+from utils.metrics import MEMORY_BUDGET_BYTES, MEMORY_RESERVED_BYTES, WORKER_PENDING, observe_processing
+
+logger = logging.getLogger(__name__)
+
+# Memory budget of the pool, set in every worker process by _init_worker
+_budget: Optional[MemoryBudget] = None
+
+
+class WorkerPoolBusy(Exception):
+    """Raised when the worker pool queue is full"""
+
+
+class _Admission(NamedTuple):
+    kind: str
+    estimate: CostEstimate
+    wait: float  # Seconds waited for memory
+
+
+def _init_worker(log_queue, ready_queue, budget: MemoryBudget):
+    """Set up a worker process and load the media libraries before its first job"""
+    global _budget
+    _budget = budget
+    init_worker_logging(log_queue)
+    start = time.perf_counter()
+    # Decompression bombs are caught by the pixel limits of admission control,
+    # which know that large JPEGs are decoded at a reduced scale
+    from PIL import Image
+    Image.MAX_IMAGE_PIXELS = None
+    try:
+        from utils.media_processor import warm_up
+        warm_up()
+    except Exception as e:
+        # Jobs still work, they only load what they need on first use
+        logger.error(f"Worker warm-up failed: {e}")
+    ready_queue.put((os.getpid(), time.perf_counter() - start))
+
+
+def _admit(processor, is_sticker: bool) -> Optional[_Admission]:
+    """Probe the file and reserve its predicted memory before it is decoded
+
+    Raises MediaTooLarge for files over the limits and WorkerPoolBusy when
+    the memory doesn't free up in time. Returns None for files that can't
+    be probed, processing them fails without decoding anything.
+    """
+    probe = processor.probe()
+    if probe is None or _budget is None:
+        return None
+    if probe.kind == 'static':
+        width, height = decoded_size(probe, is_sticker)
+    else:
+        width, height = probe.width, probe.height
+    reason = pixel_limit_reason(probe.kind != 'static', width, height)
+    if reason:
+        raise MediaTooLarge(reason)
+
+    estimate = estimate_cost(probe, is_sticker, processor.encoder.in_process)
+    logger.info(
+        f"Probed {probe.kind} {probe.format} {probe.width}x{probe.height}, predicted "
+        f"{estimate.memory_bytes // 1024 // 1024} MB + {estimate.encoder_bytes // 1024 // 1024} MB "
+        f"for the encoder, {estimate.cpu_seconds:.2f}s CPU time"
+    )
+    start = time.perf_counter()
+    if not _budget.reserve(estimate.total_bytes, MEMORY_BUDGET_WAIT):
+        raise WorkerPoolBusy(f"No memory for the file within {MEMORY_BUDGET_WAIT:g}s")
+    return _Admission(probe.kind, estimate, time.perf_counter() - start)
+
+
+def _run_processor(file_path: str, is_sticker: bool, job_id: str) -> tuple[str, bool, dict]:
+    """Run MediaProcessor inside a worker process, returns the result and processing stats"""
+    # Imported here, so only worker processes load OpenCV, numpy and Pillow
+    from utils.media_processor import MediaProcessor
+
+    set_job_id(job_id)
+    processor = MediaProcessor(file_path, is_sticker)
+    admission = _admit(processor, is_sticker)
+    try:
+        baseline_rss = reset_peak_rss()
+        cpu_start = cpu_time()
+        result_path, was_modified = processor.process()
+    finally:
+        if admission:
+            _budget.release(admission.estimate.total_bytes)
+
+    # The result is sent and removed by the bot process, so it must
+    # survive the processor cleanup in this worker
+    if result_path in processor.temp_files:
+        processor.temp_files.remove(result_path)
+    stats = {
+        'stage_times': processor.stage_times,
+        'encode_times': processor.encode_times,
+        'encode_attempts': processor.encode_attempts,
+        'final_size': processor.final_size
+    }
+    if admission:
+        estimate = admission.estimate
+        cpu_seconds = cpu_time() - cpu_start
+        peak = peak_rss()
+        peak_memory = peak - baseline_rss if peak is not None and baseline_rss is not None else None
+        stats['admission'] = {
+            'kind': admission.kind,
+            'predicted_memory': estimate.memory_bytes,
+            'peak_memory': peak_memory,
+            'predicted_cpu': estimate.cpu_seconds,
+            'cpu_seconds': cpu_seconds,
+            'memory_wait': admission.wait
+        }
+        logger.info(
+            f"Used {peak_memory // 1024 // 1024 if peak_memory is not None else '?'} MB "
+            f"of {estimate.memory_bytes // 1024 // 1024} MB predicted memory, "
+            f"{cpu_seconds:.2f}s of {estimate.cpu_seconds:.2f}s predicted CPU time"
+        )
+    return result_path, was_modified, stats
+
+
+class MediaWorkerPool:
+    """Bounded process pool running MediaProcessor off the event loop"""
+
+    def __init__(self, max_workers: int, max_queued: int, memory_budget: int):
+        self.max_workers = max_workers
+        self.max_pending = max_workers + max_queued
+        self.memory_budget = memory_budget
+        self._pending = 0
+        self._executor = self._create_executor()
+        MEMORY_BUDGET_BYTES.set(memory_budget)
+        MEMORY_RESERVED_BYTES.function = lambda: self._budget.reserved
+
+    def _create_executor(self) -> ProcessPoolExecutor:
+        # Workers report here once warmed up, see warm_up()
+        self._ready_queue = multiprocessing.Queue()
+        self._warm_up_times = []
+        # A new pool gets a new budget, reservations of dead workers are gone with it
+        self._budget = MemoryBudget(self.memory_budget)
+        return ProcessPoolExecutor(
+            max_workers=self.max_workers,
+            initializer=_init_worker,
+            initargs=(worker_log_queue(), self._ready_queue, self._budget)
+        )
+
+    async def warm_up(self, timeout: float) -> bool:
+        """Start every worker process and wait until they loaded the media libraries
+
+        Returns False if some workers were not ready within timeout seconds,
+        calling it again keeps waiting for those.
+        """
+        start = time.perf_counter()
+        loop = asyncio.get_running_loop()
+        ready_queue = self._ready_queue
+        # Workers that reported in an earlier call count as ready
+        warm_up_times = self._warm_up_times
+        # Forked pools start all workers with the first job, others one per waiting job
+        started = [loop.run_in_executor(self._executor, os.getpid) for _ in range(self.max_workers)]
+
+        def wait_ready():
+            deadline = time.monotonic() + timeout
+            while len(warm_up_times) < self.max_workers:
+                try:
+                    _, seconds = ready_queue.get(timeout=max(deadline - time.monotonic(), 0))
+                except queue.Empty:
+                    break
+                warm_up_times.append(seconds)
+
+        await asyncio.to_thread(wait_ready)
+        if len(warm_up_times) < self.max_workers:
+            logger.error(f"Only {len(warm_up_times)} of {self.max_workers} workers warmed up in {timeout}s")
+            return False
+        await asyncio.gather(*started, return_exceptions=True)
+        logger.info(
+            f"{self.max_workers} workers warmed up in {time.perf_counter() - start:.2f}s "
+            f"(slowest worker {max(warm_up_times):.2f}s)"
+        )
+        return True
+
+    async def warm_up_until_ready(self, timeout: float):
+        """Retry warm_up() until every worker is ready"""
+        while not await self.warm_up(timeout):
+            logger.warning("Retrying worker warm-up")
+
+    @property
+    def pending(self) -> int:
+        """Number of jobs running or waiting for a worker"""
+        return self._pending
+
+    def is_full(self) -> bool:
+        """Check if no more jobs can be accepted"""
+        return self._pending >= self.max_pending
+
+    async def process(self, file_path: str, is_sticker: bool) -> tuple[str, bool]:
+        """Process media file in a worker process"""
+        if self.is_full():
+            raise WorkerPoolBusy(f"Worker queue is full ({self._pending} jobs pending)")
+
+        self._pending += 1
+        WORKER_PENDING.set(self._pending)
+        executor = self._executor
+        try:
+            loop = asyncio.get_running_loop()
+            result_path, was_modified, stats = await loop.run_in_executor(
+                executor, _run_processor, file_path, is_sticker, job_id_var.get()
+            )
+            observe_processing(is_sticker, was_modified, stats)
+            return result_path, was_modified
+        except BrokenProcessPool:
+            # A worker died (e.g. OOM-killed), replace the pool for later jobs
+            if executor is self._executor:
+                logger.error("Worker process died, restarting the pool")
+                executor.shutdown(wait=False, cancel_futures=True)
+                self._executor = self._create_executor()
+            raise
+        finally:
+            self._pending -= 1
+            WORKER_PENDING.set(self._pending)
+
+    def shutdown(self):
+        """Stop worker processes"""
+        self._executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,169 @@
+import asyncio
+import traceback
+from contextlib import suppress
+
+from aiogram import Bot
+
+from config import (
+    BOT_TOKEN,
+    WORKER_PROCESSES,
+    WORKER_QUEUE_SIZE,
+    CACHE_DIR,
+    CACHE_MAX_SIZE,
+    SCRATCH_DIR,
+    SCRATCH_QUOTA,
+    SCRATCH_ORPHAN_AGE,
+    SCRATCH_JANITOR_INTERVAL,
+    JOB_QUEUE_POLL_INTERVAL,
+    JOB_QUEUE_CONCURRENCY,
+    METRICS_ENABLED,
+    METRICS_HOST,
+    METRICS_PORT,
+    METRICS_PATH,
+    READINESS_PATH,
+    WORKER_WARM_UP_TIMEOUT,
+    MEMORY_BUDGET,
+    OUTBOUND_GLOBAL_RATE,
+    OUTBOUND_CHAT_RATE,
+    OUTBOUND_GROUP_RATE,
+    OUTBOUND_CHAT_BURST,
+    OUTBOUND_MAX_RETRIES
+)
+from utils.admission import MediaProcessingError, MediaTooLarge, memory_budget_bytes
+from utils.job_planner import JobPlan
+from utils.job_queue import JobQueue, QueuedJob, create_job_queue
+from utils.jobs import MediaJobRunner
+from utils.logger import set_job_id, setup_logger
+from utils.metrics import TEMP_DISK_BYTES, set_ready, start_metrics_server
+from utils.outbound import OutboundScheduler
+from utils.result_cache import ResultCache
+from utils.scratch import ScratchSpace
+from utils.worker_pool import MediaWorkerPool
+
+# Initialize the logger
+logger = setup_logger()
+
+
+def load_plan(data: dict) -> JobPlan:
+    """JobPlan from a payload, fields dropped since the job was queued are ignored"""
+    return JobPlan(**{name: value for name, value in data.items() if name in JobPlan._fields})
+
+
+async def keep_lease(queue: JobQueue, job: QueuedJob):
+    """Renew the job lease while it is being processed"""
+    while True:
+        await asyncio.sleep(queue.visibility_timeout / 3)
+        await queue.extend(job.id)
+
+
+async def run_job(queue: JobQueue, runner: MediaJobRunner, job: QueuedJob):
+    """Run a queued job and record its outcome"""
+    payload = job.payload
+    chat_id = payload['chat_id']
+    job_id = set_job_id(payload.get('job_id'))
+    logger.info(f"Running job {job.id} for chat {chat_id}, attempt {job.attempts}")
+
+    lease = asyncio.create_task(keep_lease(queue, job))
+    try:
+        if 'plans' in payload:
+            plans = [load_plan(plan) for plan in payload['plans']]
+            failed = await runner.run_album(chat_id, plans, payload['is_sticker'], job_id)
+            if failed:
+                await runner.bot.send_message(
+                    chat_id,
+                    "Some files could not be processed:\n" +
+                    "\n".join(f"{file_name}: {error}" for file_name, error in failed)
+                )
+        else:
+            await runner.run(chat_id, load_plan(payload['plan']), payload['is_sticker'], job_id)
+    except MediaTooLarge as e:
+        # Retrying can't help, the file stays too large
+        logger.info(f"Job {job.id} rejected: {e}")
+        await queue.ack(job.id)
+        with suppress(Exception):
+            await runner.bot.send_message(chat_id, str(e))
+    except MediaProcessingError as e:
+        # Nor for a file that can't be decoded
+        logger.warning(f"Job {job.id} could not convert the file: {e}")
+        await queue.ack(job.id)
+        with suppress(Exception):
+            await runner.bot.send_message(chat_id, f"Error processing your file: {str(e)}")
+    except Exception as e:
+        logger.error(f"Job {job.id} failed: {e}\n{traceback.format_exc()}")
+        if await queue.fail(job, str(e)):
+            logger.info(f"Job {job.id} will be retried")
+        else:
+            logger.error(f"Job {job.id} ran out of attempts")
+            with suppress(Exception):
+                await runner.bot.send_message(chat_id, f"Error processing your file: {str(e)}")
+    else:
+        await queue.ack(job.id)
+        logger.info(f"Job {job.id} done")
+    finally:
+        lease.cancel()
+
+
+async def ready_after_warm_up(worker_pool: MediaWorkerPool):
+    """Keep warming the media workers up and report ready once they all are"""
+    await worker_pool.warm_up_until_ready(WORKER_WARM_UP_TIMEOUT)
+    set_ready()
+
+
+async def consume(queue: JobQueue, runner: MediaJobRunner):
+    """Take jobs from the queue one at a time"""
+    while True:
+        job = await queue.claim()
+        if job is None:
+            await asyncio.sleep(JOB_QUEUE_POLL_INTERVAL)
+            continue
+        await run_job(queue, runner, job)
+
+
+async def main():
+    """Start the media worker"""
+    queue = create_job_queue()
+    if queue is None:
+        raise ValueError("Workers need a job queue, set JOB_QUEUE_BACKEND to sqlite or redis")
+    bot = Bot(token=BOT_TOKEN)
+    # Every message sent to Telegram is paced below its flood limits
+    bot.session.middleware(OutboundScheduler(
+        OUTBOUND_GLOBAL_RATE, OUTBOUND_CHAT_RATE, OUTBOUND_CHAT_BURST, OUTBOUND_GROUP_RATE, OUTBOUND_MAX_RETRIES
+    ))
+    worker_pool = MediaWorkerPool(WORKER_PROCESSES, WORKER_QUEUE_SIZE, memory_budget_bytes(MEMORY_BUDGET))
+    result_cache = ResultCache(CACHE_DIR, CACHE_MAX_SIZE * 1024 * 1024)
+    scratch = ScratchSpace(SCRATCH_DIR, SCRATCH_QUOTA * 1024 * 1024, SCRATCH_ORPHAN_AGE)
+    TEMP_DISK_BYTES.function = scratch.usage
+    runner = MediaJobRunner(bot, worker_pool, result_cache, scratch)
+    metrics_runner = None
+    if METRICS_ENABLED:
+        metrics_runner = await start_metrics_server(METRICS_HOST, METRICS_PORT, METRICS_PATH, READINESS_PATH)
+
+    janitor = asyncio.create_task(scratch.run_janitor(SCRATCH_JANITOR_INTERVAL))
+
+    # Take jobs once every media worker has loaded the media libraries
+    warm_up = None
+    if await worker_pool.warm_up(WORKER_WARM_UP_TIMEOUT):
+        set_ready()
+    else:
+        # Jobs are taken anyway, the readiness probe fails until all workers are warm
+        warm_up = asyncio.create_task(ready_after_warm_up(worker_pool))
+
+    logger.info(f"Worker is running with {JOB_QUEUE_CONCURRENCY} consumers. To stop, press Ctrl+C")
+    try:
+        await asyncio.gather(*(consume(queue, runner) for _ in range(JOB_QUEUE_CONCURRENCY)))
+    finally:
+        logger.info("Worker shutdown...")
+        janitor.cancel()
+        if warm_up:
+            warm_up.cancel()
+        if metrics_runner:
+            await metrics_runner.cleanup()
+        worker_pool.shutdown()
+        result_cache.close()
+        await queue.close()
+        await bot.session.close()
+
+
+if __name__ == "__main__":
+    with suppress(KeyboardInterrupt):
+        asyncio.run(main())